@@ -8,11 +8,12 @@
 
 from parlai.core.params import ParlaiParser
 from parlai.mturk.tasks.dmg_pilot_dev.worlds import LocalDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import StreamingLogWriter, compact_log
 from parlai.agents.local_human.local_human import LocalHumanAgent
 from task_config import task_config
 
 from collections import defaultdict
-import json
+import os
 
 
 def main():
@@ -22,6 +23,12 @@ def main():
     """
     argparser = ParlaiParser(False, False)
     argparser.add_parlai_data_path()
+    argparser.add_argument('--turn_timeout', dest='turn_timeout', type=float,
+                           default=None, help='seconds a player may take for a '
+                           'single turn before the round is ended')
+    argparser.add_argument('--round_timeout', dest='round_timeout', type=float,
+                           default=None, help='maximum number of seconds a single '
+                           'round may take before it is ended')
 
     opt = argparser.parse_args()
     opt['task'] = 'dmg_pilot_dev'
@@ -35,9 +42,12 @@ def main():
 
     agents = [local_agent_1, local_agent_2]
 
+    log_writer = StreamingLogWriter()
+
     world = LocalDMGDialogWorld(
         opt=opt,
-        agents=agents
+        agents=agents,
+        shared={'log_writer': log_writer}
     )
 
     # Loop over all five rounds of the game
@@ -46,19 +56,26 @@ def main():
         while not world.episode_done():
             world.parley()
 
-        # Write the log data to file
-        with open('logs/dmg_pilot_data_{}.json'.format(world.game_nr), 'w') as f:
-            json.dump(world.conversation_log, f)
+        # The world already released its agents if a deadline expired
+        if world.timed_out():
+            print("Game timed out")
+            break
+
+        if r == 4:
+            world.shutdown()
+            break
 
         # Reset the world for the next round
-        world.round_log['data'] = []
-        world.round_log['score'] = None
+        world.round_log = {'score': None, 'data': []}
         world.selections = defaultdict(lambda: dict())
         world.turn_nr = -1
         world.round_nr += 1
         world.episodeDone = False
 
-    world.shutdown()
+    # Turn the streamed log into a single JSON file
+    if log_writer.close(world.log_path) and os.path.exists(world.log_path):
+        compact_log(world.log_path, 'logs/dmg_pilot_data_{}.json'.format(world.game_nr),
+                    rounds_key='data', messages_key='data')
 
 
 if __name__ == '__main__':
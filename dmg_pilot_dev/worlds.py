@@ -8,14 +8,18 @@
 
 from parlai.core.worlds import MultiAgentDialogWorld
 from parlai.core.worlds import validate
-from joblib import Parallel, delayed
 from parlai.tasks.dmg_pilot_dev.agents import DMGMultiRoundTeacher
 from parlai.tasks.dmg_pilot_dev.agents import WELCOME_MESSAGE
 from parlai.tasks.dmg_pilot_dev.agents import SELECTION_TOKEN
 from parlai.tasks.dmg_pilot_dev.agents import COM_TOKEN
 from parlai.tasks.dmg_pilot_dev.agents import DIF_TOKEN
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import GAME_EVENT, MESSAGE_EVENT, ROUND_EVENT
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import MessageParser, ProtocolError, SELECTION
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import default_shutdown_executor
+from parlai.mturk.tasks.dmg_pilot_mturk.worlds import wait_for_action
 
 from collections import defaultdict
+import os
 import random
 import time
 
@@ -37,6 +41,21 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
         self.common = None
         self.episodeDone = False
 
+        # The dev task only knows selections, everything else is chat
+        self.parser = MessageParser({SELECTION: SELECTION_TOKEN}, (COM_TOKEN, DIF_TOKEN))
+
+        # Deadlines (in seconds) after which an idle or overlong round is ended and the agents are released
+        self.turn_timeout = opt.get('turn_timeout')
+        self.round_timeout = opt.get('round_timeout')
+        self.round_start = None
+        self.last_action_time = None
+        self.timedOut = False
+
+        # Agents of finished games are shut down by a pool shared with all other worlds of the process
+        self.shutdown_executor = shared.get('shutdown_executor') if shared is not None else None
+        if self.shutdown_executor is None:
+            self.shutdown_executor = default_shutdown_executor()
+
         self.conversation_log = {
             'game_id': self.game_nr,
             # 'agents': self.agents,
@@ -48,6 +67,14 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
             'data': []
         }
 
+        # Stream every message and round summary to a JSON Lines log as they happen
+        self.log_writer = shared.get('log_writer') if shared is not None else None
+        self.log_path = os.path.join('logs', 'dmg_pilot_data_{}_{}.jsonl'.format(self.game_nr, time.time()))
+        self.log_event(GAME_EVENT, {
+            'game_id': self.game_nr,
+            'players': self.players
+        })
+
     def parley(self):
         """
         Main communication loop for the agents involved in the task
@@ -78,18 +105,19 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
 
                 agent.observe(validate(action))
 
+            self.round_start = time.time()
+            self.last_action_time = self.round_start
             self.turn_nr += 1
 
         # Else observe the actions of the players
         else:
             for agent, player in zip(self.agents, self.players):
 
-                # Obtain the action of a MTurk agent
-                try:
-                    action = agent.act(timeout=None)
-                # Obtain the action of a local agent
-                except TypeError:
-                    action = agent.act()
+                action = self.get_action(agent, timeout=self.time_left())
+                if action is None:
+                    self.expire_round()
+                    return
+                self.last_action_time = time.time()
 
                 # Observe the other agents
                 for other_agent in self.agents:
@@ -101,20 +129,19 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
 
                 log_entry = self.create_message_log_entry(agent, player, message)
                 self.round_log['data'].append(log_entry)
+                self.log_event(MESSAGE_EVENT, log_entry)
+
+                try:
+                    parsed = self.parser.parse(message)
+                except ProtocolError as error:
+                    print("WARNING: {}".format(error))
+                    parsed = None
 
-                message = message.split(" ")
                 # TODO: Set turn number requirement to 1 in order to prevent selections before the first message
-                if message[0] == SELECTION_TOKEN and self.turn_nr > 0:
-                    try:
-                        assert len(message) == 3
-                        image_id = message[-1]
-                        image_type = message[1]
-                        self.selections[agent][image_id] = image_type
-                        # print("Added image {} to the {} list of agent {} who is player {}"
-                        #       .format(image_id, image_type, agent, player))
-
-                    except:
-                        print("WARNING: Your selection could not be parsed properly!")
+                if parsed is not None and parsed.type == SELECTION and self.turn_nr > 0:
+                    self.selections[agent][parsed.image] = parsed.image_type
+                    # print("Added image {} to the {} list of agent {} who is player {}"
+                    #       .format(parsed.image, parsed.image_type, agent, player))
 
                     if self.all_selected():
                         self.episodeDone = True
@@ -122,6 +149,7 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
                         scores = self.send_feedback()
                         self.round_log['score'] = scores
                         self.conversation_log['data'].append(self.round_log)
+                        self.log_event(ROUND_EVENT, {'score': scores})
 
                 # Check if episode ended due to disconnection or timeout or returned hit
                 elif action['episode_done']:
@@ -129,6 +157,43 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
 
             self.turn_nr += 1
 
+    def get_action(self, agent, timeout=None):
+        """
+        Waits for the next action of the given agent
+        :param agent: the agent to obtain an action from
+        :param timeout: the number of seconds to wait for the action. None blocks until the agent acts
+        :return: the action of the agent or None if the timeout expired first
+        """
+        return wait_for_action(agent, timeout)
+
+    def time_left(self):
+        """
+        Returns the time until the earliest of the current turn and round deadlines
+        :return: the number of seconds left or None if no deadlines are set
+        """
+        deadlines = []
+        if self.turn_timeout:
+            deadlines.append(self.last_action_time + self.turn_timeout)
+        if self.round_timeout:
+            deadlines.append(self.round_start + self.round_timeout)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def expire_round(self):
+        """
+        Ends the current round after a deadline expired, logs the partial round data and releases the agents
+        :return: Nothing
+        """
+        print("Round {} timed out".format(self.round_nr+1))
+        self.round_log['timed_out'] = True
+        self.conversation_log['data'].append(self.round_log)
+        self.log_event(ROUND_EVENT, {'score': self.round_log['score'], 'timed_out': True})
+
+        self.timedOut = True
+        self.episodeDone = True
+        self.shutdown()
+
     def send_feedback(self):
         """
         Sends feedback to the player after each round of the game and calculates the scores
@@ -172,6 +237,19 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
         }
         return entry
 
+    def log_event(self, event, record):
+        """
+        Passes a record to the streaming log writer if the world has one
+        :param event: the type of the record
+        :param record: the record to log
+        :return: Nothing
+        """
+        if self.log_writer is None:
+            return
+        if event != GAME_EVENT:
+            record = dict(record, round=self.round_nr)
+        self.log_writer.write(self.log_path, event, record)
+
     def all_selected(self):
         """
         Returns True if all players selected all images
@@ -190,20 +268,17 @@ class LocalDMGDialogWorld(MultiAgentDialogWorld):
         """
         return self.episodeDone
 
+    def timed_out(self):
+        """
+        Returns True if the game was ended because a turn or round deadline expired
+        :return: True if the game was ended because a turn or round deadline expired
+        """
+        return self.timedOut
+
     def shutdown(self):
         """
-        Shuts down all mturk agents in parallel
+        Hands all mturk agents to the shared shutdown executor, which shuts them down in parallel
         (if one mturk agent is disconnected then it could prevent other mturk agents from completing.)
+        :return: a future per agent that resolves when the agent is shut down
         """
-        global shutdown_agent
-
-        def shutdown_agent(agent):
-            # Shut down MTurk agents
-            try:
-                agent.shutdown(timeout=None)
-            # Shut down local agents
-            except Exception:
-                agent.shutdown()
-
-        Parallel(n_jobs=len(self.agents), backend='threading')\
-            (delayed(shutdown_agent)(agent) for agent in self.agents)
+        return self.shutdown_executor.shutdown_agents(self.agents)
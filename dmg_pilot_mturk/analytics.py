@@ -0,0 +1,170 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.ingest import ingest, load_tables, MESSAGE_TYPES
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import CHAT
+
+from collections import OrderedDict
+from glob import glob
+import argparse
+import os
+import warnings
+
+import numpy as np
+
+
+CHAT_TYPE = MESSAGE_TYPES.index(CHAT)
+
+# Per-round statistics in the order they are reported
+STATISTICS = ('tokens', 'messages', 'utterances', 'speaker_turns', 'duration', 'time_to_first_selection',
+              'accuracy')
+
+
+def round_rows(rounds, file_ids, round_nrs):
+    """
+    Maps (file, round number) pairs to the rows of the rounds table they belong to
+    :param rounds: the rounds table
+    :param file_ids: an array of file ids
+    :param round_nrs: an array of round numbers
+    :return: an array of row indices into the rounds table
+    """
+    stride = int(rounds['round_nr'].max()) + 1 if len(rounds['round_nr']) else 1
+    keys = rounds['file'].astype(np.int64) * stride + rounds['round_nr']
+    order = np.argsort(keys, kind='stable')
+    position = np.searchsorted(keys[order], file_ids.astype(np.int64) * stride + round_nrs)
+    return order[position]
+
+
+def round_statistics(tables):
+    """
+    Computes the statistics of every round in the store
+    :param tables: the tables returned by ingest.load_tables
+    :return: an OrderedDict of arrays aligned with the rounds table: 'file', 'round_nr' and the STATISTICS
+    """
+    rounds = tables['rounds']
+    messages = tables['messages']
+    selections = tables['selections']
+    num_rounds = len(rounds['file'])
+
+    message_rows = round_rows(rounds, messages['file'], messages['round_nr'])
+    is_chat = messages['type'] == CHAT_TYPE
+
+    # A speaker turn starts with every utterance whose previous utterance in the round was made by the other player
+    chat_rows = message_rows[is_chat]
+    chat_speakers = messages['speaker'][is_chat]
+    turn_starts = np.ones(len(chat_rows), dtype=bool)
+    turn_starts[1:] = (chat_rows[1:] != chat_rows[:-1]) | (chat_speakers[1:] != chat_speakers[:-1])
+
+    first_selection = np.full(num_rounds, np.inf)
+    selection_rows = round_rows(rounds, selections['file'], selections['round_nr'])
+    np.minimum.at(first_selection, selection_rows, selections['timestamp'])
+    first_selection -= rounds['start']
+    first_selection[~np.isfinite(first_selection)] = np.nan
+
+    images = (rounds['images_a'] + rounds['images_b']).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        accuracy = (rounds['score_a'] + rounds['score_b']) / images
+    accuracy[(rounds['score_a'] < 0) | (rounds['score_b'] < 0) | (images == 0)] = np.nan
+
+    return OrderedDict([
+        ('file', rounds['file']),
+        ('round_nr', rounds['round_nr']),
+        ('tokens', np.bincount(message_rows, weights=messages['num_words'], minlength=num_rounds)),
+        ('messages', np.bincount(message_rows, minlength=num_rounds).astype(np.float64)),
+        ('utterances', np.bincount(chat_rows, minlength=num_rounds).astype(np.float64)),
+        ('speaker_turns', np.bincount(chat_rows[turn_starts], minlength=num_rounds).astype(np.float64)),
+        ('duration', rounds['duration']),
+        ('time_to_first_selection', first_selection),
+        ('accuracy', accuracy),
+    ])
+
+
+def pair_matrix(statistics, name):
+    """
+    Arranges a statistic as a matrix of pairs by rounds
+    :param statistics: the statistics returned by round_statistics
+    :param name: the name of the statistic
+    :return: a (number of files, number of rounds) array, NaN where a pair did not play a round
+    """
+    file_ids = statistics['file']
+    round_nrs = statistics['round_nr']
+    num_files = int(file_ids.max()) + 1 if len(file_ids) else 0
+    num_rounds = int(round_nrs.max()) + 1 if len(round_nrs) else 0
+    matrix = np.full((num_files, num_rounds), np.nan)
+    matrix[file_ids, round_nrs] = statistics[name]
+    return matrix
+
+
+def trend_slopes(matrix):
+    """
+    Fits a line through every row of a pairs by rounds matrix, ignoring missing rounds
+    :param matrix: the matrix returned by pair_matrix
+    :return: the slope per round of every pair, NaN for pairs with fewer than two rounds
+    """
+    present = ~np.isnan(matrix)
+    x = np.broadcast_to(np.arange(matrix.shape[1], dtype=np.float64), matrix.shape)
+    counts = present.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(present, x, 0).sum(axis=1) / counts
+        y_mean = np.where(present, matrix, 0).sum(axis=1) / counts
+        dx = np.where(present, x - x_mean[:, None], 0)
+        dy = np.where(present, matrix - y_mean[:, None], 0)
+        slopes = (dx * dy).sum(axis=1) / (dx * dx).sum(axis=1)
+    slopes[counts < 2] = np.nan
+    return slopes
+
+
+def corpus_report(tables):
+    """
+    Computes the statistics of all rounds and aggregates them by round number and by pair in a single pass
+    :param tables: the tables returned by ingest.load_tables
+    :return: a dict with the per-round 'statistics', the 'by_round' means and standard deviations over all pairs,
+        and the 'trends' slope of every statistic per pair and its mean over all pairs
+    """
+    statistics = round_statistics(tables)
+    report = {'statistics': statistics, 'by_round': OrderedDict(), 'trends': OrderedDict()}
+    for name in STATISTICS:
+        matrix = pair_matrix(statistics, name)
+        with warnings.catch_warnings():
+            # Rounds no pair reached and pairs without any timed selection are all-NaN slices
+            warnings.simplefilter('ignore', RuntimeWarning)
+            report['by_round'][name] = (np.nanmean(matrix, axis=0), np.nanstd(matrix, axis=0))
+            slopes = trend_slopes(matrix)
+            report['trends'][name] = (slopes, np.nanmean(slopes))
+    return report
+
+
+def main():
+    """
+    Prints the dialogue statistics of the collected games, ingesting new logs first.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Dialogue statistics of the collected DMG games')
+    argparser.add_argument('--logs', default=os.path.join(module_dir, 'logs'), help='directory of the game logs')
+    argparser.add_argument('--pattern', default='dmg_pilot_data_*.json')
+    argparser.add_argument('--store', default=os.path.join(module_dir, 'logs', 'store'))
+    argparser.add_argument('--workers', type=int, default=None, help='number of ingestion processes')
+    args = argparser.parse_args()
+
+    ingest(glob(os.path.join(args.logs, args.pattern)), args.store, args.workers)
+    report = corpus_report(load_tables(args.store))
+
+    num_rounds = len(next(iter(report['by_round'].values()))[0])
+    print("{:>24} ".format('round') + " ".join("{:>14}".format(i + 1) for i in range(num_rounds))
+          + " {:>14}".format('trend/round'))
+    for name in STATISTICS:
+        means, stds = report['by_round'][name]
+        print("{:>24} ".format(name)
+              + " ".join("{:>7.2f} ±{:>5.2f}".format(mean, std) for mean, std in zip(means, stds))
+              + " {:>14.3f}".format(report['trends'][name][1]))
+
+
+if __name__ == '__main__':
+    main()
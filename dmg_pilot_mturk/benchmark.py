@@ -0,0 +1,457 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.worlds import MTurkDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_dev.worlds import LocalDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_mturk.catalogue import load_catalogue
+from parlai.mturk.tasks.dmg_pilot_mturk.eligibility import EligibilityEngine
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import StreamingLogWriter
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import add_instrumentation_args, create_instrumentation
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import add_shutdown_args, create_shutdown_executor
+from parlai.mturk.tasks.dmg_pilot_mturk.sharding import ShardDispatcher
+from parlai.tasks.dmg_pilot_mturk.agents import SELECTION_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import COM_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import DIF_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import NEXT_ROUND_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import FEEDBACK_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import SELECTION_TOKEN as DEV_SELECTION_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import COM_TOKEN as DEV_COM_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import DIF_TOKEN as DEV_DIF_TOKEN
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import argparse
+import json
+import os
+import queue
+import re
+import resource
+import sys
+import threading
+import time
+
+
+# The control tokens a scripted player sends in each world. The dev task has no feedback or next round requests,
+# its world ends a round as soon as all images are selected.
+MTURK_TOKENS = {
+    'selection': SELECTION_TOKEN,
+    'common': COM_TOKEN,
+    'different': DIF_TOKEN,
+    'feedback': FEEDBACK_TOKEN,
+    'next_round': NEXT_ROUND_TOKEN,
+}
+DEV_TOKENS = {
+    'selection': DEV_SELECTION_TOKEN,
+    'common': DEV_COM_TOKEN,
+    'different': DEV_DIF_TOKEN,
+    'feedback': None,
+    'next_round': None,
+}
+
+
+class ScriptedAgent(object):
+    """
+    Bot player that replays the utterances and selections one player made in a recorded game.
+    Selections are mapped onto the images of the current round by their position in the recorded round,
+    missing selections are completed before the player asks for feedback, and the player continues to the
+    next round as soon as it received its feedback.
+    Recorded scripts are read with the MTurk task's tokens and replayed with the tokens of the world they play in.
+    In lockstep worlds, which ask every player for a message each turn, a player without a pending message sends
+    an empty one instead of blocking the turn.
+    """
+
+    def __init__(self, agent_id, worker_id, rounds, speed=0.0, numeric_image_ids=False, tokens=None, lockstep=False):
+        """
+        :param agent_id: the agent id the world uses to address the player
+        :param worker_id: the (simulated) worker id of the player
+        :param rounds: a list of (recorded images, [(offset in seconds, message text)]) tuples, one per round
+        :param speed: time scaling of the recorded message offsets. 0 replays as fast as possible
+        :param numeric_image_ids: select images by the number in their file name, as the dev world expects
+        :param tokens: the control tokens of the world, defaults to MTURK_TOKENS
+        :param lockstep: send an empty message instead of waiting when no message is pending
+        """
+        self.id = agent_id
+        self.worker_id = worker_id
+        self.rounds = rounds
+        self.speed = speed
+        self.numeric_image_ids = numeric_image_ids
+        self.tokens = tokens or MTURK_TOKENS
+        self.lockstep = lockstep
+
+        self.messages = queue.Queue()
+        self.round_nr = -1
+        self.round_start = None
+        self.next_round = self.tokens['next_round']
+        self.latencies = []
+
+    def observe(self, observation):
+        if observation.get('images'):
+            self.start_round(observation['images'])
+        elif observation.get('solution') is not None and self.next_round is not None:
+            self.messages.put((None, self.next_round))
+        elif 'bench_sent' in observation:
+            self.latencies.append(time.perf_counter() - observation['bench_sent'])
+
+    def act(self, timeout=None, blocking=True):
+        if self.lockstep or not blocking:
+            try:
+                offset, text = self.messages.get_nowait()
+            except queue.Empty:
+                return {'id': self.id, 'text': '', 'episode_done': False} if self.lockstep else None
+        else:
+            offset, text = self.messages.get()
+        if text is None:
+            return {'id': self.id, 'text': '', 'episode_done': True}
+        if self.speed and offset is not None:
+            delay = self.round_start + offset / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return {'id': self.id, 'text': text, 'episode_done': False, 'bench_sent': time.perf_counter()}
+
+    def shutdown(self, timeout=None):
+        # Release a reader that is still waiting for the next message
+        self.messages.put((None, None))
+
+    def start_round(self, images):
+        """
+        Queues the script of the next round for the given images
+        :param images: the images shown to the player in this round
+        :return: Nothing
+        """
+        # Messages the world did not ask for before the last round ended must not leak into this one
+        while not self.messages.empty():
+            self.messages.get_nowait()
+
+        self.round_nr += 1
+        self.round_start = time.time()
+        recorded_images, messages = self.rounds[self.round_nr % len(self.rounds)]
+
+        script = []
+        selected = {}
+        feedback_offset = 0
+        self.next_round = self.tokens['next_round']
+        for offset, text in messages:
+            tokens = text.split(" ", 2)
+            if tokens[0] in (NEXT_ROUND_TOKEN, FEEDBACK_TOKEN):
+                # The last round's <next_round> carries the recorded survey answers, so it is sent as recorded
+                if tokens[0] == NEXT_ROUND_TOKEN and self.next_round is not None:
+                    self.next_round = text
+                feedback_offset = offset
+                continue
+            if tokens[0] == SELECTION_TOKEN:
+                if len(tokens) != 3 or tokens[2] not in recorded_images:
+                    continue
+                image = images[recorded_images.index(tokens[2]) % len(images)]
+                selected[image] = tokens[1]
+                text = self.selection(tokens[1], image)
+            script.append((offset, text))
+            feedback_offset = max(feedback_offset, offset)
+
+        for image in images:
+            if image not in selected:
+                script.append((feedback_offset, self.selection(DIF_TOKEN, image)))
+        if self.tokens['feedback'] is not None:
+            script.append((feedback_offset, self.tokens['feedback']))
+
+        for item in sorted(script, key=lambda item: item[0]):
+            self.messages.put(item)
+
+    def selection(self, image_type, image):
+        image_type = self.tokens['common'] if image_type == COM_TOKEN else self.tokens['different']
+        if self.numeric_image_ids:
+            image = str(int(re.sub(r'\D', '', os.path.basename(str(image)))))
+        return "{} {} {}".format(self.tokens['selection'], image_type, image)
+
+
+def load_scripts(log_paths):
+    """
+    Reads recorded games and splits them into per-player scripts
+    :param log_paths: paths of game logs in the layout written by run.py
+    :return: a list of games, each a dict that maps a player label to the rounds ScriptedAgent expects
+    """
+    scripts = []
+    for path in log_paths:
+        with open(path, 'r') as f:
+            game_log = json.load(f)
+
+        script = defaultdict(list)
+        for round_log in game_log['rounds']:
+            if not round_log['messages']:
+                continue
+            round_start = round_log['messages'][0]['timestamp']
+            for player_label in game_log['agent_labels']:
+                messages = [(message['timestamp'] - round_start, message['message'])
+                            for message in round_log['messages']
+                            if message.get('speaker', message.get('speaker:')) == player_label]
+                script[player_label].append((round_log['images'][player_label], messages))
+        scripts.append(dict(script))
+    return scripts
+
+
+def reset_local_round(world):
+    world.round_log = {'score': None, 'data': []}
+    world.selections = defaultdict(lambda: dict())
+    world.turn_nr = -1
+    world.round_nr += 1
+    world.episodeDone = False
+
+
+# world class, function that resets a round or None, control tokens, whether the world always runs in lockstep
+WORLDS = {
+    'mturk': (MTurkDMGDialogWorld, None, MTURK_TOKENS, False),
+    'local': (LocalDMGDialogWorld, reset_local_round, DEV_TOKENS, True),
+}
+
+
+def play_game(world, reset_round, num_rounds=5):
+    """
+    Drives a world through a full game the same way the run scripts do
+    :param world: the world to drive
+    :param reset_round: function that prepares the world for the next round, None for worlds that move through
+        the rounds of the game themselves
+    :param num_rounds: the number of rounds of a game
+    :return: Nothing
+    """
+    if reset_round is None:
+        while not world.episode_done():
+            world.parley()
+        return
+
+    for r in range(num_rounds):
+        while not world.episode_done():
+            world.parley()
+        if world.timed_out():
+            return
+        if r == num_rounds - 1:
+            world.shutdown()
+        else:
+            reset_round(world)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes, falling back to the peak size if /proc is missing
+    :return: the resident set size in bytes
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_with_deadline(play, agents, timeout):
+    """
+    Plays a game in its own thread and gives up on it once the deadline passed
+    :param play: function that plays the game and returns whether it timed out
+    :param agents: the agents of the game, shut down to release a game that missed the deadline
+    :param timeout: the deadline in seconds, None or 0 waits for the game indefinitely
+    :return: the result of play
+    """
+    result = queue.Queue(maxsize=1)
+
+    def target():
+        try:
+            result.put((True, play()))
+        except Exception as e:
+            result.put((False, e))
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    try:
+        succeeded, value = result.get(timeout=timeout or None)
+    except queue.Empty:
+        for agent in agents:
+            agent.shutdown()
+        raise RuntimeError("Game did not finish within {} seconds".format(timeout))
+    if not succeeded:
+        raise value
+    return value
+
+
+def run_benchmark(opt, scripts, games=10, concurrency=2, speed=0.0, world='mturk', stream_logs=False, shards=0,
+                  game_timeout=600.0):
+    """
+    Plays a number of scripted games on concurrent worlds and measures throughput and resource usage
+    :param opt: the task options for the worlds
+    :param scripts: recorded games as returned by load_scripts
+    :param games: the total number of games to play
+    :param concurrency: the number of games to play at the same time
+    :param speed: time scaling of the recorded conversations. 0 replays as fast as possible
+    :param world: 'mturk' for MTurkDMGDialogWorld or 'local' for LocalDMGDialogWorld
+    :param stream_logs: write the game logs through a StreamingLogWriter as run.py does
+    :param shards: the number of processes to run the worlds in, 0 runs them in this process. Only supported
+        for the 'mturk' world
+    :param game_timeout: seconds after which a game that did not finish counts as failed, None or 0 for no limit
+    :return: a report dict
+    """
+    world_class, reset_round, tokens, lockstep = WORLDS[world]
+    lockstep = lockstep or opt.get('lockstep_parley', False)
+    catalogue = load_catalogue(opt)
+    instrumentation = create_instrumentation(opt)
+    shutdown_executor = create_shutdown_executor(opt, instrumentation)
+    # Games are assigned by the same engine as in run.py, with the worker records kept in memory
+    eligibility = EligibilityEngine(catalogue.game_ids, db_path=':memory:', instrumentation=instrumentation)
+    shared = {'catalogue': catalogue, 'scheduler': eligibility,
+              'instrumentation': instrumentation, 'shutdown_executor': shutdown_executor}
+    if stream_logs and not shards:
+        shared['log_writer'] = StreamingLogWriter()
+    dispatcher = None
+    if shards:
+        dispatcher = ShardDispatcher(opt, shards, scheduler=shared['scheduler'], shutdown_executor=shutdown_executor,
+                                     stream_logs=stream_logs, instrumentation=instrumentation)
+
+    durations = []
+    latencies = []
+    timeouts = [0]
+    failures = []
+    lock = threading.Lock()
+
+    def run_game(index):
+        script = scripts[index % len(scripts)]
+        agents = [ScriptedAgent('mturk_agent_{}'.format(i + 1), 'bench_{}_{}'.format(index, player_label),
+                                script[player_label], speed, numeric_image_ids=(world == 'local'), tokens=tokens,
+                                lockstep=lockstep)
+                  for i, player_label in enumerate(sorted(script))]
+
+        def play():
+            if dispatcher is not None:
+                return dispatcher.run_game(agents, index).get('timed_out', True)
+            game_world = world_class(opt=opt, agents=agents, shared=shared)
+            play_game(game_world, reset_round)
+            if stream_logs:
+                shared['log_writer'].close(game_world.log_path)
+            return game_world.timed_out()
+
+        start = time.perf_counter()
+        try:
+            timed_out = run_with_deadline(play, agents, game_timeout)
+        except Exception as e:
+            with lock:
+                failures.append("game {}: {}".format(index, e))
+            return
+        duration = time.perf_counter() - start
+
+        with lock:
+            durations.append(duration)
+            for agent in agents:
+                latencies.extend(agent.latencies)
+            if timed_out:
+                timeouts[0] += 1
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_game, range(games)))
+    wall_time = time.perf_counter() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+
+    # The CPU time of the shards is only known once they exited
+    if dispatcher is not None:
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        dispatcher.close()
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time += (children_end.ru_utime - children_start.ru_utime) \
+            + (children_end.ru_stime - children_start.ru_stime)
+    shutdown_executor.close()
+    eligibility.close()
+    instrumentation.close()
+
+    return {
+        'world': world,
+        'games': games,
+        'concurrency': concurrency,
+        'shards': shards,
+        'speed': speed,
+        'timeouts': timeouts[0],
+        'failures': failures,
+        'wall_time': wall_time,
+        'games_per_sec': games / wall_time,
+        'game_duration_p50': percentile(durations, 50),
+        'game_duration_p95': percentile(durations, 95),
+        'turn_latency_p50': percentile(latencies, 50),
+        'turn_latency_p95': percentile(latencies, 95),
+        'turn_latency_p99': percentile(latencies, 99),
+        'turn_latency_max': max(latencies) if latencies else None,
+        'messages': len(latencies),
+        'cpu_time': cpu_time,
+        'cpu_utilization': cpu_time / wall_time,
+        'rss_bytes': current_rss(),
+        'max_rss_bytes': usage_end.ru_maxrss * 1024,
+        'counters': instrumentation.snapshot()['counters'],
+    }
+
+
+def main():
+    """
+    Runs the self-play load benchmark and prints its report.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Headless self-play load benchmark for the DMG worlds')
+    argparser.add_argument('--logs', nargs='+', default=glob(os.path.join(module_dir, 'logs', '*.json')),
+                           help='recorded game logs to replay')
+    argparser.add_argument('--games_file', default=os.path.join(module_dir, 'dmg_pilot_mturk_games.json'))
+    argparser.add_argument('--games', type=int, default=100, help='total number of games to play')
+    argparser.add_argument('--concurrency', type=int, default=10, help='number of games played at the same time')
+    argparser.add_argument('--speed', type=float, default=0.0,
+                           help='time scaling of the recorded conversations, 0 replays as fast as possible')
+    argparser.add_argument('--world', choices=sorted(WORLDS), default='mturk')
+    argparser.add_argument('--lockstep_parley', action='store_true')
+    argparser.add_argument('--stream_logs', action='store_true', help='write game logs as run.py does')
+    argparser.add_argument('--shards', type=int, nargs='+', default=[0],
+                           help='number of processes to run the worlds in, 0 runs them in the benchmark process. '
+                           'Several values run the benchmark once per value, e.g. --shards 1 2 4')
+    argparser.add_argument('--game_timeout', type=float, default=600.0,
+                           help='seconds after which an unfinished game fails the run, 0 waits indefinitely')
+    argparser.add_argument('--report', default=None, help='write the report as JSON to this file')
+    add_instrumentation_args(argparser)
+    add_shutdown_args(argparser)
+    argparser.set_defaults(log_level='warning')
+    args = argparser.parse_args()
+
+    opt = {
+        'task': 'dmg_pilot_mturk',
+        'games_file': args.games_file,
+        'lockstep_parley': args.lockstep_parley,
+        'log_level': args.log_level,
+        'log_sample_rate': args.log_sample_rate,
+        'metrics_file': args.metrics_file,
+        'metrics_format': args.metrics_format,
+        'shutdown_workers': args.shutdown_workers,
+        'shutdown_timeout': args.shutdown_timeout,
+    }
+    scripts = load_scripts(args.logs)
+    reports = []
+    for shards in args.shards:
+        report = run_benchmark(opt, scripts, args.games, args.concurrency, args.speed, args.world, args.stream_logs,
+                               shards, args.game_timeout)
+        for key, value in report.items():
+            print("{:>20}: {}".format(key, value))
+        print()
+        reports.append(report)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports[0] if len(reports) == 1 else reports, f, indent=2)
+    if any(report['failures'] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
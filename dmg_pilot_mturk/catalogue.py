@@ -0,0 +1,143 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.tasks.dmg_pilot_mturk.agents import DMGMultiRoundTeacher
+from parlai.tasks.dmg_pilot_mturk.agents import WELCOME_MESSAGE
+
+from types import MappingProxyType
+import json
+import threading
+
+
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+
+class RoundIndex(object):
+    """
+    Precomputed view of a single game round.
+    Holds the images of every player, the common images as a frozenset of paths, and the welcome message that is sent
+    to every player at the round start, split around the id of the agent playing the player.
+    """
+
+    __slots__ = ('round_nr', 'images', 'common', 'welcome_parts')
+
+    # Stands in for the agent id while the welcome messages are precomputed
+    PLAYER_PLACEHOLDER = '\x00player\x00'
+
+    def __init__(self, round_nr, images):
+        """
+        :param round_nr: the number of the round in its game, starting at 0
+        :param images: a dict that maps each player label to the tuple of images shown in this round
+        """
+        self.round_nr = round_nr
+        self.images = MappingProxyType(dict(images))
+        self.common = frozenset.intersection(*[frozenset(player_images) for player_images in images.values()])
+        self.welcome_parts = MappingProxyType({
+            player_label: tuple(WELCOME_MESSAGE.format(round_nr + 1, self.PLAYER_PLACEHOLDER,
+                                                       "".join("{} \n".format(image) for image in player_images))
+                                .split(self.PLAYER_PLACEHOLDER))
+            for player_label, player_images in images.items()
+        })
+
+    def welcome(self, player_label, player):
+        """
+        Returns the welcome message that starts this round for a player
+        :param player_label: the label of the player in the game
+        :param player: the id of the agent playing the player
+        :return: a new action dict holding the welcome text and the player's images
+        """
+        return {
+            'text': str(player).join(self.welcome_parts[player_label]),
+            'images': self.images[player_label]
+        }
+
+    def is_common(self, image):
+        """
+        Returns True if the image is shown to all players in this round
+        :param image: the path of the image
+        :return: True if the image is shown to all players in this round
+        """
+        return image in self.common
+
+
+class GameCatalogue(object):
+    """
+    Immutable collection of DMG games, indexed by game id.
+    A game maps each player label to a tuple of rounds, each round being a tuple of image paths.
+    Every image is interned to an integer id, and every game round is indexed once at load time as a RoundIndex.
+    """
+
+    def __init__(self, games):
+        index = {}
+        image_ids = {}
+        for position, game in enumerate(games):
+            game_id = game.get('game_id', position)
+            index[game_id] = MappingProxyType({
+                player_label: tuple(tuple(images) for images in rounds)
+                for player_label, rounds in game.items() if player_label != 'game_id'
+            })
+            for rounds in index[game_id].values():
+                for images in rounds:
+                    for image in images:
+                        image_ids.setdefault(image, len(image_ids))
+
+        round_index = {}
+        for game_id, game in index.items():
+            num_rounds = min(len(rounds) for rounds in game.values())
+            round_index[game_id] = tuple(
+                RoundIndex(round_nr, {player_label: rounds[round_nr] for player_label, rounds in game.items()})
+                for round_nr in range(num_rounds)
+            )
+
+        self.game_ids = tuple(index.keys())
+        self.index = MappingProxyType(index)
+        self.round_index = MappingProxyType(round_index)
+        self.image_ids = MappingProxyType(image_ids)
+        self.images = tuple(sorted(image_ids, key=image_ids.get))
+
+    def rounds(self, game_id):
+        """
+        Returns the precomputed rounds of a game
+        :param game_id: the id of the game
+        :return: a tuple with a RoundIndex per round
+        """
+        return self.round_index[game_id]
+
+    def __len__(self):
+        return len(self.game_ids)
+
+    def __iter__(self):
+        return iter(self.game_ids)
+
+    def __contains__(self, game_id):
+        return game_id in self.index
+
+    def __getitem__(self, game_id):
+        return self.index[game_id]
+
+
+def load_catalogue(opt):
+    """
+    Returns the process-wide game catalogue, loading it on first use.
+    Games are read from opt['games_file'] if it is set and from the task's DMGMultiRoundTeacher otherwise.
+    :param opt: the task options
+    :return: the shared GameCatalogue
+    """
+    key = opt.get('games_file') or opt.get('task')
+
+    with _catalogues_lock:
+        if key not in _catalogues:
+            if opt.get('games_file'):
+                with open(opt['games_file'], 'r') as f:
+                    games = json.load(f)
+            else:
+                games = DMGMultiRoundTeacher(opt=opt).episodes
+            _catalogues[key] = GameCatalogue(games)
+
+        return _catalogues[key]
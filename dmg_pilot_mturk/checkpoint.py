@@ -0,0 +1,102 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+import json
+import sqlite3
+import threading
+import time
+
+
+CHECKPOINT_VERSION = 1
+
+
+class CheckpointStore(object):
+    """
+    Durable store of the state of in-progress games, keyed by the workers that play them.
+    Worlds replace their game's checkpoint at every round boundary (and optionally on every selection) in a single
+    transaction, so after a crash of the task process or a dropped worker a new world for the same workers can
+    continue the game from its last checkpoint. Checkpoints are removed when their game is completed, and expire
+    once they were not updated for max_age seconds.
+    """
+
+    def __init__(self, db_path=':memory:', max_age=None):
+        """
+        :param db_path: the path of the SQLite database holding the checkpoints
+        :param max_age: the number of seconds after its last update a checkpoint expires, None to keep it
+        """
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints "
+                        "(game_key TEXT PRIMARY KEY, game_id TEXT, round_nr INTEGER, state TEXT, updated REAL)")
+        self.db.commit()
+
+    @staticmethod
+    def key(worker_ids):
+        return "|".join(sorted(str(worker_id) for worker_id in worker_ids))
+
+    def save(self, worker_ids, state):
+        """
+        Replaces the checkpoint of the game of the given workers
+        :param worker_ids: the worker ids of the players
+        :param state: the JSON serializable state of the game, with its 'game_id' and 'round_nr'
+        :return: Nothing
+        """
+        state = dict(state, version=CHECKPOINT_VERSION)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                            (self.key(worker_ids), json.dumps(state['game_id']), state['round_nr'],
+                             json.dumps(state), time.time()))
+            self.db.commit()
+
+    def load(self, worker_ids):
+        """
+        Returns the checkpoint of the game of the given workers
+        :param worker_ids: the worker ids of the players
+        :return: the state of the game or None if the workers have no game in progress
+        """
+        with self.lock:
+            self.expire()
+            row = self.db.execute("SELECT state FROM checkpoints WHERE game_key = ?",
+                                  (self.key(worker_ids),)).fetchone()
+        if row is None:
+            return None
+        state = json.loads(row[0])
+        if state.get('version') != CHECKPOINT_VERSION:
+            return None
+        return state
+
+    def delete(self, worker_ids):
+        with self.lock:
+            self.db.execute("DELETE FROM checkpoints WHERE game_key = ?", (self.key(worker_ids),))
+            self.db.commit()
+
+    def pending(self):
+        """
+        Returns the games that have a checkpoint
+        :return: a list of (worker ids, game id, round number, time of the checkpoint) tuples
+        """
+        with self.lock:
+            self.expire()
+            rows = self.db.execute("SELECT game_key, game_id, round_nr, updated FROM checkpoints "
+                                   "ORDER BY updated").fetchall()
+        return [(game_key.split("|"), json.loads(game_id), round_nr, updated)
+                for game_key, game_id, round_nr, updated in rows]
+
+    def expire(self):
+        # Only called with the lock held
+        if self.max_age is None:
+            return
+        if self.db.execute("DELETE FROM checkpoints WHERE updated < ?", (time.time() - self.max_age,)).rowcount:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
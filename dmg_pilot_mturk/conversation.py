@@ -0,0 +1,236 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from array import array
+from collections import OrderedDict
+import sys
+
+
+class MessageRecord(object):
+    """
+    A single chat or control message of a round. The speaker is stored as the index of the player in its conversation
+    """
+
+    __slots__ = ('turn', 'player', 'text')
+
+    def __init__(self, turn, player, text):
+        self.turn = turn
+        self.player = player
+        self.text = text
+
+
+class RoundState(object):
+    """
+    State of a single game round.
+    Messages are slotted records with their timestamps kept in a separate array column, and the selections of every
+    player map integer image ids to the interned selection token.
+    """
+
+    __slots__ = ('conversation', 'round_nr', 'score', 'images', 'timed_out', 'messages', 'timestamps', 'selections')
+
+    def __init__(self, conversation):
+        """
+        :param conversation: the ConversationState the round belongs to
+        """
+        self.conversation = conversation
+        self.round_nr = None
+        self.score = None
+        self.images = None
+        self.timed_out = False
+        self.messages = []
+        self.timestamps = array('d')
+        self.selections = [{} for _ in conversation.players]
+
+    def add_message(self, timestamp, turn, player, text):
+        """
+        Records a message of the round
+        :param timestamp: the time at which the message was received
+        :param turn: the turn of the round in which the message was sent
+        :param player: the index of the player that sent the message
+        :param text: the text of the message
+        :return: the index of the message in the round
+        """
+        self.messages.append(MessageRecord(turn, player, text))
+        self.timestamps.append(timestamp)
+        return len(self.messages) - 1
+
+    def select(self, player, image, image_type):
+        """
+        Records the selection of an image
+        :param player: the index of the player that made the selection
+        :param image: the path of the selected image
+        :param image_type: the selection token, marking the image as common or different
+        :return: Nothing
+        """
+        self.selections[player][self.conversation.image_id(image)] = sys.intern(image_type)
+
+    def selected(self, player):
+        """
+        Returns the selections of a player
+        :param player: the index of the player
+        :return: a list of (image path, selection token) tuples in the order of selection
+        """
+        return [(self.conversation.image_path(image), image_type)
+                for image, image_type in self.selections[player].items()]
+
+    def message_log(self, index):
+        """
+        Serializes a message to the log schema
+        :param index: the index of the message in the round
+        :return: the log entry of the message
+        """
+        message = self.messages[index]
+        return OrderedDict([
+            ('timestamp', self.timestamps[index]),
+            ('turn', message.turn),
+            ('speaker:', self.conversation.agent_labels[message.player]),
+            ('agent_label', self.conversation.players[message.player]),
+            ('agent_id', self.conversation.agent_ids[message.player]),
+            ('message', message.text)
+        ])
+
+    def summary(self):
+        """
+        Serializes the round to the log schema without its messages
+        :return: the round summary
+        """
+        summary = OrderedDict([
+            ('round_nr', self.round_nr),
+            ('score', self.score),
+            ('images', dict(self.images) if self.images is not None else None)
+        ])
+        if self.timed_out:
+            summary['timed_out'] = True
+        return summary
+
+    def to_log(self):
+        """
+        Serializes the round to the log schema
+        :return: the round log
+        """
+        round_log = self.summary()
+        round_log['messages'] = [self.message_log(index) for index in range(len(self.messages))]
+        return round_log
+
+    def to_checkpoint(self):
+        """
+        Serializes the complete round state, including the selections, to a JSON compatible dict
+        :return: the checkpoint of the round
+        """
+        return {
+            'round_nr': self.round_nr,
+            'score': self.score,
+            'images': {label: list(images) for label, images in self.images.items()} if self.images else None,
+            'timed_out': self.timed_out,
+            'messages': [[self.timestamps[index], message.turn, message.player, message.text]
+                         for index, message in enumerate(self.messages)],
+            'selections': [[[self.conversation.image_path(image), image_type]
+                            for image, image_type in selections.items()] for selections in self.selections],
+        }
+
+    @classmethod
+    def from_checkpoint(cls, conversation, checkpoint):
+        """
+        Rebuilds a round state from its checkpoint
+        :param conversation: the ConversationState the round belongs to
+        :param checkpoint: the dict returned by to_checkpoint
+        :return: the RoundState
+        """
+        round_state = cls(conversation)
+        round_state.round_nr = checkpoint['round_nr']
+        round_state.score = checkpoint['score']
+        round_state.images = checkpoint['images']
+        round_state.timed_out = checkpoint['timed_out']
+        for timestamp, turn, player, text in checkpoint['messages']:
+            round_state.add_message(timestamp, turn, player, text)
+        for player, selections in enumerate(checkpoint['selections']):
+            for image, image_type in selections:
+                round_state.select(player, image, image_type)
+        return round_state
+
+
+class ConversationState(object):
+    """
+    Compact in-memory state of a game conversation that is only turned into the log schema when it is written.
+    Player, label and worker ids are interned once per conversation and images are referred to by the integer ids
+    of the game catalogue.
+    """
+
+    __slots__ = ('game_id', 'players', 'agent_labels', 'agent_ids', 'image_ids', 'images', 'rounds')
+
+    def __init__(self, game_id, players, agent_labels, agent_ids, image_ids, images):
+        """
+        :param game_id: the id of the game that is played
+        :param players: the agent ids of the players
+        :param agent_labels: the labels of the players in the game
+        :param agent_ids: the worker ids of the players
+        :param image_ids: a dict that maps each image path to its integer id
+        :param images: a sequence that maps each integer id back to its image path
+        """
+        self.game_id = game_id
+        self.players = tuple(sys.intern(str(player)) for player in players)
+        self.agent_labels = tuple(sys.intern(str(label)) for label in agent_labels)
+        self.agent_ids = tuple(sys.intern(str(agent_id)) for agent_id in agent_ids)
+        self.image_ids = image_ids
+        self.images = images
+        self.rounds = []
+
+    def new_round(self):
+        return RoundState(self)
+
+    def image_id(self, image):
+        # Images that are not part of the catalogue keep their path
+        return self.image_ids.get(image, image)
+
+    def image_path(self, image):
+        return self.images[image] if isinstance(image, int) else image
+
+    def header(self):
+        """
+        Serializes the game information to the log schema
+        :return: the game information without its rounds
+        """
+        return OrderedDict([
+            ('game_id', self.game_id),
+            ('players', list(self.players)),
+            ('agent_labels', list(self.agent_labels)),
+            ('agent_ids', list(self.agent_ids))
+        ])
+
+    def to_log(self):
+        """
+        Serializes the conversation to the log schema
+        :return: the conversation log
+        """
+        conversation_log = self.header()
+        conversation_log['rounds'] = [round_state.to_log() for round_state in self.rounds]
+        return conversation_log
+
+    def to_checkpoint(self):
+        """
+        Serializes the conversation with all completed rounds to a JSON compatible dict
+        :return: the checkpoint of the conversation
+        """
+        checkpoint = dict(self.header())
+        checkpoint['rounds'] = [round_state.to_checkpoint() for round_state in self.rounds]
+        return checkpoint
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, image_ids, images):
+        """
+        Rebuilds a conversation from its checkpoint
+        :param checkpoint: the dict returned by to_checkpoint
+        :param image_ids: a dict that maps each image path to its integer id
+        :param images: a sequence that maps each integer id back to its image path
+        :return: the ConversationState
+        """
+        conversation = cls(checkpoint['game_id'], checkpoint['players'], checkpoint['agent_labels'],
+                           checkpoint['agent_ids'], image_ids, images)
+        conversation.rounds = [RoundState.from_checkpoint(conversation, round_checkpoint)
+                               for round_checkpoint in checkpoint['rounds']]
+        return conversation
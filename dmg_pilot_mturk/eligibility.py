@@ -0,0 +1,341 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import default_instrumentation, WARNING
+
+import json
+import random
+import sqlite3
+import threading
+
+
+def bit_count(mask):
+    return bin(mask).count('1')
+
+
+def nth_bit(mask, n):
+    """
+    Returns the position of the n-th set bit of a bitset, scanning it in 64 bit words
+    :param mask: the bitset
+    :param n: the index of the set bit, starting at 0
+    :return: the position of the bit
+    """
+    offset = 0
+    while True:
+        word = mask & 0xFFFFFFFFFFFFFFFF
+        count = bit_count(word)
+        if n < count:
+            break
+        n -= count
+        mask >>= 64
+        offset += 64
+
+    while True:
+        low = word & -word
+        if n == 0:
+            return offset + low.bit_length() - 1
+        word ^= low
+        n -= 1
+
+
+class WorkerRecord(object):
+    """
+    The games a worker played, as bitsets over the engine's game bits.
+    plays[k] holds the games the worker played more than k times, so the last bitset holds the blocked games.
+    """
+
+    __slots__ = ('worker_id', 'plays', 'num_games', 'last_game', 'banned')
+
+    def __init__(self, worker_id, max_plays, plays=None, num_games=0, last_game=None, banned=False):
+        self.worker_id = worker_id
+        self.plays = list(plays) if plays else [0] * max_plays
+        self.num_games = num_games
+        self.last_game = last_game
+        self.banned = banned
+
+    @property
+    def played(self):
+        return self.plays[0]
+
+    @property
+    def blocked(self):
+        return self.plays[-1]
+
+    def add_play(self, bit):
+        mask = 1 << bit
+        for k in range(len(self.plays)):
+            if not self.plays[k] & mask:
+                self.plays[k] |= mask
+                break
+        self.num_games += 1
+        self.last_game = bit
+
+
+class EligibilityEngine(object):
+    """
+    Decides which workers may play and which game a pair of workers plays, backed by a SQLite store.
+    Every worker record is read from the store once and then kept in memory, so ban and block checks are dictionary
+    lookups and bit operations regardless of the number of workers. Games are picked by sampling directly from the
+    bitset of games the pair is allowed to play, preferring the least played ones. The store runs in WAL mode and is
+    shared by all conversation threads, so records survive restarts of the task.
+    """
+
+    def __init__(self, game_ids, db_path=':memory:', max_games=10, max_plays_per_game=1, partner_window=3,
+                 seed=None, instrumentation=None):
+        """
+        :param game_ids: the ids of the games that can be assigned
+        :param db_path: the path of the SQLite database holding the worker records
+        :param max_games: the number of games after which a worker is banned from the task
+        :param max_plays_per_game: the number of times a worker may play the same game. With more than one play,
+            a worker's last game is offered again with a partner that never played it
+        :param partner_window: the number of queued workers that are checked for a partner of a worker's last game
+        :param seed: the seed of the game sampling
+        :param instrumentation: the Instrumentation to report assignment problems to
+        """
+        self.instrumentation = instrumentation or default_instrumentation()
+        self.max_games = max_games
+        self.max_plays = max_plays_per_game
+        self.partner_window = partner_window
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS games "
+                        "(game_key TEXT PRIMARY KEY, bit INTEGER UNIQUE, plays INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS workers "
+                        "(worker_id TEXT PRIMARY KEY, plays TEXT, num_games INTEGER, last_game INTEGER, "
+                        "banned INTEGER)")
+
+        # Games keep their bit across runs so stored worker bitsets stay valid when the catalogue grows
+        self.bits = {}
+        self.game_plays = {}
+        for game_key, bit, plays in self.db.execute("SELECT game_key, bit, plays FROM games"):
+            self.bits[json.loads(game_key)] = bit
+            self.game_plays[bit] = plays
+        for game_id in game_ids:
+            if game_id not in self.bits:
+                bit = len(self.bits)
+                self.bits[game_id] = bit
+                self.game_plays[bit] = 0
+                self.db.execute("INSERT INTO games VALUES (?, ?, ?)", (json.dumps(game_id), bit, 0))
+        self.db.commit()
+
+        self.game_ids = {bit: game_id for game_id, bit in self.bits.items()}
+        self.available = 0
+        for game_id in game_ids:
+            self.available |= 1 << self.bits[game_id]
+
+        # Bitsets of the available games by the number of times they were played
+        self.levels = {}
+        for game_id in game_ids:
+            bit = self.bits[game_id]
+            self.levels[self.game_plays[bit]] = self.levels.get(self.game_plays[bit], 0) | (1 << bit)
+
+        self.workers = {}
+        self.reserved = {}
+
+    def record_for(self, worker_id):
+        """
+        Returns the record of a worker, reading it from the store the first time the worker is seen
+        :param worker_id: the id of the worker
+        :return: the WorkerRecord of the worker
+        """
+        record = self.workers.get(worker_id)
+        if record is None:
+            row = self.db.execute("SELECT plays, num_games, last_game, banned FROM workers WHERE worker_id = ?",
+                                  (worker_id,)).fetchone()
+            if row is None:
+                record = WorkerRecord(worker_id, self.max_plays)
+            else:
+                plays = [int(mask, 16) for mask in json.loads(row[0])]
+                plays = (plays + [0] * self.max_plays)[:self.max_plays]
+                record = WorkerRecord(worker_id, self.max_plays, plays, row[1], row[2], bool(row[3]))
+            self.workers[worker_id] = record
+        return record
+
+    def save(self, record):
+        self.db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)",
+                        (record.worker_id, json.dumps([format(mask, 'x') for mask in record.plays]),
+                         record.num_games, record.last_game, int(record.banned)))
+
+    def is_eligible(self, worker_id):
+        """
+        Returns True if the worker is not banned and has games left to play
+        :param worker_id: the id of the worker
+        :return: True if the worker may play
+        """
+        with self.lock:
+            record = self.record_for(worker_id)
+            return not record.banned and self.available & ~record.blocked != 0
+
+    def ban(self, worker_id):
+        """
+        Bans a worker from the task
+        :param worker_id: the id of the worker
+        :return: Nothing
+        """
+        with self.lock:
+            record = self.record_for(worker_id)
+            record.banned = True
+            self.save(record)
+            self.db.commit()
+
+    def allowed_games(self, worker_ids):
+        """
+        Returns the games the given workers may play together. A game is allowed if none of the workers is blocked
+        from it and at most one of them played it before
+        :param worker_ids: the ids of the workers
+        :return: a bitset of the allowed games
+        """
+        records = [self.record_for(worker_id) for worker_id in worker_ids]
+        allowed = self.available
+        played_by_any = 0
+        for record in records:
+            allowed &= ~record.blocked
+            allowed &= ~(played_by_any & record.played)
+            played_by_any |= record.played
+        return allowed
+
+    def unseen_games(self, worker_ids):
+        with self.lock:
+            unseen = self.available
+            for worker_id in worker_ids:
+                unseen &= ~self.record_for(worker_id).played
+            return unseen
+
+    def sample(self, allowed):
+        """
+        Picks a random game from the least played level that holds an allowed game
+        :param allowed: a bitset of the allowed games
+        :return: the bit of the game or None if no game is allowed
+        """
+        for count in sorted(self.levels):
+            candidates = self.levels[count] & allowed
+            if candidates:
+                return nth_bit(candidates, self.random.randrange(bit_count(candidates)))
+        return None
+
+    def choose_game(self, worker_ids):
+        """
+        Chooses the game for a group of workers
+        :param worker_ids: the ids of the workers, the first one being the longest waiting worker
+        :return: the bit of the game or None if the workers cannot play together
+        """
+        allowed = self.allowed_games(worker_ids)
+
+        # Offer the first worker's last game again if the others never played it
+        last_game = self.record_for(worker_ids[0]).last_game if worker_ids else None
+        if self.max_plays > 1 and last_game is not None and allowed & (1 << last_game) \
+                and all(not self.record_for(worker_id).played & (1 << last_game) for worker_id in worker_ids[1:]):
+            return last_game
+
+        bit = self.sample(self.unseen_games(worker_ids))
+        if bit is None:
+            bit = self.sample(allowed)
+        return bit
+
+    def match(self, workers):
+        """
+        Pairs the longest waiting eligible worker with the first queued worker it can play a game with
+        and reserves that game for the pair. Usable as a {'func': ..., 'multiple': True} eligibility function
+        :param workers: the waiting workers in the order of their arrival
+        :return: the two matched workers or an empty list
+        """
+        with self.lock:
+            eligible = [worker for worker in workers if self.is_eligible(worker.worker_id)]
+            for i, worker in enumerate(eligible):
+                # Prefer partners that never played the worker's last game, so that game can be replayed
+                last_game = self.record_for(worker.worker_id).last_game
+                partners = eligible[i + 1:]
+                if self.max_plays > 1 and last_game is not None:
+                    preferred = [partner for partner in partners[:self.partner_window]
+                                 if not self.record_for(partner.worker_id).played & (1 << last_game)]
+                    partners = preferred + [partner for partner in partners if partner not in preferred]
+
+                for partner in partners:
+                    worker_ids = (worker.worker_id, partner.worker_id)
+                    bit = self.choose_game(worker_ids)
+                    if bit is not None:
+                        self.reserve(worker_ids, bit)
+                        return [worker, partner]
+            return []
+
+    def reserve(self, worker_ids, bit):
+        """
+        Reserves a game for a group of workers until their world asks for it through assign
+        :param worker_ids: the ids of the workers
+        :param bit: the bit of the game
+        :return: Nothing
+        """
+        with self.lock:
+            self.reserved[frozenset(worker_ids)] = bit
+
+    def reserve_unseen(self, worker_ids):
+        """
+        Picks a game none of the given workers played and reserves it for them, in one step so no world records a
+        play between the sampling and the reservation
+        :param worker_ids: the ids of the workers
+        :return: the bit of the reserved game or None if the workers share no unplayed game
+        """
+        with self.lock:
+            bit = self.sample(self.unseen_games(worker_ids))
+            if bit is not None:
+                self.reserve(worker_ids, bit)
+            return bit
+
+    def assign(self, worker_ids):
+        """
+        Returns the game reserved for the given workers, or chooses one, and records it for all of them.
+        Serves as the worlds' scheduler, so the engine can be shared with the worlds through shared['scheduler']
+        :param worker_ids: the ids of the workers that are going to play the game together
+        :return: the id of the assigned game
+        """
+        with self.lock:
+            bit = self.reserved.pop(frozenset(worker_ids), None)
+            if bit is None:
+                bit = self.choose_game(list(worker_ids))
+            if bit is None:
+                self.instrumentation.event(WARNING, 'no_allowed_game', workers=list(worker_ids))
+                bit = self.sample(self.available)
+
+            self.record(bit, worker_ids)
+            return self.game_ids[bit]
+
+    def record(self, bit, worker_ids):
+        """
+        Records that the given workers play a game, bans the workers that reached the game limit and persists
+        the changes in a single transaction
+        :param bit: the bit of the game
+        :param worker_ids: the ids of the workers that play the game
+        :return: Nothing
+        """
+        count = self.game_plays[bit]
+        self.levels[count] &= ~(1 << bit)
+        if not self.levels[count]:
+            del self.levels[count]
+        self.levels[count + 1] = self.levels.get(count + 1, 0) | (1 << bit)
+        self.game_plays[bit] = count + 1
+        self.db.execute("UPDATE games SET plays = ? WHERE bit = ?", (count + 1, bit))
+
+        for worker_id in worker_ids:
+            record = self.record_for(worker_id)
+            record.add_play(bit)
+            if record.num_games >= self.max_games:
+                record.banned = True
+            self.save(record)
+        self.db.commit()
+
+    def has_seen(self, worker_id, game_id):
+        with self.lock:
+            return bool(self.record_for(worker_id).played & (1 << self.bits[game_id]))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,279 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import ProtocolError
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import CHAT, SELECTION
+from parlai.mturk.tasks.dmg_pilot_mturk.ingest import MESSAGE_TYPES, INVALID_MESSAGE, message_parser, normalize_log
+
+from collections import Counter
+from glob import glob
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+
+DATASET_VERSION = 1
+NULL_TOKEN = '__null__'
+UNK_TOKEN = '__unk__'
+
+NO_IMAGE = -1
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Fixed-size records of the dataset. Every array is stored as its own .npy file and memory-mapped by the loader
+GAME_DTYPE = np.dtype([('game_id', np.int32), ('round_start', np.int32), ('round_end', np.int32)])
+ROUND_DTYPE = np.dtype([('game', np.int32), ('round_nr', np.int16), ('score_a', np.int16), ('score_b', np.int16),
+                        ('message_start', np.int64), ('message_end', np.int64),
+                        ('image_start', np.int32), ('image_end', np.int32)])
+MESSAGE_DTYPE = np.dtype([('speaker', np.int8), ('type', np.int8), ('timestamp', np.float64),
+                          ('token_start', np.int64), ('token_end', np.int64),
+                          ('image', np.int32), ('marked_common', np.bool_)])
+IMAGE_DTYPE = np.dtype([('player', np.int8), ('image', np.int32), ('common', np.bool_)])
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def read_game(path):
+    """
+    Reads a game log into the records the exporter needs
+    :param path: the path of the game log, in the layout written by run.py or the dev task's layout
+    :return: the game as returned by ingest.normalize_log
+    """
+    with open(path, 'r') as f:
+        return normalize_log(json.load(f))
+
+
+def build_vocabulary(games, min_count=1):
+    """
+    Builds the vocabulary of the utterances of the given games
+    :param games: games as returned by read_game
+    :param min_count: the number of times a token has to occur to get its own id
+    :return: the list of tokens, the id of a token being its index
+    """
+    counts = Counter()
+    for game in games:
+        parser, _ = message_parser(game['layout'])
+        for round_data in game['rounds']:
+            for _, _, _, text in round_data['messages']:
+                try:
+                    if parser.parse(text).type != CHAT:
+                        continue
+                except ProtocolError:
+                    continue
+                counts.update(tokenize(text))
+    tokens = sorted((token for token, count in counts.items() if count >= min_count),
+                    key=lambda token: (-counts[token], token))
+    return [NULL_TOKEN, UNK_TOKEN] + tokens
+
+
+def export(log_paths, output_dir, min_count=1, vocabulary=None):
+    """
+    Exports game logs to a pre-tokenized dataset of memory-mappable arrays.
+    Utterances are stored as one flat array of token ids, and messages, rounds and games as fixed-size records that
+    hold offsets into the array below them, so any round can be read without touching the rest of the corpus
+    :param log_paths: the paths of the game logs
+    :param output_dir: the directory to write the dataset to
+    :param min_count: the number of times a token has to occur to get its own id
+    :param vocabulary: a token list to reuse, e.g. the one of a training set. Built from the logs if None
+    :return: the number of exported games, rounds and messages
+    """
+    games = [read_game(path) for path in sorted(log_paths)]
+    if vocabulary is None:
+        vocabulary = build_vocabulary(games, min_count)
+    token_ids = {token: index for index, token in enumerate(vocabulary)}
+    unk = token_ids[UNK_TOKEN]
+
+    image_ids = {}
+    game_ids = {}
+    game_records = []
+    round_records = []
+    message_records = []
+    image_records = []
+    tokens = []
+
+    for game in games:
+        parser, common_token = message_parser(game['layout'])
+        labels = game['labels']
+        speakers = {label: index for index, label in enumerate(labels)}
+        game_id = game_ids.setdefault(game['game_id'], len(game_ids))
+        game_records.append((game_id, len(round_records), len(round_records) + len(game['rounds'])))
+
+        for round_data in game['rounds']:
+            images = round_data['images']
+            common = set.intersection(*[set(player_images) for player_images in images.values()]) if images \
+                else set()
+            image_start = len(image_records)
+            for label in labels:
+                for image in images.get(label, ()):
+                    image_records.append((speakers[label], image_ids.setdefault(image, len(image_ids)),
+                                          image in common))
+
+            message_start = len(message_records)
+            for speaker, _, timestamp, text in round_data['messages']:
+                try:
+                    parsed = parser.parse(text)
+                    message_type = MESSAGE_TYPES.index(parsed.type)
+                except ProtocolError:
+                    parsed = None
+                    message_type = INVALID_MESSAGE
+
+                token_start = len(tokens)
+                image = NO_IMAGE
+                marked_common = False
+                if parsed is not None and parsed.type == CHAT:
+                    tokens.extend(token_ids.get(token, unk) for token in tokenize(text))
+                elif parsed is not None and parsed.type == SELECTION:
+                    image = image_ids.setdefault(parsed.image, len(image_ids))
+                    marked_common = parsed.image_type == common_token
+                message_records.append((speakers.get(speaker, -1), message_type, timestamp, token_start,
+                                        len(tokens), image, marked_common))
+
+            score = round_data['score']
+            round_records.append((len(game_records) - 1, round_data['round_nr'],
+                                  score.get(labels[0], -1) if labels else -1,
+                                  score.get(labels[1], -1) if len(labels) > 1 else -1,
+                                  message_start, len(message_records), image_start, len(image_records)))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.save(os.path.join(output_dir, 'tokens.npy'), np.array(tokens, dtype=np.int32))
+    np.save(os.path.join(output_dir, 'messages.npy'), np.array(message_records, dtype=MESSAGE_DTYPE))
+    np.save(os.path.join(output_dir, 'rounds.npy'), np.array(round_records, dtype=ROUND_DTYPE))
+    np.save(os.path.join(output_dir, 'games.npy'), np.array(game_records, dtype=GAME_DTYPE))
+    np.save(os.path.join(output_dir, 'images.npy'), np.array(image_records, dtype=IMAGE_DTYPE))
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': DATASET_VERSION,
+            'vocabulary': vocabulary,
+            'images': sorted(image_ids, key=image_ids.get),
+            'game_ids': sorted(game_ids, key=game_ids.get),
+            'message_types': list(MESSAGE_TYPES),
+        }, f)
+
+    return len(game_records), len(round_records), len(message_records)
+
+
+class DMGDataset(object):
+    """
+    Random-access loader of an exported dataset.
+    All arrays are memory-mapped, so opening the dataset reads only its metadata and every episode reads only its
+    own records. Episodes are rounds, and the examples of an episode are its messages, following the
+    num_episodes/num_examples/get interface of ParlAI's FixedDialogTeacher.
+    """
+
+    def __init__(self, data_dir):
+        """
+        :param data_dir: the directory the dataset was exported to
+        """
+        with open(os.path.join(data_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != DATASET_VERSION:
+            raise ValueError("Dataset version {} is not supported, expected {}".format(meta['version'],
+                                                                                       DATASET_VERSION))
+        self.vocabulary = meta['vocabulary']
+        self.image_paths = meta['images']
+        self.game_ids = meta['game_ids']
+        self.message_types = meta['message_types']
+
+        self.tokens = np.load(os.path.join(data_dir, 'tokens.npy'), mmap_mode='r')
+        self.messages = np.load(os.path.join(data_dir, 'messages.npy'), mmap_mode='r')
+        self.rounds = np.load(os.path.join(data_dir, 'rounds.npy'), mmap_mode='r')
+        self.games = np.load(os.path.join(data_dir, 'games.npy'), mmap_mode='r')
+        self.images = np.load(os.path.join(data_dir, 'images.npy'), mmap_mode='r')
+
+    def num_episodes(self):
+        return len(self.rounds)
+
+    def num_examples(self):
+        return len(self.messages)
+
+    def episode_length(self, episode_idx):
+        round_record = self.rounds[episode_idx]
+        return int(round_record['message_end'] - round_record['message_start'])
+
+    def decode(self, token_ids):
+        return " ".join(self.vocabulary[token_id] for token_id in token_ids)
+
+    def round_images(self, episode_idx):
+        """
+        Returns the images of every player in a round with their gold labels
+        :param episode_idx: the index of the round
+        :return: a list with one list of (image path, is common) tuples per player
+        """
+        round_record = self.rounds[episode_idx]
+        images = self.images[round_record['image_start']:round_record['image_end']]
+        players = [[] for _ in range(int(images['player'].max()) + 1)] if len(images) else []
+        for record in images:
+            players[record['player']].append((self.image_paths[record['image']], bool(record['common'])))
+        return players
+
+    def get(self, episode_idx, entry_idx=0):
+        """
+        Returns a message of a round as an observation dict
+        :param episode_idx: the index of the round
+        :param entry_idx: the index of the message within the round
+        :return: a dict with the 'token_ids' of the message and its decoded 'text', its 'speaker' index and
+            'message_type', the selected 'image' and whether it was 'marked_common' for selections, and
+            'episode_done' for the last message of the round. The first message also carries the 'images' of the
+            round, the 'scores' of the players and the 'game_id'
+        """
+        round_record = self.rounds[episode_idx]
+        message = self.messages[round_record['message_start'] + entry_idx]
+        token_ids = self.tokens[message['token_start']:message['token_end']]
+
+        action = {
+            'token_ids': token_ids,
+            'text': self.decode(token_ids),
+            'speaker': int(message['speaker']),
+            'message_type': self.message_types[message['type']] if message['type'] >= 0 else None,
+            'episode_done': entry_idx == self.episode_length(episode_idx) - 1,
+        }
+        if message['image'] != NO_IMAGE:
+            action['image'] = self.image_paths[message['image']]
+            action['marked_common'] = bool(message['marked_common'])
+        if entry_idx == 0:
+            action['game_id'] = self.game_ids[self.games[round_record['game']]['game_id']]
+            action['round_nr'] = int(round_record['round_nr'])
+            action['images'] = self.round_images(episode_idx)
+            action['scores'] = (int(round_record['score_a']), int(round_record['score_b']))
+        return action
+
+
+def main():
+    """
+    Exports the collected game logs to a pre-tokenized, memory-mappable dataset.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Export DMG game logs to a pre-tokenized dataset')
+    argparser.add_argument('--logs', default=os.path.join(module_dir, 'logs'), help='directory of the game logs')
+    argparser.add_argument('--pattern', default='dmg_pilot_data_*.json')
+    argparser.add_argument('--output', default=os.path.join(module_dir, 'logs', 'dataset'))
+    argparser.add_argument('--min_count', type=int, default=1, help='minimum count of a token in the vocabulary')
+    argparser.add_argument('--vocabulary', default=None, help='meta.json of a dataset whose vocabulary to reuse')
+    args = argparser.parse_args()
+
+    vocabulary = None
+    if args.vocabulary:
+        with open(args.vocabulary, 'r') as f:
+            vocabulary = json.load(f)['vocabulary']
+
+    num_games, num_rounds, num_messages = export(glob(os.path.join(args.logs, args.pattern)), args.output,
+                                                 args.min_count, vocabulary)
+    print("Exported {} games with {} rounds and {} messages to {}".format(num_games, num_rounds, num_messages,
+                                                                        args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.images import DirectoryImageProvider, ZipImageProvider
+
+from collections import defaultdict
+from itertools import combinations
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+PLAYER_LABELS = ('A', 'B')
+
+# Number of images both players see in each round of the hand-built pilot games
+COMMON_PER_ROUND = (4, 4, 2, 4, 3)
+
+
+def popcount(masks):
+    """
+    Counts the set bits of an array of uint64 bitsets
+    :param masks: a numpy array of uint64
+    :return: a numpy array with the number of set bits of every mask
+    """
+    masks = np.ascontiguousarray(masks, dtype=np.uint64)
+    return np.unpackbits(masks.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class GameGenerator(object):
+    """
+    Generates DMG games from a pool of images per category.
+    Like the pilot games, a game draws a fixed set of images from one category and shows each player a subset
+    of them per round, so that every image is reused across rounds the same number of times and the players share
+    a given number of images in each round. Rounds are bitsets over the game's images, and every choice scores
+    all candidate rounds at once with NumPy. The generator is deterministic under its seed and never emits the
+    same game twice.
+    """
+
+    def __init__(self, pools, images_per_game=12, images_per_round=6, common_per_round=COMMON_PER_ROUND,
+                 seed=0, max_attempts=100):
+        """
+        :param pools: a dict that maps each category to the relative paths of its images
+        :param images_per_game: the number of images used by a game, at most 64
+        :param images_per_round: the number of images each player sees in a round
+        :param common_per_round: the number of images both players see, for each round
+        :param seed: the seed of the random number generator
+        :param max_attempts: the number of draws after which a game that violates the constraints is given up
+        """
+        self.images_per_game = images_per_game
+        self.images_per_round = images_per_round
+        self.common_per_round = tuple(common_per_round)
+        self.num_rounds = len(self.common_per_round)
+        self.max_attempts = max_attempts
+        self.random = np.random.RandomState(seed)
+
+        assert images_per_game <= 64, "A game can use at most 64 images"
+        slots = len(PLAYER_LABELS) * self.num_rounds * images_per_round
+        assert slots % images_per_game == 0, \
+            "{} image slots cannot be spread evenly over {} images".format(slots, images_per_game)
+        self.uses_per_image = slots // images_per_game
+
+        self.pools = {category: sorted(paths) for category, paths in pools.items()
+                      if len(paths) >= images_per_game}
+        self.categories = sorted(self.pools)
+        if not self.categories:
+            raise ValueError("No category holds {} images".format(images_per_game))
+
+        # All possible rounds of a player as bitsets over the game's images, and the same as a 0/1 matrix
+        self.candidates = np.array([sum(1 << i for i in indices)
+                                    for indices in combinations(range(images_per_game), images_per_round)],
+                                   dtype=np.uint64)
+        bits = np.arange(images_per_game, dtype=np.uint64)
+        self.membership = ((self.candidates[:, None] >> bits) & np.uint64(1)).astype(np.int64)
+
+        self.signatures = set()
+
+    def generate(self, num_games):
+        """
+        Generates a number of distinct games, cycling through the categories
+        :param num_games: the number of games to generate
+        :return: a list of games in the layout of dmg_pilot_mturk_games.json
+        """
+        games = []
+        failures = 0
+        while len(games) < num_games:
+            category = self.categories[len(games) % len(self.categories)]
+            game = self.generate_game(category)
+            if game is None:
+                failures += 1
+                if failures > self.max_attempts * num_games:
+                    raise RuntimeError("Could only generate {} distinct games".format(len(games)))
+                continue
+            games.append(game)
+        return games
+
+    def generate_game(self, category):
+        """
+        Draws a game from the given category
+        :param category: the category to draw the images from
+        :return: a game dict or None if the draw violated a constraint or duplicated an earlier game
+        """
+        pool = self.pools[category]
+        images = [pool[i] for i in sorted(self.random.choice(len(pool), self.images_per_game, replace=False))]
+
+        for _ in range(self.max_attempts):
+            rounds = self.draw_rounds()
+            if rounds is not None:
+                break
+        else:
+            return None
+
+        signature = tuple(tuple(int(mask) for mask in player_rounds) for player_rounds in rounds) + (tuple(images),)
+        if signature in self.signatures:
+            return None
+        self.signatures.add(signature)
+
+        game = {}
+        for player_label, player_rounds in zip(PLAYER_LABELS, rounds):
+            game[player_label] = []
+            for mask in player_rounds:
+                shown = [images[i] for i in range(self.images_per_game) if (int(mask) >> i) & 1]
+                game[player_label].append([shown[i] for i in self.random.permutation(len(shown))])
+        return game
+
+    def draw_rounds(self):
+        """
+        Draws the rounds of both players as bitsets over the game's images
+        :return: a (rounds of A, rounds of B) tuple of mask lists or None if the draw got stuck
+        """
+        remaining = np.full(self.images_per_game, self.uses_per_image, dtype=np.int64)
+        used = {player_label: set() for player_label in PLAYER_LABELS}
+        rounds = ([], [])
+
+        for round_nr, common in enumerate(self.common_per_round):
+            # Every image must still be placeable in the player rounds that are left after each choice
+            rounds_left = len(PLAYER_LABELS) * (self.num_rounds - round_nr)
+
+            # The images left for the last round are shown to both players exactly if they have two uses left
+            final_common = self.common_per_round[-1] if round_nr == self.num_rounds - 2 else None
+
+            # Try the best rounds for the first player until the second player can still complete the round
+            allowed = np.ones(len(self.candidates), dtype=bool)
+            while True:
+                first = self.choose(remaining, rounds_left - 1, allowed, used[PLAYER_LABELS[0]])
+                if first is None:
+                    return None
+
+                overlap = popcount(self.candidates & self.candidates[first]) == common
+                second = self.choose(remaining - self.membership[first], rounds_left - 2, overlap,
+                                     used[PLAYER_LABELS[1]], final_common)
+                if second is not None:
+                    break
+                allowed[first] = False
+
+            remaining -= self.membership[first] + self.membership[second]
+            for player_rounds, player_label, choice in zip(rounds, PLAYER_LABELS, (first, second)):
+                player_rounds.append(self.candidates[choice])
+                used[player_label].add(choice)
+
+        return rounds
+
+    def choose(self, remaining, rounds_left, allowed, used, final_common=None):
+        """
+        Picks a candidate round, preferring images with the most uses left
+        :param remaining: the number of uses left for every image
+        :param rounds_left: the number of player rounds left after this choice
+        :param allowed: boolean mask of the candidates that satisfy the round's overlap constraint
+        :param used: indices of the candidates the player was shown before
+        :param final_common: if set, the number of images that must be left for both players of the last round
+        :return: the index of the chosen candidate or None if no candidate is feasible
+        """
+        after = remaining[None, :] - self.membership
+        feasible = allowed & (after >= 0).all(axis=1) & (after <= rounds_left).all(axis=1)
+        if final_common is not None:
+            feasible &= (after == len(PLAYER_LABELS)).sum(axis=1) == final_common
+        if used:
+            feasible[list(used)] = False
+        if not feasible.any():
+            return None
+
+        scores = self.membership @ remaining + self.random.random_sample(len(self.candidates))
+        scores[~feasible] = -np.inf
+        return int(np.argmax(scores))
+
+
+def collect_pools(providers):
+    """
+    Groups the images of the given providers by category
+    :param providers: image providers as defined in images.py
+    :return: a dict that maps each category to the relative paths of its images
+    """
+    pools = defaultdict(set)
+    for provider in providers:
+        for path in provider.paths():
+            pools[path.split('/')[0]].add(path)
+    return {category: sorted(paths) for category, paths in pools.items()}
+
+
+def main():
+    """
+    Generates a games file from the image categories of one or more image sources.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Generate DMG games from image categories')
+    argparser.add_argument('--src', action='append', default=None,
+                           help='directory holding person_* image categories (can be repeated)')
+    argparser.add_argument('--zip', action='append', default=[],
+                           help='zip archive holding person_* image categories (can be repeated)')
+    argparser.add_argument('--games', type=int, default=1000, help='number of games to generate')
+    argparser.add_argument('--images_per_game', type=int, default=12)
+    argparser.add_argument('--images_per_round', type=int, default=6)
+    argparser.add_argument('--common', type=int, nargs='+', default=list(COMMON_PER_ROUND),
+                           help='number of common images for each round')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--out', default=os.path.join(module_dir, 'dmg_full_games.json'))
+    args = argparser.parse_args()
+
+    if args.src is None and not args.zip:
+        args.src = [os.path.join(module_dir, '..', 'dmg_full')]
+    providers = [DirectoryImageProvider(source) for source in args.src or []]
+    providers += [ZipImageProvider(zip_path) for zip_path in args.zip]
+
+    generator = GameGenerator(collect_pools(providers), args.images_per_game, args.images_per_round,
+                              args.common, args.seed)
+    games = generator.generate(args.games)
+
+    with open(args.out, 'w') as f:
+        json.dump(games, f, indent=2)
+    print("Generated {} games from {} categories into {}".format(len(games), len(generator.categories), args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from collections import OrderedDict
+from fnmatch import fnmatch
+from glob import glob
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+# Size of a gallery tile in the game window and its variant for high density displays
+DISPLAY_SIZE = (250, 167)
+RETINA_SIZE = (500, 334)
+
+MANIFEST_FILE = 'manifest.json'
+RETINA_PREFIX = '2x/'
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class DirectoryImageProvider(object):
+    """
+    Provides the game images stored in category directories below a root directory,
+    addressed by their path relative to that root, e.g. person_refrigerator/COCO_train2014_000000310289.jpg
+    """
+
+    def __init__(self, root, pattern='person_*/*.jpg'):
+        self.root = root
+        self.pattern = pattern
+
+    def paths(self):
+        """
+        Returns the relative paths of all images of the provider
+        :return: a sorted list of relative image paths
+        """
+        paths = glob(os.path.join(self.root, self.pattern))
+        return sorted(os.path.relpath(path, self.root).replace(os.sep, '/') for path in paths)
+
+    def read(self, path):
+        """
+        Returns the content of an image
+        :param path: the relative path of the image
+        :return: the bytes of the image file
+        """
+        with open(os.path.join(self.root, path), 'rb') as f:
+            return f.read()
+
+    def etag(self, path):
+        """
+        Returns a validator that changes whenever the image file changes
+        :param path: the relative path of the image
+        :return: the ETag value of the image
+        """
+        stat = os.stat(os.path.join(self.root, path))
+        return '{:x}-{:x}'.format(int(stat.st_mtime), stat.st_size)
+
+    def __contains__(self, path):
+        return fnmatch(path, self.pattern) and os.path.isfile(os.path.join(self.root, path))
+
+
+class ZipImageProvider(object):
+    """
+    Provides the game images stored in a zip archive without extracting it, e.g. coco_selection.zip.
+    Images are addressed by their path below the archive's top-level directory. The archive is memory-mapped:
+    stored members are returned as zero-copy views of the mapping and deflated members are decompressed into
+    a bounded LRU cache.
+    """
+
+    LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+    def __init__(self, zip_path, pattern='person_*/*.jpg', cache_size=64):
+        self.zip_path = zip_path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+        with zipfile.ZipFile(zip_path) as archive:
+            infos = [info for info in archive.infolist() if not info.is_dir()]
+
+        # Strip a top-level directory that holds all image categories, such as coco_selection/
+        prefix = ''
+        top_levels = set(info.filename.split('/')[0] for info in infos)
+        if len(top_levels) == 1 and all(info.filename.count('/') > 1 for info in infos):
+            prefix = top_levels.pop() + '/'
+
+        with open(zip_path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.members = {}
+        for info in infos:
+            path = info.filename[len(prefix):]
+            if not fnmatch(path, pattern):
+                continue
+            if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                print("WARNING: Skipping {} with unsupported compression".format(info.filename))
+                continue
+
+            signature, name_length, extra_length = self.LOCAL_HEADER.unpack_from(self.map, info.header_offset)
+            assert signature == b'PK\x03\x04', "Corrupt local header for {}".format(info.filename)
+            offset = info.header_offset + self.LOCAL_HEADER.size + name_length + extra_length
+            self.members[path] = (offset, info.compress_size, info.compress_type, info.CRC, info.file_size)
+
+    def paths(self):
+        """
+        Returns the relative paths of all images of the provider
+        :return: a sorted list of relative image paths
+        """
+        return sorted(self.members)
+
+    def read(self, path):
+        """
+        Returns the content of an image
+        :param path: the relative path of the image
+        :return: a memoryview of the mapped archive for stored members, the decompressed bytes otherwise
+        """
+        offset, compress_size, compress_type, _, _ = self.members[path]
+        data = memoryview(self.map)[offset:offset + compress_size]
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+
+        with self.lock:
+            if path in self.cache:
+                self.cache.move_to_end(path)
+                return self.cache[path]
+
+        content = zlib.decompress(data, -zlib.MAX_WBITS)
+
+        with self.lock:
+            self.cache[path] = content
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return content
+
+    def etag(self, path):
+        """
+        Returns a validator taken from the archive's CRC of the image
+        :param path: the relative path of the image
+        :return: the ETag value of the image
+        """
+        _, _, _, crc, file_size = self.members[path]
+        return '{:08x}-{:x}'.format(crc, file_size)
+
+    def __contains__(self, path):
+        return path in self.members
+
+
+def render(data, size):
+    """
+    Scales and crops an image to exactly fill a gallery tile of the given size
+    :param data: the bytes of the original image
+    :param size: the (width, height) of the tile
+    :return: the bytes of the rendered JPEG
+    """
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    image = ImageOps.fit(image, size, Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def build_thumbnails(providers, out_dir):
+    """
+    Renders display-sized and 2x variants of all images into content-hashed files and writes a manifest
+    that maps each image's relative path to its variants. Variants that exist already are not rendered again.
+    :param providers: the image providers to read the original images from
+    :param out_dir: the directory to write the variants and the manifest to
+    :return: the manifest
+    """
+    if Image is None:
+        raise ImportError("Building thumbnails requires Pillow (pip install Pillow)")
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    manifest = {}
+    for provider in providers:
+        for path in provider.paths():
+            data = provider.read(path)
+            source_hash = hashlib.sha1(data).hexdigest()
+
+            manifest[path] = {}
+            for variant, size in (('1x', DISPLAY_SIZE), ('2x', RETINA_SIZE)):
+                name = '{}.{}x{}.jpg'.format(source_hash[:16], *size)
+                target = os.path.join(out_dir, name)
+                if not os.path.exists(target):
+                    with open(target, 'wb') as f:
+                        f.write(render(data, size))
+                manifest[path][variant] = name
+
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    print("Rendered {} images into {}".format(len(manifest), out_dir))
+    return manifest
+
+
+class ImageStore(object):
+    """
+    Read-only view of a thumbnail directory that resolves request paths to variants and keeps them in memory.
+    Images without thumbnails can be served in their original size from a list of image providers.
+    """
+
+    def __init__(self, thumbnail_dir=None, originals=()):
+        self.thumbnail_dir = thumbnail_dir
+        self.originals = list(originals)
+        self.manifest = {}
+        if thumbnail_dir is not None and os.path.exists(os.path.join(thumbnail_dir, MANIFEST_FILE)):
+            with open(os.path.join(thumbnail_dir, MANIFEST_FILE), 'r') as f:
+                self.manifest = json.load(f)
+        self.names = set(name for variants in self.manifest.values() for name in variants.values())
+
+        # The game page loads the manifest to request the content-hashed names instead of the relative paths
+        self.manifest_data = json.dumps(self.manifest, sort_keys=True).encode('utf-8')
+        self.manifest_etag = hashlib.sha1(self.manifest_data).hexdigest()[:16]
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, path):
+        """
+        Maps a request path to the name of a variant file
+        :param path: a content-hashed file name, an image's relative path or an image's relative path prefixed with 2x/
+        :return: the name of the variant file or None if the path is unknown
+        """
+        if path in self.names:
+            return path
+        variant = '1x'
+        if path.startswith(RETINA_PREFIX):
+            path = path[len(RETINA_PREFIX):]
+            variant = '2x'
+        if path in self.manifest:
+            return self.manifest[path][variant]
+        return None
+
+    def get(self, name):
+        """
+        Returns the content of a variant file
+        :param name: the name of the variant file
+        :return: the bytes of the variant file
+        """
+        with self.lock:
+            if name not in self.cache:
+                with open(os.path.join(self.thumbnail_dir, name), 'rb') as f:
+                    self.cache[name] = f.read()
+            return self.cache[name]
+
+    def find_original(self, path):
+        """
+        Returns the provider that holds the original of an image
+        :param path: the relative path of the image
+        :return: the image provider or None if no provider holds the image
+        """
+        for provider in self.originals:
+            if path in provider:
+                return provider
+        return None
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the thumbnails of an ImageStore with content-hash ETags. Content-hashed file names are cached for a year,
+    the manifest that maps relative image paths to them and the relative paths themselves, which only pages without
+    the manifest request, are revalidated by their ETag on every use
+    """
+    store = None
+
+    def do_GET(self):
+        self.send_image(head_only=False)
+
+    def do_HEAD(self):
+        self.send_image(head_only=True)
+
+    def send_image(self, head_only):
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+
+        # Content-hashed file names never change their content, the manifest and relative image paths are
+        # revalidated by ETag
+        content_type = 'image/jpeg'
+        name = self.store.resolve(path)
+        if path == MANIFEST_FILE:
+            etag = '"{}"'.format(self.store.manifest_etag)
+            immutable = False
+            content_type = 'application/json'
+            read = lambda: self.store.manifest_data
+        elif name is not None:
+            etag = '"{}"'.format(os.path.splitext(name)[0])
+            immutable = (name == path)
+            read = lambda: self.store.get(name)
+        else:
+            provider = self.store.find_original(path)
+            if provider is None:
+                self.send_error(404)
+                return
+            etag = '"{}"'.format(provider.etag(path))
+            immutable = False
+            read = lambda: provider.read(path)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_cache_headers(etag, immutable)
+            self.end_headers()
+            return
+
+        data = read()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_cache_headers(etag, immutable)
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(data)
+
+    def send_cache_headers(self, etag, immutable):
+        # The manifest and relative paths may be served from a new thumbnail build, so browsers have to check their
+        # ETag on every use
+        if immutable:
+            cache_control = 'public, max-age={}, immutable'.format(CACHE_MAX_AGE)
+        else:
+            cache_control = 'public, no-cache'
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(thumbnail_dir, originals=(), host='0.0.0.0', port=8100):
+    """
+    Serves a thumbnail directory until interrupted
+    :param thumbnail_dir: the directory written by build_thumbnails
+    :param originals: image providers to serve images without thumbnails from
+    :param host: the interface to listen on
+    :param port: the port to listen on
+    :return: Nothing
+    """
+    store = ImageStore(thumbnail_dir, originals)
+    handler = type('BoundImageRequestHandler', (ImageRequestHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    print("Serving images from {} on http://{}:{}/".format(thumbnail_dir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    """
+    Builds or serves the pre-resized game images.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Pre-resized image build stage and server for the DMG task')
+    subparsers = argparser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='render display-sized variants of the game images')
+    build_parser.add_argument('--src', action='append', default=None,
+                              help='directory holding person_* image categories (can be repeated)')
+    build_parser.add_argument('--zip', action='append', default=[],
+                              help='zip archive holding person_* image categories (can be repeated)')
+    build_parser.add_argument('--out', default=os.path.join(module_dir, 'thumbnails'))
+
+    serve_parser = subparsers.add_parser('serve', help='serve the rendered images')
+    serve_parser.add_argument('--dir', default=os.path.join(module_dir, 'thumbnails'))
+    serve_parser.add_argument('--zip', action='append', default=[],
+                              help='zip archive to serve original images from (can be repeated)')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8100)
+
+    args = argparser.parse_args()
+    if args.command == 'build':
+        if args.src is None and not args.zip:
+            args.src = [module_dir, os.path.join(module_dir, '..', 'dmg_full')]
+        providers = [DirectoryImageProvider(source) for source in args.src or []]
+        providers += [ZipImageProvider(zip_path) for zip_path in args.zip]
+        build_thumbnails(providers, args.out)
+    elif args.command == 'serve':
+        serve(args.dir, [ZipImageProvider(zip_path) for zip_path in args.zip], args.host, args.port)
+    else:
+        argparser.print_help()
+
+
+if __name__ == '__main__':
+    main()
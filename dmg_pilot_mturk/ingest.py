@@ -0,0 +1,411 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import MessageParser, ProtocolError
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import CHAT, SELECTION, FEEDBACK, NEXT_ROUND
+from parlai.tasks.dmg_pilot_mturk.agents import COM_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import SELECTION_TOKEN as DEV_SELECTION_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import COM_TOKEN as DEV_COM_TOKEN
+from parlai.tasks.dmg_pilot_dev.agents import DIF_TOKEN as DEV_DIF_TOKEN
+
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+STORE_VERSION = 2
+TABLES_FILE = 'tables.npz'
+MANIFEST_FILE = 'manifest.json'
+CHUNK_DIR = 'chunks'
+
+# Message types by their code in the messages table. Malformed control messages get code -1
+MESSAGE_TYPES = (CHAT, SELECTION, FEEDBACK, NEXT_ROUND)
+INVALID_MESSAGE = -1
+
+# Layouts of the game logs of the MTurk task and of the dev task, which uses its own control tokens
+MTURK_LAYOUT = 'mturk'
+DEV_LAYOUT = 'dev'
+
+# Column types of every table. Columns marked 'str' are dictionary-encoded into a shared string table on consolidation
+SCHEMA = {
+    'games': [('file', np.int32), ('game_id', 'str'), ('num_rounds', np.int16), ('start', np.float64),
+              ('end', np.float64)],
+    'rounds': [('file', np.int32), ('round_nr', np.int16), ('score_a', np.int16), ('score_b', np.int16),
+               ('images_a', np.int16), ('images_b', np.int16), ('start', np.float64), ('end', np.float64),
+               ('duration', np.float64), ('num_messages', np.int32), ('num_utterances', np.int32),
+               ('num_words', np.int32), ('num_common', np.int16), ('timed_out', np.bool_)],
+    'messages': [('file', np.int32), ('round_nr', np.int16), ('turn', np.int32), ('speaker', np.int8),
+                 ('timestamp', np.float64), ('offset', np.float64), ('type', np.int8), ('num_words', np.int32)],
+    'selections': [('file', np.int32), ('round_nr', np.int16), ('speaker', np.int8), ('timestamp', np.float64),
+                   ('image', 'str'), ('common', np.bool_), ('correct', np.bool_), ('final', np.bool_)],
+}
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def message_parser(layout):
+    """
+    Returns a parser for the messages of a game log layout, as the worlds that write the layout use it
+    :param layout: DEV_LAYOUT for logs of the dev task, MTURK_LAYOUT for logs written by run.py
+    :return: a (MessageParser, token a selection marks a common image with) tuple
+    """
+    if layout == DEV_LAYOUT:
+        return MessageParser({SELECTION: DEV_SELECTION_TOKEN}, (DEV_COM_TOKEN, DEV_DIF_TOKEN)), DEV_COM_TOKEN
+    return MessageParser(), COM_TOKEN
+
+
+def normalize_log(game_log):
+    """
+    Brings a game log into a single layout, whichever task wrote it
+    :param game_log: a game log in the layout written by run.py, or the dev task's layout
+    :return: a dict with the game id, the layout, the player labels and a list of rounds, each a dict with the round
+        number, the scores by label, the images by label, whether it timed out and a list of
+        (speaker label, turn, timestamp, text) messages
+    """
+    # The dev task keeps its rounds and their messages under 'data'
+    layout = DEV_LAYOUT if 'rounds' not in game_log and 'data' in game_log else MTURK_LAYOUT
+    players = game_log.get('players', [])
+    labels = game_log.get('agent_labels', players)
+    label_of = dict(zip(players, labels))
+
+    rounds = []
+    for position, round_log in enumerate(game_log.get('rounds', game_log.get('data', []))):
+        round_nr = round_log.get('round_nr')
+        messages = round_log.get('messages', round_log.get('data', []))
+        rounds.append({
+            'round_nr': position if round_nr is None else round_nr,
+            'score': {label_of.get(player, player): value for player, value in (round_log.get('score') or {}).items()},
+            'images': round_log.get('images') or {},
+            'timed_out': bool(round_log.get('timed_out', False)),
+            'messages': [(message.get('speaker', message.get('speaker:')), message.get('turn', -1),
+                          message['timestamp'], message['message'])
+                         for message in messages],
+        })
+    return {'game_id': str(game_log.get('game_id')), 'layout': layout, 'labels': list(labels), 'rounds': rounds}
+
+
+def flatten_log(game_log):
+    """
+    Flattens a game log into rows of the games, rounds, messages and selections tables
+    :param game_log: a game log in the layout written by run.py, or the dev task's layout
+    :return: a dict that maps each table name to a dict of column lists, and the list of message texts
+    """
+    game = normalize_log(game_log)
+    parser, common_token = message_parser(game['layout'])
+    columns = {table: {column: [] for column, _ in schema} for table, schema in SCHEMA.items()}
+    texts = []
+
+    labels = game['labels']
+    speakers = {label: index for index, label in enumerate(labels)}
+    rounds = game['rounds']
+
+    game_start = None
+    game_end = None
+    for round_data in rounds:
+        round_nr = round_data['round_nr']
+        messages = round_data['messages']
+        images = round_data['images']
+        common = set.intersection(*[set(player_images) for player_images in images.values()]) if images else set()
+
+        round_start = messages[0][2] if messages else None
+        round_end = messages[-1][2] if messages else None
+        num_utterances = 0
+        num_words = 0
+        last_selection = {}
+
+        for speaker_label, turn, timestamp, text in messages:
+            speaker = speakers.get(speaker_label, -1)
+            try:
+                parsed = parser.parse(text)
+                message_type = MESSAGE_TYPES.index(parsed.type)
+            except ProtocolError:
+                parsed = None
+                message_type = INVALID_MESSAGE
+
+            words = len(text.split()) if message_type == 0 else 0
+            if message_type == 0:
+                num_utterances += 1
+                num_words += words
+
+            row = columns['messages']
+            row['file'].append(0)
+            row['round_nr'].append(round_nr)
+            row['turn'].append(turn)
+            row['speaker'].append(speaker)
+            row['timestamp'].append(timestamp)
+            row['offset'].append(timestamp - round_start)
+            row['type'].append(message_type)
+            row['num_words'].append(words)
+            texts.append(text)
+
+            if parsed is not None and parsed.type == SELECTION:
+                marked_common = parsed.image_type == common_token
+                row = columns['selections']
+                last_selection[(speaker, parsed.image)] = len(row['file'])
+                row['file'].append(0)
+                row['round_nr'].append(round_nr)
+                row['speaker'].append(speaker)
+                row['timestamp'].append(timestamp)
+                row['image'].append(parsed.image)
+                row['common'].append(marked_common)
+                row['correct'].append(marked_common == (parsed.image in common))
+                row['final'].append(False)
+
+        # Only the last selection of an image by a player counts for the score
+        for index in last_selection.values():
+            columns['selections']['final'][index] = True
+
+        scores = round_data['score']
+        row = columns['rounds']
+        row['file'].append(0)
+        row['round_nr'].append(round_nr)
+        row['score_a'].append(scores.get(labels[0], -1) if labels else -1)
+        row['score_b'].append(scores.get(labels[1], -1) if len(labels) > 1 else -1)
+        row['images_a'].append(len(images.get(labels[0], ())) if labels else 0)
+        row['images_b'].append(len(images.get(labels[1], ())) if len(labels) > 1 else 0)
+        row['start'].append(round_start if round_start is not None else np.nan)
+        row['end'].append(round_end if round_end is not None else np.nan)
+        row['duration'].append(round_end - round_start if messages else np.nan)
+        row['num_messages'].append(len(messages))
+        row['num_utterances'].append(num_utterances)
+        row['num_words'].append(num_words)
+        row['num_common'].append(len(common))
+        row['timed_out'].append(round_data['timed_out'])
+
+        if round_start is not None:
+            game_start = round_start if game_start is None else min(game_start, round_start)
+            game_end = round_end if game_end is None else max(game_end, round_end)
+
+    row = columns['games']
+    row['file'].append(0)
+    row['game_id'].append(game['game_id'])
+    row['num_rounds'].append(len(rounds))
+    row['start'].append(game_start if game_start is not None else np.nan)
+    row['end'].append(game_end if game_end is not None else np.nan)
+
+    return columns, texts
+
+
+def encode_texts(texts):
+    """
+    Packs strings into a single UTF-8 buffer with an offset array
+    :param texts: a list of strings
+    :return: a (uint8 buffer, int64 offsets) tuple, the i-th string spanning offsets[i]:offsets[i + 1]
+    """
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_text(buffer, offsets, index):
+    return bytes(buffer[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+
+def ingest_file(path, chunk_dir):
+    """
+    Flattens a single game log into a chunk file. Runs in a worker process
+    :param path: the path of the game log
+    :param chunk_dir: the directory to write the chunk to
+    :return: a (path, sha1, chunk path) tuple
+    """
+    sha1 = file_hash(path)
+    with open(path, 'r') as f:
+        columns, texts = flatten_log(json.load(f))
+
+    arrays = {}
+    for table, schema in SCHEMA.items():
+        for column, dtype in schema:
+            values = columns[table][column]
+            arrays['{}.{}'.format(table, column)] = np.array(values, dtype=str if dtype == 'str' else dtype)
+    arrays['texts.buffer'], arrays['texts.offsets'] = encode_texts(texts)
+
+    chunk_path = os.path.join(chunk_dir, sha1 + '.npz')
+    np.savez(chunk_path, **arrays)
+    return path, sha1, chunk_path
+
+
+def consolidate(manifest, store_dir):
+    """
+    Concatenates the chunks of all ingested files into one set of typed columns
+    :param manifest: the store manifest
+    :param store_dir: the directory of the store
+    :return: Nothing
+    """
+    paths = sorted(manifest['files'])
+    parts = {}
+    text_buffers = []
+    text_lengths = []
+
+    for file_id, path in enumerate(paths):
+        with np.load(os.path.join(store_dir, CHUNK_DIR, manifest['files'][path]['sha1'] + '.npz')) as chunk:
+            for table, schema in SCHEMA.items():
+                size = len(chunk['{}.file'.format(table)])
+                for column, _ in schema:
+                    values = chunk['{}.{}'.format(table, column)]
+                    if column == 'file':
+                        values = np.full(size, file_id, dtype=np.int32)
+                    parts.setdefault((table, column), []).append(values)
+            text_buffers.append(chunk['texts.buffer'])
+            text_lengths.append(np.diff(chunk['texts.offsets']))
+
+    arrays = {'files.path': np.array(paths, dtype=str)}
+    for table, schema in SCHEMA.items():
+        for column, dtype in schema:
+            values = parts.get((table, column), [])
+            if dtype == 'str':
+                strings = np.concatenate(values) if values else np.array([], dtype=str)
+                table_values, codes = np.unique(strings, return_inverse=True)
+                arrays['{}.{}'.format(table, column)] = codes.astype(np.int32)
+                arrays['{}.{}_values'.format(table, column)] = table_values
+            else:
+                arrays['{}.{}'.format(table, column)] = np.concatenate(values).astype(dtype) if values \
+                    else np.array([], dtype=dtype)
+
+    lengths = np.concatenate(text_lengths) if text_lengths else np.array([], dtype=np.int64)
+    arrays['texts.offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    arrays['texts.buffer'] = np.concatenate(text_buffers) if text_buffers else np.array([], dtype=np.uint8)
+
+    tmp_path = os.path.join(store_dir, TABLES_FILE + '.tmp.npz')
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, os.path.join(store_dir, TABLES_FILE))
+
+
+def ingest(log_paths, store_dir, workers=None):
+    """
+    Ingests game logs into the columnar store, skipping files that did not change since they were last ingested
+    :param log_paths: the paths of the game logs
+    :param store_dir: the directory of the store
+    :param workers: the number of worker processes. Defaults to the number of CPUs
+    :return: a (number of ingested files, number of skipped files) tuple
+    """
+    chunk_dir = os.path.join(store_dir, CHUNK_DIR)
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    manifest = {'version': STORE_VERSION, 'files': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != STORE_VERSION:
+            manifest = {'version': STORE_VERSION, 'files': {}}
+
+    log_paths = sorted(set(os.path.abspath(path) for path in log_paths))
+    changed = []
+    for path in log_paths:
+        entry = manifest['files'].get(path)
+        stat = os.stat(path)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            continue
+        # A touched file whose content is unchanged keeps its chunk
+        if entry is not None and entry['size'] == stat.st_size and entry['sha1'] == file_hash(path) \
+                and os.path.exists(os.path.join(chunk_dir, entry['sha1'] + '.npz')):
+            entry['mtime'] = stat.st_mtime
+            continue
+        changed.append(path)
+
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, sha1, _ in pool.map(ingest_file, changed, [chunk_dir] * len(changed)):
+                stat = os.stat(path)
+                manifest['files'][path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1}
+
+    # Forget files that were removed from the log directory
+    removed = set(manifest['files']) - set(log_paths)
+    for path in removed:
+        del manifest['files'][path]
+
+    if changed or removed or not os.path.exists(os.path.join(store_dir, TABLES_FILE)):
+        consolidate(manifest, store_dir)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return len(changed), len(log_paths) - len(changed)
+
+
+def load_tables(store_dir):
+    """
+    Loads the columnar store
+    :param store_dir: the directory of the store
+    :return: a dict that maps each table name to a dict of NumPy columns. String columns hold integer codes into
+        the '<column>_values' column of the same table, message texts are kept in the 'texts' table
+    """
+    tables = {}
+    with np.load(os.path.join(store_dir, TABLES_FILE)) as arrays:
+        for key in arrays.files:
+            table, column = key.split('.', 1)
+            tables.setdefault(table, {})[column] = arrays[key]
+    return tables
+
+
+def to_dataframes(tables):
+    """
+    Turns the loaded tables into pandas DataFrames, decoding string columns and message texts
+    :param tables: the tables returned by load_tables
+    :return: a dict that maps each table name to a DataFrame
+    """
+    if pd is None:
+        raise ImportError("Building DataFrames requires pandas (pip install pandas)")
+
+    frames = {}
+    for table, schema in SCHEMA.items():
+        data = {}
+        for column, dtype in schema:
+            values = tables[table][column]
+            if dtype == 'str':
+                values = pd.Categorical.from_codes(values, tables[table][column + '_values'])
+            data[column] = values
+        frames[table] = pd.DataFrame(data)
+
+    texts = tables['texts']
+    frames['messages']['text'] = [decode_text(texts['buffer'], texts['offsets'], i)
+                                  for i in range(len(texts['offsets']) - 1)]
+    frames['messages']['path'] = tables['files']['path'][tables['messages']['file']]
+    return frames
+
+
+def main():
+    """
+    Ingests the game logs of a directory into the columnar analysis store.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Ingest DMG game logs into a columnar analysis store')
+    argparser.add_argument('--logs', default=os.path.join(module_dir, 'logs'), help='directory of the game logs')
+    argparser.add_argument('--pattern', default='dmg_pilot_data_*.json')
+    argparser.add_argument('--store', default=os.path.join(module_dir, 'logs', 'store'))
+    argparser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = argparser.parse_args()
+
+    ingested, skipped = ingest(glob(os.path.join(args.logs, args.pattern)), args.store, args.workers)
+    tables = load_tables(args.store)
+    print("Ingested {} files, skipped {} unchanged files. The store holds {} games, {} rounds and {} messages"
+          .format(ingested, skipped, len(tables['games']['file']), len(tables['rounds']['file']),
+                  len(tables['messages']['file'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+import atexit
+from collections import OrderedDict
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+LEVELS = OrderedDict([('debug', DEBUG), ('info', INFO), ('warning', WARNING)])
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+TIME_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+ACCURACY_BUCKETS = (0.5, 0.67, 0.84, 1.0)
+
+# Metrics the worlds report, with their Prometheus type, help text and histogram buckets
+METRICS = OrderedDict([
+    ('dmg_turn_latency_seconds', ('histogram', 'Time between two consecutive messages of a round', TIME_BUCKETS)),
+    ('dmg_time_to_first_message_seconds', ('histogram', 'Time from the round start to its first message',
+                                           TIME_BUCKETS)),
+    ('dmg_round_duration_seconds', ('histogram', 'Time from the round start to its end', TIME_BUCKETS)),
+    ('dmg_selection_accuracy', ('histogram', 'Fraction of correctly marked images per player and round',
+                                ACCURACY_BUCKETS)),
+    ('dmg_queue_wait_seconds', ('histogram', 'Time a worker waited in the pairing queue', TIME_BUCKETS)),
+    ('dmg_agent_shutdown_seconds', ('histogram', 'Time an agent took to shut down after its game ended',
+                                    TIME_BUCKETS)),
+    ('dmg_messages_total', ('counter', 'Messages received from the players', None)),
+    ('dmg_rounds_total', ('counter', 'Completed rounds', None)),
+    ('dmg_round_timeouts_total', ('counter', 'Rounds ended by a turn or round deadline', None)),
+    ('dmg_disconnects_total', ('counter', 'Players that disconnected, timed out or returned their HIT', None)),
+    ('dmg_protocol_errors_total', ('counter', 'Malformed control messages', None)),
+    ('dmg_pairs_total', ('counter', 'Pairs formed by the pairing queue', None)),
+    ('dmg_pairing_rejections_total', ('counter', 'Waiting pools in which no pair shared a playable game', None)),
+    ('dmg_agent_shutdown_timeouts_total', ('counter', 'Agents that did not shut down within the timeout', None)),
+    ('dmg_agent_shutdown_errors_total', ('counter', 'Agents whose shutdown raised an error', None)),
+    ('dmg_events_dropped_total', ('counter', 'Log events dropped because the logger queue was full', None)),
+])
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Instrumentation(object):
+    """
+    Structured event logger and metrics registry shared by all worlds of a process.
+    Events below the configured level are dropped before they are built, events below WARNING can be sampled, and
+    the remaining events are handed to a background thread that writes them as JSON lines, so the world threads never
+    wait for console I/O. Metrics are aggregated in memory and can be dumped in the Prometheus text format or as JSON
+    to a local file, periodically by the same background thread.
+    """
+
+    def __init__(self, level=INFO, sample_rate=1.0, stream=None, metrics_path=None, metrics_format='prometheus',
+                 dump_interval=10.0, max_queue=10000, seed=None):
+        """
+        :param level: the lowest level of the events to log
+        :param sample_rate: the fraction of the events below WARNING to log
+        :param stream: the file to write the events to. Defaults to stdout
+        :param metrics_path: the file to dump the metrics to, None to disable dumping
+        :param metrics_format: 'prometheus' or 'json'
+        :param dump_interval: the number of seconds between two metrics dumps
+        :param max_queue: the number of events that can wait for the writer before new events are dropped
+        :param seed: the seed of the sampling
+        """
+        self.level = level
+        self.sample_rate = sample_rate
+        self.stream = stream
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        self.dump_interval = dump_interval
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enabled(self, level):
+        """
+        Returns True if events of the given level are logged
+        :param level: the level of the event
+        :return: True if events of the given level are logged
+        """
+        return level >= self.level
+
+    def event(self, level, name, **fields):
+        """
+        Queues a structured event without waiting for it to be written
+        :param level: the level of the event
+        :param name: the name of the event
+        :param fields: the JSON serializable fields of the event
+        :return: Nothing
+        """
+        if level < self.level:
+            return
+        if level < WARNING and self.sample_rate < 1.0 and self.random.random() >= self.sample_rate:
+            return
+
+        record = OrderedDict([('time', time.time()), ('level', LEVEL_NAMES.get(level, level)), ('event', name)])
+        record.update(fields)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.increment('dmg_events_dropped_total')
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                buckets = METRICS[name][2] if name in METRICS else TIME_BUCKETS
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics of another registry, e.g. of a shard process, to this one
+        :param snapshot: the metrics as returned by snapshot
+        :return: Nothing
+        """
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot['histograms'].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(tuple(bound for bound, _ in other['buckets']))
+                histogram = self.histograms[name]
+                for i, (_, count) in enumerate(other['buckets']):
+                    histogram.counts[i] += count
+                histogram.count += other['count']
+                histogram.sum += other['sum']
+
+    def snapshot(self):
+        """
+        Returns the current values of all metrics
+        :return: a dict with the counters and the histograms
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: {'buckets': list(zip(histogram.buckets, histogram.counts)),
+                                      'count': histogram.count, 'sum': histogram.sum}
+                               for name, histogram in self.histograms.items()}
+            }
+
+    def format_prometheus(self, snapshot):
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            if name in METRICS:
+                lines.append("# HELP {} {}".format(name, METRICS[name][1]))
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, value))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            if name in METRICS:
+                lines.append("# HELP {} {}".format(name, METRICS[name][1]))
+            lines.append("# TYPE {} histogram".format(name))
+            for bound, count in histogram['buckets']:
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, count))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, histogram['count']))
+            lines.append("{}_sum {}".format(name, histogram['sum']))
+            lines.append("{}_count {}".format(name, histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None, metrics_format=None):
+        """
+        Writes the metrics to a file, replacing it atomically so a scraper never reads a partial dump
+        :param path: the file to write to. Defaults to the configured metrics path
+        :param metrics_format: 'prometheus' or 'json'. Defaults to the configured format
+        :return: Nothing
+        """
+        path = path or self.metrics_path
+        metrics_format = metrics_format or self.metrics_format
+        if path is None:
+            return
+
+        snapshot = self.snapshot()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if metrics_format == 'json':
+                json.dump(snapshot, f, indent=2)
+            else:
+                f.write(self.format_prometheus(snapshot))
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """
+        Writes all queued events, dumps the metrics a last time and stops the writer thread
+        :return: Nothing
+        """
+        self.closed.set()
+        self.thread.join()
+        self.dump()
+
+    def run(self):
+        """
+        Writer thread loop that writes queued events and dumps the metrics periodically
+        :return: Nothing
+        """
+        next_dump = time.time() + self.dump_interval
+        while True:
+            try:
+                record = self.queue.get(timeout=max(0, min(next_dump - time.time(), 0.5)))
+            except queue.Empty:
+                record = None
+
+            if record is not None:
+                stream = self.stream or sys.stdout
+                stream.write(json.dumps(record, default=str) + '\n')
+                if self.queue.empty():
+                    stream.flush()
+
+            if time.time() >= next_dump:
+                self.dump()
+                next_dump = time.time() + self.dump_interval
+
+            if record is None and self.closed.is_set() and self.queue.empty():
+                break
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_instrumentation():
+    """
+    Returns the process-wide instrumentation used by worlds that were not handed one through shared
+    :return: the default Instrumentation
+    """
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            _default = Instrumentation()
+            atexit.register(_default.close)
+        return _default
+
+
+def add_instrumentation_args(argparser):
+    """
+    Adds the instrumentation options to a ParlaiParser or argparse parser
+    :param argparser: the parser to extend
+    :return: Nothing
+    """
+    argparser.add_argument('--log_level', default='info', choices=list(LEVELS),
+                           help='lowest level of the structured events to log')
+    argparser.add_argument('--log_sample_rate', type=float, default=1.0,
+                           help='fraction of the debug and info events to log')
+    argparser.add_argument('--metrics_file', default=None,
+                           help='file to dump the metrics to periodically')
+    argparser.add_argument('--metrics_format', default='prometheus', choices=['prometheus', 'json'])
+
+
+def create_instrumentation(opt):
+    """
+    Creates an Instrumentation from the options added by add_instrumentation_args
+    :param opt: the task options
+    :return: a new Instrumentation
+    """
+    return Instrumentation(level=LEVELS[opt.get('log_level') or 'info'],
+                           sample_rate=opt.get('log_sample_rate', 1.0),
+                           metrics_path=opt.get('metrics_file'),
+                           metrics_format=opt.get('metrics_format') or 'prometheus')
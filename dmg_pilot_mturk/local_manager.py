@@ -0,0 +1,195 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.benchmark import ScriptedAgent, load_scripts, percentile
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import os
+import random
+import threading
+import time
+
+
+class LocalMTurkManager(object):
+    """
+    In-process stand-in for MTurkManager that needs no server or network.
+    Simulated workers replaying recorded games arrive at a configurable rate, are onboarded, matched by the
+    eligibility function, labelled by the role function and handed to the task function on a worker pool,
+    so that the whole pairing and teardown path of run.py can be load-tested on a single machine.
+    """
+
+    def __init__(self, opt, mturk_agent_ids):
+        self.opt = opt
+        self.mturk_agent_ids = mturk_agent_ids
+        self.num_conversations = opt.get('num_conversations', 1)
+        self.arrival_rate = opt.get('arrival_rate', 10.0)
+        self.max_workers = opt.get('max_connections') or self.num_conversations
+        self.onboard_function = None
+        self.started_conversations = 0
+        self.completed_conversations = 0
+
+        log_paths = opt.get('replay_logs') or glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'logs', '*.json'))
+        self.scripts = load_scripts(log_paths)
+        self.random = random.Random(opt.get('seed'))
+
+        self.waiting = []
+        self.arrival_times = {}
+        self.pairing_latencies = []
+        self.onboarding_times = []
+        self.conversation_times = []
+        self.condition = threading.Condition()
+        self.arrivals_done = False
+        self.accepting = False
+
+    def setup_server(self):
+        print("Using local MTurk manager, no server is set up")
+
+    def start_new_run(self):
+        self.started_conversations = 0
+        self.completed_conversations = 0
+
+    def create_hits(self):
+        print("Simulating {} conversations with workers arriving at {} per second"
+              .format(self.num_conversations, self.arrival_rate))
+
+    def set_onboard_function(self, onboard_function):
+        self.onboard_function = onboard_function
+
+    def ready_to_accept_workers(self):
+        self.accepting = True
+
+    def expire_all_unassigned_hits(self):
+        with self.condition:
+            self.waiting = []
+
+    def shutdown(self):
+        self.accepting = False
+
+    def create_worker(self, index):
+        """
+        Creates a simulated worker that replays one player of a random recorded game
+        :param index: the number of the worker in this run
+        :return: a ScriptedAgent
+        """
+        script = self.random.choice(self.scripts)
+        player_label = self.random.choice(sorted(script))
+        worker = ScriptedAgent(None, 'local_worker_{}'.format(index), script[player_label],
+                               speed=self.opt.get('replay_speed', 0.0))
+        worker.assignment_id = 'local_assignment_{}'.format(index)
+        worker.hit_id = 'local_hit_{}'.format(index)
+        return worker
+
+    def arrive_workers(self, num_workers):
+        """
+        Thread loop that lets workers arrive as a Poisson process and onboards them
+        :param num_workers: the number of workers to simulate
+        :return: Nothing
+        """
+        for index in range(num_workers):
+            if not self.accepting:
+                break
+            if self.arrival_rate:
+                time.sleep(self.random.expovariate(self.arrival_rate))
+
+            worker = self.create_worker(index)
+            arrival = time.time()
+            if self.onboard_function is not None:
+                self.onboard_function(worker)
+            self.onboarding_times.append(time.time() - arrival)
+
+            with self.condition:
+                self.arrival_times[worker.worker_id] = arrival
+                self.waiting.append(worker)
+                self.condition.notify_all()
+
+        with self.condition:
+            self.arrivals_done = True
+            self.condition.notify_all()
+
+    def match_workers(self, eligibility_function):
+        """
+        Takes the next group of workers from the waiting pool that the eligibility function accepts
+        :param eligibility_function: a function of one worker or a {'func': ..., 'multiple': True} dict
+        :return: a list of matched workers, empty if no group can be formed yet
+        """
+        group_size = len(self.mturk_agent_ids)
+        if isinstance(eligibility_function, dict) and eligibility_function.get('multiple'):
+            matched = eligibility_function['func'](self.waiting)
+        else:
+            function = eligibility_function['func'] if isinstance(eligibility_function, dict) \
+                else eligibility_function
+            matched = [worker for worker in self.waiting if function(worker)][:group_size]
+
+        if len(matched) < group_size:
+            return []
+        matched = matched[:group_size]
+        for worker in matched:
+            self.waiting.remove(worker)
+        return matched
+
+    def start_task(self, eligibility_function, assign_role_function, task_function):
+        """
+        Runs conversations until num_conversations are completed or no more workers arrive
+        :param eligibility_function: a function of one worker or a {'func': ..., 'multiple': True} dict
+        :param assign_role_function: function that sets the id of every worker of a matched group
+        :param task_function: function(mturk_manager, opt, workers) that runs a conversation
+        :return: Nothing
+        """
+        num_workers = self.opt.get('num_workers') or self.num_conversations * len(self.mturk_agent_ids)
+        arrivals = threading.Thread(target=self.arrive_workers, args=(num_workers,), daemon=True)
+        arrivals.start()
+
+        start = time.time()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while self.started_conversations < self.num_conversations:
+                with self.condition:
+                    workers = self.match_workers(eligibility_function)
+                    while not workers and not self.arrivals_done:
+                        self.condition.wait()
+                        workers = self.match_workers(eligibility_function)
+                if not workers:
+                    print("No more workers to pair, {} workers left waiting".format(len(self.waiting)))
+                    break
+
+                paired = time.time()
+                for worker in workers:
+                    self.pairing_latencies.append(paired - self.arrival_times.pop(worker.worker_id))
+
+                assign_role_function(workers)
+                self.started_conversations += 1
+                futures.append(pool.submit(self.run_conversation, task_function, workers))
+
+        for future in futures:
+            future.result()
+
+        self.print_report(time.time() - start)
+
+    def run_conversation(self, task_function, workers):
+        start = time.time()
+        task_function(mturk_manager=self, opt=self.opt, workers=workers)
+        with self.condition:
+            self.conversation_times.append(time.time() - start)
+            self.completed_conversations += 1
+
+    def print_report(self, wall_time):
+        report = [
+            ('conversations', self.completed_conversations),
+            ('wall_time', wall_time),
+            ('conversations_per_sec', self.completed_conversations / wall_time if wall_time else None),
+            ('onboarding_p50', percentile(self.onboarding_times, 50)),
+            ('pairing_latency_p50', percentile(self.pairing_latencies, 50)),
+            ('pairing_latency_p95', percentile(self.pairing_latencies, 95)),
+            ('pairing_latency_max', max(self.pairing_latencies) if self.pairing_latencies else None),
+            ('conversation_p50', percentile(self.conversation_times, 50)),
+            ('conversation_p95', percentile(self.conversation_times, 95)),
+        ]
+        for key, value in report:
+            print("{:>22}: {}".format(key, value))
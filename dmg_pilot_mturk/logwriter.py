@@ -0,0 +1,170 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from collections import OrderedDict
+import json
+import os
+import queue
+import sys
+import threading
+
+
+GAME_EVENT = 'game'
+MESSAGE_EVENT = 'message'
+ROUND_EVENT = 'round'
+
+
+class StreamingLogWriter(object):
+    """
+    Appends game log records to JSON Lines files from a single background thread.
+    Worlds only enqueue their records; the writer thread drains the queue in batches and flushes every file it
+    touched once per batch, so a crash loses at most the records that were not written yet. A record that cannot be
+    serialized or written is reported and skipped, so one bad record does not stop the logs of all games.
+    """
+
+    def __init__(self, batch_size=256, close_timeout=60.0):
+        """
+        :param batch_size: the maximum number of records written between two flushes
+        :param close_timeout: the default number of seconds close waits for the records of a file
+        """
+        self.batch_size = batch_size
+        self.close_timeout = close_timeout
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, event, record):
+        """
+        Queues a record for the given log file
+        :param path: the path of the JSON Lines file
+        :param event: the type of the record, one of GAME_EVENT, MESSAGE_EVENT and ROUND_EVENT
+        :param record: a JSON serializable dict
+        :return: Nothing
+        """
+        line = dict(record)
+        line['event'] = event
+        self.queue.put((path, line))
+
+    def close(self, path, timeout=None):
+        """
+        Blocks until all queued records of the given log file are written and closes the file
+        :param path: the path of the JSON Lines file
+        :param timeout: the number of seconds to wait. Defaults to the writer's close_timeout
+        :return: True if the file was closed, False if the timeout expired first
+        """
+        closed = threading.Event()
+        self.queue.put((path, closed))
+        if closed.wait(self.close_timeout if timeout is None else timeout):
+            return True
+        print("WARNING: Timed out waiting for the log writer to close {}".format(path))
+        return False
+
+    def run(self):
+        """
+        Writer thread loop that writes queued records in batches
+        :return: Nothing
+        """
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            touched = set()
+            for path, item in batch:
+                if isinstance(item, threading.Event):
+                    touched.discard(path)
+                    try:
+                        if path in self.files:
+                            self.files.pop(path).close()
+                    except (IOError, OSError) as e:
+                        print("WARNING: Could not close log file {}: {}".format(path, e))
+                    item.set()
+                    continue
+
+                try:
+                    line = json.dumps(item) + '\n'
+                    if path not in self.files:
+                        directory = os.path.dirname(path)
+                        if directory and not os.path.exists(directory):
+                            os.makedirs(directory)
+                        self.files[path] = open(path, 'a')
+                    self.files[path].write(line)
+                    touched.add(path)
+                except (IOError, OSError, TypeError, ValueError) as e:
+                    print("WARNING: Dropping {} record for {}: {}".format(item.get('event'), path, e))
+
+            for path in touched:
+                try:
+                    self.files[path].flush()
+                except (IOError, OSError) as e:
+                    print("WARNING: Could not flush log file {}: {}".format(path, e))
+
+
+def read_log_stream(path):
+    """
+    Reads the records of a JSON Lines game log, skipping a line that was cut off by a crash
+    :param path: the path of the JSON Lines file
+    :return: a list of record dicts
+    """
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print("WARNING: Skipping incomplete log record in {}".format(path))
+    return records
+
+
+def compact_log(path, out_path=None, rounds_key='rounds', messages_key='messages'):
+    """
+    Turns a JSON Lines game log into the per-game JSON layout used by the analysis notebooks
+    :param path: the path of the JSON Lines file
+    :param out_path: the path of the JSON file to write. Defaults to the stream's path with a .json extension
+    :param rounds_key: the key under which the game lists its rounds
+    :param messages_key: the key under which a round lists its messages
+    :return: the compacted game log
+    """
+    conversation_log = OrderedDict()
+    rounds = OrderedDict()
+
+    for record in read_log_stream(path):
+        event = record.pop('event')
+        if event == GAME_EVENT:
+            conversation_log.update(record)
+            continue
+
+        round_nr = record.pop('round')
+        if round_nr not in rounds:
+            rounds[round_nr] = {'summary': {}, 'messages': []}
+        if event == MESSAGE_EVENT:
+            rounds[round_nr]['messages'].append(record)
+        elif event == ROUND_EVENT:
+            rounds[round_nr]['summary'].update(record)
+
+    conversation_log[rounds_key] = []
+    for round_data in rounds.values():
+        round_log = OrderedDict(round_data['summary'])
+        round_log[messages_key] = round_data['messages']
+        conversation_log[rounds_key].append(round_log)
+
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + '.json'
+    with open(out_path, 'w') as f:
+        json.dump(conversation_log, f)
+
+    return conversation_log
+
+
+if __name__ == '__main__':
+    for stream_path in sys.argv[1:]:
+        compact_log(stream_path)
@@ -0,0 +1,181 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import INFO, WARNING
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class PairingQueue(object):
+    """
+    Queue of waiting workers that only forms pairs with a game neither worker has played.
+    Every game keeps the waiting workers that never played it in arrival order, so the partner of the longest waiting
+    worker is the earliest arrival found in the index entries of that worker's unplayed games. The chosen game is
+    reserved with the eligibility engine, which hands it to the pair's world. Workers with a checkpointed game are
+    paired with their partner of that game first, without a reservation, so their world resumes the game.
+    """
+
+    def __init__(self, engine, instrumentation=None, checkpoints=None):
+        """
+        :param engine: the EligibilityEngine that holds the worker records
+        :param instrumentation: the Instrumentation to report wait times and rejections to
+        :param checkpoints: the CheckpointStore of the task, None to never pair workers for a resume
+        """
+        self.engine = engine
+        self.instrumentation = instrumentation
+        self.checkpoints = checkpoints
+        self.lock = threading.Lock()
+
+        self.joined = OrderedDict()
+        self.unplayed = {}
+        self.index = {}
+        self.rejected = None
+
+    def add(self, worker_id):
+        """
+        Adds a worker to the queue and to the index entries of all games it never played
+        :param worker_id: the id of the worker
+        :return: Nothing
+        """
+        self.joined[worker_id] = time.time()
+        unplayed = self.engine.unseen_games([worker_id])
+        self.unplayed[worker_id] = unplayed
+        for bit in self.bits(unplayed):
+            self.index.setdefault(bit, OrderedDict())[worker_id] = None
+
+    def remove(self, worker_id):
+        """
+        Removes a worker from the queue and the index
+        :param worker_id: the id of the worker
+        :return: the number of seconds the worker waited
+        """
+        for bit in self.bits(self.unplayed.pop(worker_id)):
+            del self.index[bit][worker_id]
+        return time.time() - self.joined.pop(worker_id)
+
+    def refresh(self, worker_id):
+        """
+        Drops a worker from the index entries of the games it played since it was added
+        :param worker_id: the id of the worker
+        :return: Nothing
+        """
+        unplayed = self.engine.unseen_games([worker_id])
+        for bit in self.bits(self.unplayed[worker_id] & ~unplayed):
+            del self.index[bit][worker_id]
+        self.unplayed[worker_id] = unplayed
+
+    @staticmethod
+    def bits(mask):
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def sync(self, workers):
+        """
+        Brings the queue in line with the pool of waiting workers, adding new arrivals and dropping workers that left
+        :param workers: the waiting workers
+        :return: a dict that maps the worker ids to the workers
+        """
+        pool = OrderedDict((worker.worker_id, worker) for worker in workers)
+        for worker_id in [worker_id for worker_id in self.joined if worker_id not in pool]:
+            self.remove(worker_id)
+        for worker_id in pool:
+            if worker_id not in self.joined and self.engine.is_eligible(worker_id):
+                self.add(worker_id)
+        return pool
+
+    def find_partner(self, worker_id):
+        """
+        Returns the longest waiting worker that shares an unplayed game with the given worker
+        :param worker_id: the id of the worker to find a partner for
+        :return: the id of the partner or None if no waiting worker shares an unplayed game with the worker
+        """
+        partner_id = None
+        for bit in self.bits(self.unplayed[worker_id]):
+            for candidate_id in self.index[bit]:
+                if candidate_id == worker_id:
+                    continue
+                if partner_id is None or self.joined[candidate_id] < self.joined[partner_id]:
+                    partner_id = candidate_id
+                break
+        return partner_id
+
+    def find_resume(self, pool):
+        """
+        Returns the workers of the oldest checkpointed game whose players are all waiting
+        :param pool: a dict that maps the worker ids to the waiting workers
+        :return: the ids of the workers or None if no checkpointed game can be resumed
+        """
+        worker_ids = {str(worker_id): worker_id for worker_id in pool}
+        for game_workers, _, _, _ in self.checkpoints.pending():
+            if all(worker_id in worker_ids for worker_id in game_workers):
+                return [worker_ids[worker_id] for worker_id in game_workers]
+        return None
+
+    def match(self, workers):
+        """
+        Pairs the longest waiting worker with the longest waiting worker it shares an unplayed game with and
+        reserves one of their unplayed games. Usable as a {'func': ..., 'multiple': True} eligibility function
+        :param workers: the waiting workers
+        :return: the two matched workers or an empty list
+        """
+        with self.lock:
+            pool = self.sync(workers)
+
+            # Workers that return to a checkpointed game only play it with their partner, its game is chosen already
+            if self.checkpoints is not None:
+                worker_ids = self.find_resume(pool)
+                if worker_ids is not None:
+                    for worker_id in worker_ids:
+                        if worker_id in self.joined:
+                            waited = self.remove(worker_id)
+                            if self.instrumentation is not None:
+                                self.instrumentation.observe('dmg_queue_wait_seconds', waited)
+                    if self.instrumentation is not None:
+                        self.instrumentation.increment('dmg_pairs_total')
+                        self.instrumentation.event(INFO, 'paired_for_resume', workers=list(worker_ids),
+                                                   waiting=len(self.joined))
+                    return [pool[worker_id] for worker_id in worker_ids]
+
+            for worker_id in self.joined:
+                partner_id = self.find_partner(worker_id)
+                if partner_id is None:
+                    continue
+
+                worker_ids = (worker_id, partner_id)
+                if self.engine.reserve_unseen(worker_ids) is None:
+                    # A world recorded a play of these workers since they were indexed
+                    for paired_id in worker_ids:
+                        self.refresh(paired_id)
+                    continue
+                for paired_id in worker_ids:
+                    waited = self.remove(paired_id)
+                    if self.instrumentation is not None:
+                        self.instrumentation.observe('dmg_queue_wait_seconds', waited)
+                if self.instrumentation is not None:
+                    self.instrumentation.increment('dmg_pairs_total')
+                    self.instrumentation.event(INFO, 'paired', workers=list(worker_ids), waiting=len(self.joined))
+                return [pool[worker_id], pool[partner_id]]
+
+            # Fall back to the engine if workers may replay a game, before giving up on this pool
+            matched = []
+            if len(self.joined) > 1 and self.engine.max_plays > 1:
+                matched = self.engine.match([pool[worker_id] for worker_id in self.joined])
+                for worker in matched:
+                    self.remove(worker.worker_id)
+
+            # Report a pool in which no pair can be formed once, not on every poll of the manager
+            if not matched and len(self.joined) > 1 and self.rejected != tuple(self.joined):
+                self.rejected = tuple(self.joined)
+                if self.instrumentation is not None:
+                    self.instrumentation.increment('dmg_pairing_rejections_total')
+                    self.instrumentation.event(WARNING, 'no_valid_pair', waiting=len(self.joined))
+            return matched
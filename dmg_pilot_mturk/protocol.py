@@ -0,0 +1,186 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.tasks.dmg_pilot_mturk.agents import SELECTION_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import COM_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import DIF_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import NEXT_ROUND_TOKEN
+from parlai.tasks.dmg_pilot_mturk.agents import FEEDBACK_TOKEN
+
+from glob import glob
+import argparse
+import json
+import os
+import timeit
+
+
+CHAT = 'chat'
+SELECTION = 'selection'
+FEEDBACK = 'feedback'
+NEXT_ROUND = 'next_round'
+
+# Control message types and the tokens that start them, as sent by the task page
+CONTROL_TOKENS = {
+    SELECTION: SELECTION_TOKEN,
+    FEEDBACK: FEEDBACK_TOKEN,
+    NEXT_ROUND: NEXT_ROUND_TOKEN,
+}
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a message starts with a control token but does not follow the token's format
+    """
+
+    def __init__(self, message_type, text, reason):
+        super(ProtocolError, self).__init__("Malformed {} message {!r}: {}".format(message_type, text, reason))
+        self.message_type = message_type
+        self.text = text
+        self.reason = reason
+
+
+class Message(object):
+    """
+    A parsed message. Chat messages carry only their text, control messages add their parsed fields
+    """
+
+    __slots__ = ('type', 'text')
+
+    def __init__(self, message_type, text):
+        self.type = message_type
+        self.text = text
+
+
+class SelectionMessage(Message):
+
+    __slots__ = ('image_type', 'image')
+
+    def __init__(self, text, image_type, image):
+        self.type = SELECTION
+        self.text = text
+        self.image_type = image_type
+        self.image = image
+
+
+class MessageParser(object):
+    """
+    Table-driven parser for the messages the players send.
+    Anything that does not start with a known control token is chat, so chat messages cost a single character test
+    and a dict lookup at most.
+    """
+
+    def __init__(self, tokens=None, selection_types=(COM_TOKEN, DIF_TOKEN)):
+        """
+        :param tokens: a dict that maps each control message type to its token. Defaults to CONTROL_TOKENS
+        :param selection_types: the tokens a selection can mark an image with
+        """
+        tokens = CONTROL_TOKENS if tokens is None else tokens
+        self.types = {token: message_type for message_type, token in tokens.items()}
+        self.prefixes = frozenset(token[0] for token in self.types)
+        self.selection_types = frozenset(selection_types)
+        self.parsers = {
+            SELECTION: self.parse_selection,
+            FEEDBACK: self.parse_bare,
+            NEXT_ROUND: self.parse_next_round,
+        }
+
+    def parse(self, text):
+        """
+        Parses a message
+        :param text: the text of the message
+        :return: a Message, with type CHAT if the text is no control message
+        :raises ProtocolError: if the text starts with a control token but is malformed
+        """
+        if not text or text[0] not in self.prefixes:
+            return Message(CHAT, text)
+
+        token, _, arguments = text.partition(" ")
+        message_type = self.types.get(token)
+        if message_type is None:
+            return Message(CHAT, text)
+        return self.parsers[message_type](message_type, text, arguments)
+
+    def parse_selection(self, message_type, text, arguments):
+        # Image paths may contain spaces, so only the selection type is split off
+        image_type, _, image = arguments.partition(" ")
+        if image_type not in self.selection_types:
+            raise ProtocolError(message_type, text, "unknown selection type {!r}".format(image_type))
+        if not image:
+            raise ProtocolError(message_type, text, "no image given")
+        return SelectionMessage(text, image_type, image)
+
+    def parse_next_round(self, message_type, text, arguments):
+        # The last <next_round> of a game carries the player's answers to the closing survey
+        return Message(message_type, text)
+
+    def parse_bare(self, message_type, text, arguments):
+        if arguments.strip():
+            raise ProtocolError(message_type, text, "unexpected arguments {!r}".format(arguments))
+        return Message(message_type, text)
+
+
+def split_chain(text):
+    """
+    The split()-based token handling the worlds used before, kept as the baseline of the micro-benchmark
+    :param text: the text of the message
+    :return: the message type
+    """
+    message = text.split(" ")
+    if message[0] == SELECTION_TOKEN:
+        assert len(message) == 3
+        return SELECTION
+    if message[0] == FEEDBACK_TOKEN:
+        return FEEDBACK
+    if message[0] == NEXT_ROUND_TOKEN:
+        return NEXT_ROUND
+    return CHAT
+
+
+def main():
+    """
+    Micro-benchmark of the message parser on the messages of recorded games.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Micro-benchmark of the DMG message parser')
+    argparser.add_argument('--logs', nargs='+', default=glob(os.path.join(module_dir, 'logs', '*.json')),
+                           help='recorded game logs to take the messages from')
+    argparser.add_argument('--repeat', type=int, default=20, help='number of passes over the messages')
+    args = argparser.parse_args()
+
+    parser = MessageParser()
+    messages = {}
+    for path in args.logs:
+        with open(path, 'r') as f:
+            for round_log in json.load(f)['rounds']:
+                for message in round_log['messages']:
+                    try:
+                        message_type = parser.parse(message['message']).type
+                    except ProtocolError:
+                        continue
+                    messages.setdefault(message_type, []).append(message['message'])
+
+    print("{:>12} {:>8} {:>14} {:>14}".format('type', 'count', 'parse ns/msg', 'split ns/msg'))
+    for message_type, texts in sorted(messages.items()):
+        def baseline():
+            for text in texts:
+                try:
+                    split_chain(text)
+                except AssertionError:
+                    pass
+
+        parse_time = timeit.timeit(lambda: [parser.parse(text) for text in texts], number=args.repeat)
+        split_time = timeit.timeit(baseline, number=args.repeat)
+        total = float(len(texts) * args.repeat)
+        print("{:>12} {:>8} {:>14.0f} {:>14.0f}".format(message_type, len(texts), parse_time / total * 1e9,
+                                                         split_time / total * 1e9))
+
+
+if __name__ == '__main__':
+    main()
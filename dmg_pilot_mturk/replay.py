@@ -0,0 +1,365 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.worlds import MTurkDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_mturk.catalogue import GameCatalogue
+from parlai.mturk.tasks.dmg_pilot_mturk.sharding import PresetScheduler
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import StreamingLogWriter, compact_log
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import add_instrumentation_args, create_instrumentation
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import add_shutdown_args, create_shutdown_executor
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def speaker(message):
+    # Older logs label the speaker as 'speaker:'
+    return message.get('speaker', message.get('speaker:'))
+
+
+class ReplaySequencer(object):
+    """
+    Shared cursor over the recorded messages of a game.
+    A message is only handed to its player once the world routed the previous message to the other player, so the
+    event-driven world receives the messages of both players in exactly the recorded order. Recorded players do not
+    take strict turns, so games are not replayed in lockstep.
+    """
+
+    def __init__(self, messages, speed=0.0):
+        """
+        :param messages: the recorded messages of the game as (offset in seconds, player label, text) tuples
+        :param speed: time scaling of the recorded message offsets. 0 replays as fast as possible
+        """
+        self.messages = messages
+        self.speed = speed
+        self.condition = threading.Condition()
+        self.cursor = 0
+        self.pending = False
+        self.closed = False
+        self.start = None
+
+    def next(self, player_label):
+        """
+        Waits until the next recorded message is one of the given player's
+        :param player_label: the label of the player
+        :return: the index and text of the message, or None if the recording ended or the replay was stopped
+        """
+        with self.condition:
+            while not self.closed and self.cursor < len(self.messages) \
+                    and (self.pending or self.messages[self.cursor][1] != player_label):
+                self.condition.wait()
+            if self.closed or self.cursor >= len(self.messages):
+                return None
+            self.pending = True
+            if self.start is None:
+                self.start = time.time()
+            index = self.cursor
+            offset, _, text = self.messages[index]
+
+        if self.speed:
+            delay = self.start + offset / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return index, text
+
+    def delivered(self, index):
+        """
+        Moves the cursor past a message once the world routed it
+        :param index: the index of the message
+        :return: Nothing
+        """
+        with self.condition:
+            if index == self.cursor:
+                self.cursor += 1
+                self.pending = False
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ReplayAgent(object):
+    """
+    Stub player that sends the recorded messages of one player of a game, in the order set by the game's
+    ReplaySequencer. The player label is assigned once the world has shuffled its agents.
+    """
+
+    def __init__(self, agent_id, worker_id, sequencer):
+        """
+        :param agent_id: the agent id the world uses to address the player
+        :param worker_id: the worker id of the recorded player
+        :param sequencer: the ReplaySequencer of the game
+        """
+        self.id = agent_id
+        self.worker_id = worker_id
+        self.sequencer = sequencer
+        self.player_label = None
+
+    def observe(self, observation):
+        if 'replay_index' in observation:
+            self.sequencer.delivered(observation['replay_index'])
+
+    def act(self, timeout=None):
+        message = self.sequencer.next(self.player_label)
+        if message is None:
+            return {'id': self.id, 'text': '', 'episode_done': True}
+        index, text = message
+        return {'id': self.id, 'text': text, 'episode_done': False, 'replay_index': index}
+
+    def shutdown(self, timeout=None):
+        # Release a reader that is still waiting for its next message
+        self.sequencer.close()
+
+
+def recorded_messages(game_log):
+    """
+    Flattens the messages of a recorded game into the order in which the players sent them
+    :param game_log: a game log in the layout written by run.py
+    :return: a list of (offset from the first message in seconds, player label, text) tuples
+    """
+    messages = [message for round_log in game_log['rounds'] for message in round_log['messages']]
+    if not messages:
+        return []
+    start = messages[0]['timestamp']
+    return [(message['timestamp'] - start, speaker(message), message['message']) for message in messages]
+
+
+def game_catalogue(game_log):
+    """
+    Builds a catalogue that only holds the recorded game, with the images its players saw in every round
+    :param game_log: a game log in the layout written by run.py
+    :return: a GameCatalogue
+    """
+    game = {'game_id': game_log['game_id']}
+    for player_label in game_log['agent_labels']:
+        game[player_label] = [round_log['images'][player_label] for round_log in game_log['rounds']]
+    return GameCatalogue([game])
+
+
+def label_scores(game_log, round_log):
+    """
+    Returns the scores of a round keyed by player label, as player ids depend on how the world shuffled its agents
+    :param game_log: the game log
+    :param round_log: a round of the game log
+    :return: a dict that maps each player label to its score, or None if the round was not scored
+    """
+    if round_log.get('score') is None:
+        return None
+    labels = dict(zip(game_log['players'], game_log['agent_labels']))
+    return {labels[player]: score for player, score in round_log['score'].items()}
+
+
+def compare_logs(recorded, replayed):
+    """
+    Compares a replayed game to its recording. Rounds are compared by their images, the speakers and texts of their
+    messages and their scores. Timestamps and turn numbers depend on the world that recorded the game and are ignored
+    :param recorded: the recorded game log
+    :param replayed: the game log the replay produced
+    :return: a list of descriptions of the differences, empty if the replay matches the recording
+    """
+    differences = []
+    if len(recorded['rounds']) != len(replayed['rounds']):
+        differences.append("played {} rounds instead of {}".format(len(replayed['rounds']), len(recorded['rounds'])))
+
+    for round_nr, (recorded_round, replayed_round) in enumerate(zip(recorded['rounds'], replayed['rounds'])):
+        for player_label in recorded['agent_labels']:
+            if list(recorded_round['images'][player_label]) != list(replayed_round['images'][player_label]):
+                differences.append("round {}: player {} saw different images".format(round_nr, player_label))
+
+        recorded_messages = [(speaker(message), message['message']) for message in recorded_round['messages']]
+        replayed_messages = [(speaker(message), message['message']) for message in replayed_round['messages']]
+        if recorded_messages != replayed_messages:
+            position = next((i for i, (a, b) in enumerate(zip(recorded_messages, replayed_messages)) if a != b),
+                            min(len(recorded_messages), len(replayed_messages)))
+            differences.append("round {}: messages differ from message {} on ({} recorded, {} replayed)".format(
+                round_nr, position, len(recorded_messages), len(replayed_messages)))
+
+        recorded_score = label_scores(recorded, recorded_round)
+        replayed_score = label_scores(replayed, replayed_round)
+        if recorded_score != replayed_score:
+            differences.append("round {}: scored {} instead of {}".format(round_nr, replayed_score, recorded_score))
+    return differences
+
+
+def replay_game(game_log, opt, speed=0.0, shared=None):
+    """
+    Plays a recorded game on a new MTurkDMGDialogWorld and compares the result to the recording
+    :param game_log: the recorded game log
+    :param opt: the task options for the world
+    :param speed: time scaling of the recorded conversation. 0 replays as fast as possible
+    :param shared: the instrumentation, shutdown executor and log writer to hand to the world
+    :return: a dict with the 'game_id', 'messages', 'duration', 'timed_out' and 'differences' of the replay, and
+        its 'log_path' if the log was written
+    """
+    sequencer = ReplaySequencer(recorded_messages(game_log), speed)
+    agents = [ReplayAgent(player, worker_id, sequencer)
+              for player, worker_id in zip(game_log['players'], game_log['agent_ids'])]
+    shared = dict(shared or {}, catalogue=game_catalogue(game_log), scheduler=PresetScheduler(game_log['game_id']))
+    log_writer = shared.get('log_writer')
+
+    start = time.perf_counter()
+    world = MTurkDMGDialogWorld(opt=opt, agents=agents, shared=shared)
+    # The world shuffles its agents, so every agent plays whichever label it got
+    for agent, player_label in zip(world.agents, world.player_labels):
+        agent.player_label = player_label
+    while not world.episode_done():
+        world.parley()
+    duration = time.perf_counter() - start
+    sequencer.close()
+
+    result = {
+        'game_id': game_log['game_id'],
+        'messages': len(sequencer.messages),
+        'duration': duration,
+        'timed_out': world.timed_out(),
+    }
+    if log_writer is not None:
+        log_writer.close(world.log_path)
+        replayed = json.loads(json.dumps(compact_log(world.log_path)))
+        result['log_path'] = world.log_path
+    else:
+        replayed = json.loads(json.dumps(world.conversation_log))
+    result['differences'] = compare_logs(game_log, replayed)
+    return result
+
+
+def load_known_differences(path):
+    """
+    Reads the differences that recorded logs are known to have with their replay
+    :param path: the path of a JSON file that maps log file names to their 'reason' and 'differences', or None
+    :return: a dict that maps each log file name to a set of difference descriptions
+    """
+    if path is None:
+        return {}
+    with open(path, 'r') as f:
+        known = json.load(f)
+    return {name: set(entry['differences']) for name, entry in known.items()}
+
+
+def run_replay(opt, log_paths, speed=0.0, concurrency=1, repeat=1, stream_logs=False, known_differences=None):
+    """
+    Replays recorded games on concurrent worlds, checks them against their recordings and measures throughput
+    :param opt: the task options for the worlds
+    :param log_paths: paths of game logs in the layout written by run.py
+    :param speed: time scaling of the recorded conversations. 0 replays as fast as possible
+    :param concurrency: the number of games to replay at the same time
+    :param repeat: the number of times to replay every game
+    :param stream_logs: write the replayed logs through a StreamingLogWriter as run.py does, and compare those
+    :param known_differences: a dict as returned by load_known_differences. Known differences of a log are reported
+        separately and do not count as mismatches
+    :return: a report dict
+    """
+    known_differences = known_differences or {}
+    game_logs = []
+    for path in log_paths:
+        with open(path, 'r') as f:
+            game_logs.append((path, json.load(f)))
+
+    instrumentation = create_instrumentation(opt)
+    shutdown_executor = create_shutdown_executor(opt, instrumentation)
+    shared = {'instrumentation': instrumentation, 'shutdown_executor': shutdown_executor}
+    if stream_logs:
+        shared['log_writer'] = StreamingLogWriter()
+
+    def run_game(index):
+        path, game_log = game_logs[index % len(game_logs)]
+        result = replay_game(game_log, opt, speed, shared)
+        result['path'] = path
+        known = known_differences.get(os.path.basename(path), set())
+        result['known_differences'] = [difference for difference in result['differences'] if difference in known]
+        result['differences'] = [difference for difference in result['differences'] if difference not in known]
+        return result
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run_game, range(len(game_logs) * repeat)))
+    wall_time = time.perf_counter() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    shutdown_executor.close()
+    instrumentation.close()
+
+    messages = sum(result['messages'] for result in results)
+    return {
+        'games': len(results),
+        'mismatches': sum(1 for result in results if result['differences']),
+        'timeouts': sum(1 for result in results if result['timed_out']),
+        'speed': speed,
+        'concurrency': concurrency,
+        'wall_time': wall_time,
+        'games_per_sec': len(results) / wall_time,
+        'messages_per_sec': messages / wall_time,
+        'cpu_time': (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime),
+        'results': results,
+    }
+
+
+def main():
+    """
+    Replays recorded games, prints the differences to their recordings and a summary, and exits with status 1 if any
+    replay differs from its recording in a way that is not listed as a known difference.
+    :return: Nothing.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    argparser = argparse.ArgumentParser(description='Replays recorded DMG games through MTurkDMGDialogWorld')
+    argparser.add_argument('--logs', nargs='+', default=sorted(glob(os.path.join(module_dir, 'logs', '*.json'))),
+                           help='recorded game logs to replay')
+    argparser.add_argument('--speed', type=float, default=0.0,
+                           help='time scaling of the recorded conversations, 0 replays as fast as possible')
+    argparser.add_argument('--concurrency', type=int, default=1, help='number of games replayed at the same time')
+    argparser.add_argument('--repeat', type=int, default=1, help='number of times to replay every game')
+    argparser.add_argument('--stream_logs', action='store_true',
+                           help='write the replayed logs to logs/ in the working directory and compare those')
+    argparser.add_argument('--known_differences', default=os.path.join(module_dir, 'replay_known_differences.json'),
+                           help='JSON file of the differences recorded logs are known to have with their replay')
+    argparser.add_argument('--report', default=None, help='write the report as JSON to this file')
+    add_instrumentation_args(argparser)
+    add_shutdown_args(argparser)
+    argparser.set_defaults(log_level='warning')
+    args = argparser.parse_args()
+
+    opt = {
+        'task': 'dmg_pilot_mturk',
+        'lockstep_parley': False,
+        'log_level': args.log_level,
+        'log_sample_rate': args.log_sample_rate,
+        'metrics_file': args.metrics_file,
+        'metrics_format': args.metrics_format,
+        'shutdown_workers': args.shutdown_workers,
+        'shutdown_timeout': args.shutdown_timeout,
+    }
+    report = run_replay(opt, args.logs, args.speed, args.concurrency, args.repeat, args.stream_logs,
+                        load_known_differences(args.known_differences))
+
+    for result in report['results']:
+        for difference in result['known_differences']:
+            print("{}: {} (known)".format(result['path'], difference))
+        for difference in result['differences']:
+            print("{}: {}".format(result['path'], difference))
+    for key, value in report.items():
+        if key != 'results':
+            print("{:>20}: {}".format(key, value))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    if report['mismatches']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,22 @@
 from parlai.core.params import ParlaiParser
 from parlai.mturk.core.mturk_manager import MTurkManager
 from parlai.mturk.tasks.dmg_pilot_mturk.worlds import MTurkDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_mturk.catalogue import load_catalogue
+from parlai.mturk.tasks.dmg_pilot_mturk.eligibility import EligibilityEngine
+from parlai.mturk.tasks.dmg_pilot_mturk.pairing import PairingQueue
+from parlai.mturk.tasks.dmg_pilot_mturk.checkpoint import CheckpointStore
+from parlai.mturk.tasks.dmg_pilot_mturk.sharding import ShardDispatcher
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import StreamingLogWriter, compact_log
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import add_instrumentation_args, create_instrumentation
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import add_shutdown_args, create_shutdown_executor
 from parlai.agents.local_human.local_human import LocalHumanAgent
 from parlai.core.agents import create_agent
 from task_config import task_config
 
-from collections import defaultdict
-import json
 import os
-import time
+import shutil
+import tempfile
+
 
 
 def main():
@@ -30,21 +38,110 @@ def main():
     argparser.add_argument('--two_mturk_agents', dest='two_mturk_agents',
                            action='store_true', help='data collection mode '
                            'with converations between two MTurk agents')
+    argparser.add_argument('--lockstep_parley', dest='lockstep_parley',
+                           action='store_true', help='let the agents act in '
+                           'a fixed order instead of handling messages as they arrive')
+    argparser.add_argument('--turn_timeout', dest='turn_timeout', type=float,
+                           default=None, help='seconds without any message after '
+                           'which a round is ended and the agents are released')
+    argparser.add_argument('--round_timeout', dest='round_timeout', type=float,
+                           default=None, help='maximum number of seconds a single '
+                           'round may take before it is ended and the agents are released')
+    argparser.add_argument('--local_manager', dest='local_manager',
+                           action='store_true', help='run the task offline with '
+                           'simulated workers that replay recorded games')
+    argparser.add_argument('--arrival_rate', dest='arrival_rate', type=float,
+                           default=10.0, help='simulated workers arriving per '
+                           'second when running with --local_manager')
+    argparser.add_argument('--worker_db', dest='worker_db', default=None,
+                           help='SQLite database that keeps the games every worker played, defaults to '
+                           'worker_records.db next to this script, or an in-memory database with --local_manager')
+    argparser.add_argument('--max_games_per_worker', dest='max_games_per_worker', type=int,
+                           default=10, help='number of games after which a worker is banned')
+    argparser.add_argument('--max_plays_per_game', dest='max_plays_per_game', type=int,
+                           default=1, help='number of times a worker may play the same game')
+    argparser.add_argument('--checkpoint_db', dest='checkpoint_db', default=None,
+                           help='SQLite database that keeps the state of in-progress games, so they '
+                           'can be resumed after a restart. Defaults to checkpoints.db next to this script, '
+                           'or a temporary file with --local_manager')
+    argparser.add_argument('--checkpoint_max_age', dest='checkpoint_max_age', type=float,
+                           default=24 * 60 * 60, help='seconds after which the checkpoint of a game '
+                           'that was not resumed expires')
+    argparser.add_argument('--checkpoint_selections', dest='checkpoint_selections',
+                           action='store_true', help='also checkpoint a game on every selection, '
+                           'not only at round boundaries')
+    argparser.add_argument('--num_rounds', dest='num_rounds', type=int,
+                           default=None, help='number of rounds of a game, defaults to '
+                           'all rounds of the game definition')
+    argparser.add_argument('--shards', dest='shards', type=int, default=0,
+                           help='number of processes to run the game worlds in, 0 runs '
+                           'them in the task process')
+    add_instrumentation_args(argparser)
+    add_shutdown_args(argparser)
 
     opt = argparser.parse_args()
     opt['task'] = 'dmg_pilot_dev'
     opt['datatype'] = 'dmg_pilot_data_1'
     opt.update(task_config)
 
+    # Simulated workers always play against each other
+    if opt['local_manager']:
+        opt['two_mturk_agents'] = True
+
+    # Offline runs keep their worker records and checkpoints away from the databases of the live task. The shards
+    # open the checkpoint store themselves, so offline checkpoints go to a temporary file rather than into memory
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    checkpoint_dir = None
+    if opt['worker_db'] is None:
+        opt['worker_db'] = ':memory:' if opt['local_manager'] else os.path.join(module_dir, 'worker_records.db')
+    if opt['checkpoint_db'] is None:
+        if opt['local_manager']:
+            checkpoint_dir = tempfile.mkdtemp(prefix='dmg_checkpoints_')
+            opt['checkpoint_db'] = os.path.join(checkpoint_dir, 'checkpoints.db')
+        else:
+            opt['checkpoint_db'] = os.path.join(module_dir, 'checkpoints.db')
+
     local_agent_1_id = 'local_1'
     mturk_agent_ids = ['mturk_agent_1']
     if opt['two_mturk_agents']:
         mturk_agent_ids.append('mturk_agent_2')
 
-    mturk_manager = MTurkManager(
-        opt=opt,
-        mturk_agent_ids=mturk_agent_ids
-    )
+    # Load the game definitions once for all conversations of this run, spread the pairs over all games and
+    # stream the logs of all games through a single writer thread
+    catalogue = load_catalogue(opt)
+    log_writer = StreamingLogWriter()
+    instrumentation = create_instrumentation(opt)
+    shutdown_executor = create_shutdown_executor(opt, instrumentation)
+
+    # The eligibility engine pairs the workers and picks their game, so it also serves as the worlds' scheduler
+    eligibility = EligibilityEngine(catalogue.game_ids, db_path=opt['worker_db'],
+                                    max_games=opt['max_games_per_worker'],
+                                    max_plays_per_game=opt['max_plays_per_game'],
+                                    instrumentation=instrumentation)
+    checkpoints = CheckpointStore(opt['checkpoint_db'], max_age=opt['checkpoint_max_age'])
+    shared = {'catalogue': catalogue, 'scheduler': eligibility, 'log_writer': log_writer,
+              'instrumentation': instrumentation, 'shutdown_executor': shutdown_executor,
+              'checkpoints': checkpoints}
+
+    # Worlds can be spread over several processes, each with its own log writer
+    dispatcher = None
+    if opt['shards'] > 0:
+        dispatcher = ShardDispatcher(opt, opt['shards'], scheduler=eligibility, checkpoints=checkpoints,
+                                     shutdown_executor=shutdown_executor, instrumentation=instrumentation)
+
+    if opt['local_manager']:
+        # The offline manager replays recorded games through the benchmark's scripted agents, which the live task
+        # does not need
+        from parlai.mturk.tasks.dmg_pilot_mturk.local_manager import LocalMTurkManager
+        mturk_manager = LocalMTurkManager(
+            opt=opt,
+            mturk_agent_ids=mturk_agent_ids
+        )
+    else:
+        mturk_manager = MTurkManager(
+            opt=opt,
+            mturk_agent_ids=mturk_agent_ids
+        )
 
     mturk_manager.setup_server()
 
@@ -56,7 +153,14 @@ def main():
         mturk_manager.ready_to_accept_workers()
 
         def check_worker_eligibility(worker):
-            return True
+            return eligibility.is_eligible(worker.worker_id)
+
+        # Two MTurk workers are paired by the queue, which also reserves a game neither of them has played
+        if opt['two_mturk_agents']:
+            pairing = PairingQueue(eligibility, instrumentation, checkpoints)
+            eligibility_function = {'func': pairing.match, 'multiple': True}
+        else:
+            eligibility_function = check_worker_eligibility
 
         def assign_worker_roles(workers):
             for index, worker in enumerate(workers):
@@ -77,41 +181,32 @@ def main():
 
             opt["batchindex"] = mturk_manager.started_conversations
 
+            if dispatcher is not None:
+                result = dispatcher.run_game(agents, opt["batchindex"])
+                if result.get('error'):
+                    print("Game failed on shard {}: {}".format(result['shard'], result['error']))
+                return
+
             world = MTurkDMGDialogWorld(
                 opt=opt,
-                agents=agents
+                agents=agents,
+                shared=shared
             )
 
-            log_timestamp = time.time()
-
-            # Loop over all five rounds of the game
-            for r in range(5):
-                print("--- Starting round {} ---".format(r+1))
-                while not world.episode_done():
-                    world.parley()
-
-                # Write the log data to file
+            # The world moves through the rounds of the game itself and releases the agents when it ends
+            while not world.episode_done():
+                world.parley()
 
-                print("Writing log to file")
-                if not os.path.exists("logs"):
-                    os.makedirs("logs")
-                with open('logs/dmg_pilot_data_{}_{}.json'.format(world.game_nr, log_timestamp), 'w') as f:
-                    json.dump(world.conversation_log, f)
+            if world.timed_out():
+                print("Game timed out")
 
-                if not r == 4:
-                    # Reset the world for the next round
-                    world.selections = defaultdict(lambda: dict())
-                    world.round_log = world.reset_round_log()
-                    world.turn_nr = -1
-                    world.round_nr += 1
-                    world.doneCounter = 0
-                    world.episodeDone = False
-
-                else:
-                    world.shutdown()
+            # Turn the streamed log into a single JSON file for the analysis notebooks
+            print("Writing log to file")
+            if log_writer.close(world.log_path) and os.path.exists(world.log_path):
+                compact_log(world.log_path)
 
         mturk_manager.start_task(
-            eligibility_function=check_worker_eligibility,
+            eligibility_function=eligibility_function,
             assign_role_function=assign_worker_roles,
             task_function=run_conversation
         )
@@ -123,6 +218,14 @@ def main():
     finally:
         mturk_manager.expire_all_unassigned_hits()
         mturk_manager.shutdown()
+        if dispatcher is not None:
+            dispatcher.close()
+        shutdown_executor.close()
+        instrumentation.close()
+        eligibility.close()
+        checkpoints.close()
+        if checkpoint_dir is not None:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     main()
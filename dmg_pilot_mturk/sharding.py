@@ -0,0 +1,374 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.worlds import MTurkDMGDialogWorld
+from parlai.mturk.tasks.dmg_pilot_mturk.catalogue import load_catalogue
+from parlai.mturk.tasks.dmg_pilot_mturk.checkpoint import CheckpointStore
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import StreamingLogWriter, compact_log
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import create_instrumentation, default_instrumentation
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import INFO, WARNING
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import create_shutdown_executor
+
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+
+
+class PresetScheduler(object):
+    """
+    Scheduler of a shard's world that hands out the game the dispatcher already assigned to the workers
+    """
+
+    def __init__(self, game_id):
+        self.game_id = game_id
+
+    def assign(self, worker_ids):
+        return self.game_id
+
+
+class AgentProxy(object):
+    """
+    Stand-in in a shard process for an agent that lives in the dispatcher's process.
+    Observations and shutdowns are sent to the dispatcher, actions arrive through the shard's inbox.
+    """
+
+    def __init__(self, outbox, game_key, index, agent_id, worker_id=None):
+        """
+        :param outbox: the queue to the dispatcher
+        :param game_key: the key of the game the agent plays
+        :param index: the index of the agent in the dispatcher's agent list of the game
+        :param agent_id: the id of the agent
+        :param worker_id: the worker id of the agent, None for local agents
+        """
+        self.outbox = outbox
+        self.game_key = game_key
+        self.index = index
+        self.id = agent_id
+        # Worlds only checkpoint games of agents that have a worker id
+        if worker_id is not None:
+            self.worker_id = worker_id
+        self.actions = queue.Queue()
+
+    def observe(self, observation):
+        self.outbox.put(('observe', self.game_key, self.index, observation))
+
+    def act(self, timeout=None):
+        return self.actions.get()
+
+    def shutdown(self, timeout=None):
+        self.outbox.put(('shutdown', self.game_key, self.index))
+
+
+def run_shard(shard_id, opt, inbox, outbox, stream_logs=True):
+    """
+    Main loop of a shard process. Runs every game the dispatcher starts on its own thread, with the shard's own
+    catalogue, log writer, instrumentation and shutdown executor, until the dispatcher stops the shard
+    :param shard_id: the index of the shard
+    :param opt: the task options
+    :param inbox: the queue of game starts and agent actions from the dispatcher
+    :param outbox: the queue of observations, shutdowns and results to the dispatcher
+    :param stream_logs: write the game logs through the shard's StreamingLogWriter
+    :return: Nothing
+    """
+    if opt.get('metrics_file'):
+        opt = dict(opt, metrics_file='{}.shard{}'.format(opt['metrics_file'], shard_id))
+    instrumentation = create_instrumentation(opt)
+    shared = {
+        'catalogue': load_catalogue(opt),
+        'log_writer': StreamingLogWriter() if stream_logs else None,
+        'instrumentation': instrumentation,
+        'shutdown_executor': create_shutdown_executor(opt, instrumentation),
+        'checkpoints': CheckpointStore(opt['checkpoint_db'], max_age=opt.get('checkpoint_max_age'))
+        if opt.get('checkpoint_db') else None,
+    }
+    games = {}
+    threads = []
+
+    def run_game(game_key, spec):
+        result = {'shard': shard_id}
+        try:
+            game_shared = dict(shared, scheduler=PresetScheduler(spec['game_id'])
+                               if spec['game_id'] is not None else None)
+            world = MTurkDMGDialogWorld(opt=dict(opt, batchindex=spec['batchindex']), agents=list(games[game_key]),
+                                        shared=game_shared)
+            while not world.episode_done():
+                world.parley()
+            if shared['log_writer'] is not None:
+                shared['log_writer'].close(world.log_path)
+                compact_log(world.log_path)
+            result.update({
+                'game_id': world.game_nr,
+                'timed_out': world.timed_out(),
+                'scores': [round_state.score for round_state in world.conversation.rounds],
+                'log_path': world.log_path,
+            })
+        except Exception as e:
+            instrumentation.event(WARNING, 'shard_game_failed', shard=shard_id, error=repr(e))
+            result['error'] = repr(e)
+        del games[game_key]
+        outbox.put(('done', game_key, result))
+
+    instrumentation.event(INFO, 'shard_started', shard=shard_id)
+    outbox.put(('ready', shard_id))
+    while True:
+        message = inbox.get()
+        if message[0] == 'stop':
+            break
+        if message[0] == 'start':
+            _, game_key, spec = message
+            games[game_key] = [AgentProxy(outbox, game_key, index, agent_id, worker_id)
+                               for index, (agent_id, worker_id) in enumerate(spec['agents'])]
+            thread = threading.Thread(target=run_game, args=(game_key, spec), daemon=True)
+            thread.start()
+            threads = [thread for thread in threads if thread.is_alive()] + [thread]
+        elif message[0] == 'act':
+            # Actions that arrive after their game ended are dropped
+            _, game_key, index, action = message
+            if game_key in games:
+                games[game_key][index].actions.put(action)
+
+    for thread in threads:
+        thread.join()
+    shared['shutdown_executor'].close()
+    if shared['checkpoints'] is not None:
+        shared['checkpoints'].close()
+    instrumentation.close()
+    # Let the dispatcher report the metrics of all shards together
+    outbox.put(('metrics', shard_id, instrumentation.snapshot()))
+
+
+class GameHandle(object):
+
+    __slots__ = ('agents', 'shard', 'done', 'result', 'stopped')
+
+    def __init__(self, agents, shard):
+        self.agents = agents
+        self.shard = shard
+        self.done = threading.Event()
+        self.result = None
+        self.stopped = set()
+
+
+class ShardDispatcher(object):
+    """
+    Runs the worlds of all conversations in a pool of shard processes, so that message validation, serialization
+    and logging of different games do not compete for one interpreter lock.
+    The agents stay in the dispatcher's process: a reader thread per agent forwards its actions to the game's shard,
+    and a single router thread delivers the observations the shards send back. Every new game goes to the live shard
+    with the fewest running games. Games are assigned by the dispatcher's scheduler, so eligibility and worker records
+    stay in one place. If a shard process dies, the router ends its games with an error and shuts down their agents.
+    Only the worlds move to the shards: every action and observation of every game still passes through the
+    dispatcher's process, and its single router thread unpickles and delivers all observations. That thread bounds
+    the throughput no matter how many shards run, so adding shards only helps while the worlds, not the routing,
+    are the bottleneck. Measure it with benchmark.py --shards 1 2 4 before raising the number of shards.
+    """
+
+    # Seconds the router waits for a message before it checks whether the shards are still alive
+    poll_interval = 0.5
+
+    def __init__(self, opt, num_shards, scheduler=None, checkpoints=None, shutdown_executor=None,
+                 stream_logs=True, instrumentation=None):
+        """
+        :param opt: the task options, handed to every shard
+        :param num_shards: the number of shard processes
+        :param scheduler: the scheduler that assigns the games, e.g. the EligibilityEngine
+        :param checkpoints: the CheckpointStore of the task. Games of workers with a checkpoint are not reassigned
+        :param shutdown_executor: the ShutdownExecutor that shuts down the agents of finished games
+        :param stream_logs: let every shard write the logs of its games through its own StreamingLogWriter
+        :param instrumentation: the Instrumentation to report shard failures to and merge the shards' metrics into
+        """
+        self.scheduler = scheduler
+        self.checkpoints = checkpoints
+        self.shutdown_executor = shutdown_executor
+        self.instrumentation = instrumentation or default_instrumentation()
+        self.lock = threading.Lock()
+        self.keys = itertools.count()
+        self.games = {}
+        self.load = [0] * num_shards
+        self.started = set()
+        self.dead = set()
+        self.closing = False
+        self.ready = threading.Event()
+
+        # Shards are spawned rather than forked, as the dispatcher's process already runs threads
+        context = multiprocessing.get_context('spawn')
+        self.outbox = context.Queue()
+        self.inboxes = [context.Queue() for _ in range(num_shards)]
+        self.processes = [context.Process(target=run_shard, args=(shard_id, dict(opt), inbox, self.outbox,
+                                                                                 stream_logs),
+                                          daemon=True)
+                          for shard_id, inbox in enumerate(self.inboxes)]
+        for process in self.processes:
+            process.start()
+
+        self.router = threading.Thread(target=self.route, daemon=True)
+        self.router.start()
+
+        # Only hand out games once every shard loaded its catalogue or died trying
+        self.ready.wait()
+        if len(self.dead) == num_shards:
+            self.close()
+            raise RuntimeError("All {} shards exited during startup".format(num_shards))
+
+    def run_game(self, agents, batchindex=0):
+        """
+        Plays a game of the given agents on the least loaded shard and waits for it to end
+        :param agents: the agents of the game
+        :param batchindex: the index of the conversation, used to pick the game if there is no scheduler
+        :return: a dict with the 'shard', 'game_id', 'timed_out', round 'scores' and 'log_path' of the game, or
+            its 'error'
+        """
+        worker_ids = [getattr(agent, 'worker_id', None) for agent in agents]
+        game_id = None
+        if self.scheduler is not None and None not in worker_ids:
+            if self.checkpoints is None or self.checkpoints.load(worker_ids) is None:
+                game_id = self.scheduler.assign(worker_ids)
+
+        with self.lock:
+            alive = [shard for shard in range(len(self.load)) if shard not in self.dead]
+            if not alive:
+                return {'shard': None, 'error': 'no live shard to run the game on'}
+            shard = min(alive, key=self.load.__getitem__)
+            self.load[shard] += 1
+            game_key = next(self.keys)
+            handle = GameHandle(agents, shard)
+            self.games[game_key] = handle
+
+        self.inboxes[shard].put(('start', game_key, {
+            'agents': [(agent.id, worker_id) for agent, worker_id in zip(agents, worker_ids)],
+            'game_id': game_id,
+            'batchindex': batchindex,
+        }))
+        for index, agent in enumerate(agents):
+            threading.Thread(target=self.forward_actions, args=(game_key, handle, index, agent), daemon=True).start()
+
+        handle.done.wait()
+        with self.lock:
+            self.load[shard] -= 1
+            del self.games[game_key]
+        return handle.result
+
+    def forward_actions(self, game_key, handle, index, agent):
+        """
+        Reader thread loop that sends the actions of an agent to the shard of its game
+        :param game_key: the key of the game
+        :param handle: the GameHandle of the game
+        :param index: the index of the agent in the game
+        :param agent: the agent
+        :return: Nothing
+        """
+        while not handle.done.is_set():
+            # Obtain the action of a MTurk agent
+            try:
+                action = agent.act(timeout=None)
+            # Obtain the action of a local agent
+            except TypeError:
+                action = agent.act()
+            if handle.done.is_set():
+                break
+            self.inboxes[handle.shard].put(('act', game_key, index, action))
+            if action['episode_done']:
+                break
+
+    def route(self):
+        """
+        Router thread loop that delivers observations, shutdowns and results from the shards
+        :return: Nothing
+        """
+        next_check = time.time() + self.poll_interval
+        while True:
+            try:
+                message = self.outbox.get(timeout=self.poll_interval)
+            except queue.Empty:
+                message = ()
+            if time.time() >= next_check:
+                self.check_shards()
+                next_check = time.time() + self.poll_interval
+            if message is None:
+                break
+            if not message:
+                continue
+            if message[0] == 'ready':
+                self.started.add(message[1])
+                self.check_ready()
+                continue
+            if message[0] == 'metrics':
+                self.instrumentation.merge(message[2])
+                continue
+            handle = self.games.get(message[1])
+            if handle is None:
+                continue
+            if message[0] == 'observe':
+                handle.agents[message[2]].observe(message[3])
+            elif message[0] == 'shutdown':
+                self.shutdown_agent(handle, message[2])
+            elif message[0] == 'done':
+                # The shard hands over its teardowns asynchronously, so they may still be on their way
+                for index in range(len(handle.agents)):
+                    self.shutdown_agent(handle, index)
+                handle.result = message[2]
+                handle.done.set()
+
+    def check_ready(self):
+        if len(self.started | self.dead) == len(self.processes):
+            self.ready.set()
+
+    def check_shards(self):
+        """
+        Ends the games of shards whose process died with an error result. Only called by the router thread
+        :return: Nothing
+        """
+        if self.closing:
+            return
+        for shard, process in enumerate(self.processes):
+            if shard in self.dead or process.is_alive():
+                continue
+            with self.lock:
+                self.dead.add(shard)
+                handles = [handle for handle in self.games.values()
+                           if handle.shard == shard and not handle.done.is_set()]
+            error = 'shard {} exited with code {}'.format(shard, process.exitcode)
+            self.instrumentation.event(WARNING, 'shard_died', shard=shard, exitcode=process.exitcode,
+                                       games=len(handles))
+            for handle in handles:
+                for index in range(len(handle.agents)):
+                    self.shutdown_agent(handle, index)
+                handle.result = {'shard': shard, 'error': error}
+                handle.done.set()
+            self.check_ready()
+
+    def shutdown_agent(self, handle, index):
+        """
+        Shuts down an agent of a game unless it was shut down already. Only called by the router thread
+        :param handle: the GameHandle of the game
+        :param index: the index of the agent in the game
+        :return: Nothing
+        """
+        if index in handle.stopped:
+            return
+        handle.stopped.add(index)
+        agent = handle.agents[index]
+        if self.shutdown_executor is not None:
+            self.shutdown_executor.shutdown_agents([agent])
+        else:
+            agent.shutdown()
+
+    def close(self):
+        """
+        Stops the shards once their running games ended, and the router
+        :return: Nothing
+        """
+        self.closing = True
+        for inbox in self.inboxes:
+            inbox.put(('stop',))
+        for process in self.processes:
+            process.join()
+        self.outbox.put(None)
+        self.router.join()
@@ -4,6 +4,11 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import CONTROL_TOKENS
+from parlai.mturk.tasks.dmg_pilot_mturk.images import MANIFEST_FILE
+
+import json
+
 task_config = {}
 
 """A short and descriptive title about the kind of task the HIT contains.
@@ -31,6 +36,17 @@ On MTurk website, these words are used in searches to find HITs.
 task_config['hit_keywords'] = 'chat, dialog, goal-oriented, multi-round, visually-grounded'
 
 
+"""Base URL the game page loads the images from. Point it at a local image server (python images.py serve)
+to show pre-resized thumbnails with long-lived cache headers instead of the full-size images on GitHub.
+"""
+task_config['image_url'] = 'https://raw.githubusercontent.com/janoschhaber/psivgd/master/'
+
+
+"""Set to True if image_url points at a local image server, which also serves 2x variants for high density displays.
+"""
+task_config['image_server'] = False
+
+
 """A detailed task description that will be shown on the HIT task game_window page
 and on the left side of the chat page. Supports HTML formatting.
 """
@@ -107,7 +123,40 @@ If you are ready, please click "Accept HIT" to start this task.
 
 <script type="text/javascript">
 
-    var git_path = "https://raw.githubusercontent.com/janoschhaber/psivgd/master/";
+    var git_path = "%IMAGE_URL%";
+    var retina_path = "%RETINA_URL%";
+
+    // Content-hashed names of the pre-resized images, which the image server lets browsers cache for a year.
+    // Images missing from the manifest, or shown before it arrived, are loaded by their relative path instead
+    var image_manifest = {};
+    if (retina_path) {
+        $.getJSON(git_path + "%MANIFEST_FILE%", function(manifest) {
+            image_manifest = manifest;
+        });
+    }
+
+    function imageUrl(image_path, variant) {
+        if (image_manifest.hasOwnProperty(image_path)) {
+            return git_path + image_manifest[image_path][variant];
+        }
+        return (variant == '2x' ? retina_path : git_path) + image_path;
+    }
+
+    // Tokens of the control messages, shared with the worlds' message parser
+    var control_tokens = %CONTROL_TOKENS%;
+    var control_types = {};
+    for (var control_type in control_tokens) {
+        control_types[control_tokens[control_type]] = control_type;
+    }
+
+    function controlType(text) {
+        // Returns the type of a control message or null for chat
+        if (!text || text.charAt(0) != '<') {
+            return null;
+        }
+        var token = text.split(' ', 1)[0];
+        return control_types.hasOwnProperty(token) ? control_types[token] : null;
+    }
     
     var your_selection = "";
     var their_selection = "";
@@ -130,8 +179,13 @@ If you are ready, please click "Accept HIT" to start this task.
             var image_path = images[image_id];
         
             string += '<div class="gallery"><div class="cover" style="background-image: url(';
-            string += git_path + image_path;
-            string += ');"> </div> <div class="desc" ';
+            string += imageUrl(image_path, '1x');
+            string += ')';
+            if (retina_path) {
+                string += '; background-image: -webkit-image-set(url(' + imageUrl(image_path, '1x') + ') 1x, url(';
+                string += imageUrl(image_path, '2x') + ') 2x)';
+            }
+            string += ';"> </div> <div class="desc" ';
             string += 'id="';
             string += escapeHtml(image_path).replace(/\D/g,'');
             string += '"> <input type="radio" id="';
@@ -211,15 +265,15 @@ If you are ready, please click "Accept HIT" to start this task.
             }             
                       
             
-        } else if (text.startsWith('<selection>')) {
-            
-        } else if (text.startsWith('<next_round>')) {
-                    
-        } else if (text.startsWith('<feedback>')) {
-        
-        }else if (message.solution) {
+        } else if (controlType(text)) {
+            // Control messages of the partner are not shown in the chat
+
+        } else if (message.solution) {
             // $('#test').html(escapeHtml('Show Feedback!'));  
-            showFeedback(solution);      
+            showFeedback(solution);
+            if (message.next_images) {
+                prefetchImages(message.next_images);
+            }
         } else if (text) {
             num_messages++;
             message.id = (was_this_agent ? "YOU:" : "THEM:");
@@ -242,7 +296,7 @@ function escapeHtml(unsafe) {
 
 function sendSelectionMessage(image_id, m_type) {
 
-    var selection = '<selection> ' + String(image_id) + ' ' + String(m_type)
+    var selection = control_tokens.selection + ' ' + String(image_id) + ' ' + String(m_type)
     // $('#test').html(escapeHtml(selection));
     
     new_message_id = uuidv4();     
@@ -261,6 +315,22 @@ function sendSelectionMessage(image_id, m_type) {
       );
 }
 
+var prefetched_images = [];
+
+function prefetchImages(images) {
+    // Load the next round's images into the browser cache while the feedback is shown
+    prefetched_images = [];
+    for (var image_id in images) {
+        var image = new Image();
+        if (retina_path && window.devicePixelRatio > 1) {
+            image.src = imageUrl(images[image_id], '2x');
+        } else {
+            image.src = imageUrl(images[image_id], '1x');
+        }
+        prefetched_images.push(image);
+    }
+}
+
 function showFeedback(solution) {
  
     feedback_msg = '';
@@ -303,7 +373,7 @@ function getFeedback() {
     send_packet(
         TYPE_MESSAGE,
         {
-          text: '<feedback>',
+          text: control_tokens.feedback,
           id: cur_agent_id,
           message_id: new_message_id,
           episode_done: false
@@ -322,7 +392,7 @@ function nextRound() {
     send_packet(
         TYPE_MESSAGE,
         {
-          text: '<next_round>',
+          text: control_tokens.next_round,
           id: cur_agent_id,
           message_id: new_message_id,
           episode_done: false
@@ -337,4 +407,8 @@ function nextRound() {
 </script>
 '''
 
-
+task_config['task_description'] = task_config['task_description'] \
+    .replace('%CONTROL_TOKENS%', json.dumps(CONTROL_TOKENS)) \
+    .replace('%IMAGE_URL%', task_config['image_url']) \
+    .replace('%MANIFEST_FILE%', MANIFEST_FILE) \
+    .replace('%RETINA_URL%', task_config['image_url'] + '2x/' if task_config['image_server'] else '')
@@ -0,0 +1,135 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+# Code by Janosch Haber, University of Amsterdam. 2018
+
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import default_instrumentation, WARNING
+
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import threading
+import time
+
+
+class ShutdownExecutor(object):
+    """
+    Process-wide, bounded thread pool that shuts down the agents of finished games.
+    Worlds hand their agents over and return immediately, so a world's slot is free again while its workers are
+    still submitting their HITs. Every teardown gets a timeout, so a worker that never submits holds a pool thread
+    for a bounded time only (if one mturk agent is disconnected then it could prevent other mturk agents from
+    completing).
+    """
+
+    def __init__(self, max_workers=16, timeout=60.0, instrumentation=None):
+        """
+        :param max_workers: the number of agents that can be shut down at the same time
+        :param timeout: the number of seconds an MTurk agent may take to shut down, None to wait indefinitely
+        :param instrumentation: the Instrumentation to report teardown times and failures to
+        """
+        self.timeout = timeout
+        self.instrumentation = instrumentation or default_instrumentation()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+        # Whether the shutdown of an agent class takes a timeout, as MTurk agents do and local agents do not
+        self.takes_timeout = {}
+
+    def shutdown_agents(self, agents):
+        """
+        Queues the shutdown of a group of agents without waiting for it
+        :param agents: the agents to shut down
+        :return: a list with a future per agent that resolves to the number of seconds its shutdown took
+        """
+        return [self.pool.submit(self.teardown, agent) for agent in agents]
+
+    def teardown(self, agent):
+        """
+        Shuts down a single agent and records how long it took. Runs on a pool thread
+        :param agent: the agent to shut down
+        :return: the number of seconds the shutdown took
+        """
+        start = time.time()
+        try:
+            if self.accepts_timeout(agent):
+                agent.shutdown(timeout=self.timeout)
+            else:
+                agent.shutdown()
+        except Exception as e:
+            self.instrumentation.increment('dmg_agent_shutdown_errors_total')
+            self.instrumentation.event(WARNING, 'agent_shutdown_failed', agent=getattr(agent, 'id', None),
+                                       error=repr(e))
+        duration = time.time() - start
+
+        self.instrumentation.observe('dmg_agent_shutdown_seconds', duration)
+        if self.timeout is not None and duration >= self.timeout:
+            self.instrumentation.increment('dmg_agent_shutdown_timeouts_total')
+            self.instrumentation.event(WARNING, 'agent_shutdown_timed_out', agent=getattr(agent, 'id', None),
+                                       duration=duration)
+        return duration
+
+    def accepts_timeout(self, agent):
+        """
+        Returns True if the agent's shutdown takes a timeout, inspecting the signature once per agent class
+        :param agent: the agent to shut down
+        :return: True if shutdown can be called with a timeout
+        """
+        agent_class = type(agent)
+        if agent_class not in self.takes_timeout:
+            try:
+                parameters = inspect.signature(agent.shutdown).parameters.values()
+            except (TypeError, ValueError):
+                parameters = []
+            self.takes_timeout[agent_class] = any(parameter.name == 'timeout' or parameter.kind == parameter.VAR_KEYWORD
+                                                  for parameter in parameters)
+        return self.takes_timeout[agent_class]
+
+    def close(self, wait=True):
+        """
+        Stops accepting teardowns
+        :param wait: wait for all queued teardowns to finish
+        :return: Nothing
+        """
+        self.pool.shutdown(wait=wait)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_shutdown_executor():
+    """
+    Returns the process-wide executor used by worlds that were not handed one through shared
+    :return: the default ShutdownExecutor
+    """
+    global _default
+
+    with _default_lock:
+        if _default is None:
+            _default = ShutdownExecutor()
+        return _default
+
+
+def add_shutdown_args(argparser):
+    """
+    Adds the agent shutdown options to a ParlaiParser or argparse parser
+    :param argparser: the parser to extend
+    :return: Nothing
+    """
+    argparser.add_argument('--shutdown_workers', type=int, default=16,
+                           help='number of agents that can be shut down at the same time')
+    argparser.add_argument('--shutdown_timeout', type=float, default=60.0,
+                           help='seconds an MTurk agent may take to submit its HIT when the game ends')
+
+
+def create_shutdown_executor(opt, instrumentation=None):
+    """
+    Creates a ShutdownExecutor from the options added by add_shutdown_args
+    :param opt: the task options
+    :param instrumentation: the Instrumentation to report to
+    :return: a new ShutdownExecutor
+    """
+    return ShutdownExecutor(max_workers=opt.get('shutdown_workers') or 16,
+                            timeout=opt.get('shutdown_timeout', 60.0),
+                            instrumentation=instrumentation)
@@ -8,173 +8,561 @@
 
 from parlai.mturk.core.worlds import MTurkTaskWorld
 from parlai.core.worlds import validate
-from joblib import Parallel, delayed
-from parlai.tasks.dmg_pilot_mturk.agents import DMGMultiRoundTeacher
-from parlai.tasks.dmg_pilot_mturk.agents import WELCOME_MESSAGE
-from parlai.tasks.dmg_pilot_mturk.agents import SELECTION_TOKEN
+from parlai.mturk.tasks.dmg_pilot_mturk.catalogue import load_catalogue
+from parlai.mturk.tasks.dmg_pilot_mturk.conversation import ConversationState, RoundState
+from parlai.mturk.tasks.dmg_pilot_mturk.instrumentation import default_instrumentation, DEBUG, INFO, WARNING
+from parlai.mturk.tasks.dmg_pilot_mturk.logwriter import GAME_EVENT, MESSAGE_EVENT, ROUND_EVENT
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import MessageParser, ProtocolError
+from parlai.mturk.tasks.dmg_pilot_mturk.protocol import SELECTION, FEEDBACK, NEXT_ROUND
+from parlai.mturk.tasks.dmg_pilot_mturk.teardown import default_shutdown_executor
 from parlai.tasks.dmg_pilot_mturk.agents import COM_TOKEN
 from parlai.tasks.dmg_pilot_mturk.agents import DIF_TOKEN
-from parlai.tasks.dmg_pilot_mturk.agents import NEXT_ROUND_TOKEN
-from parlai.tasks.dmg_pilot_mturk.agents import FEEDBACK_TOKEN
 
-from copy import deepcopy
-from collections import defaultdict
+import inspect
+import os
+import queue
 import random
+import threading
 import time
 
 
+# States of a game. Every round starts by sending the players their images, lasts until both players marked all their
+# images and got their feedback, and ends once both asked for the next round
+ROUND_START = 'round_start'
+SELECTING = 'selecting'
+SCORED = 'scored'
+GAME_DONE = 'game_done'
+
+# Seconds between two polls of an agent that has no action yet, and seconds shutdown waits for a reader thread
+POLL_INTERVAL = 0.05
+READER_JOIN_TIMEOUT = 1.0
+
+# Whether the act of an agent class can return without an action, as the act of MTurk agents does with blocking=False
+takes_blocking = {}
+
+
+def accepts_blocking(agent):
+    """
+    Returns True if the agent's act takes a blocking flag, inspecting the signature once per agent class
+    :param agent: the agent to obtain actions from
+    :return: True if act can be called with blocking=False
+    """
+    agent_class = type(agent)
+    if agent_class not in takes_blocking:
+        try:
+            parameters = inspect.signature(agent.act).parameters
+        except (TypeError, ValueError):
+            parameters = {}
+        takes_blocking[agent_class] = 'blocking' in parameters
+    return takes_blocking[agent_class]
+
+
+def wait_for_action(agent, timeout=None, stopped=None):
+    """
+    Waits for the next action of an agent. Agents that can return without an action are polled, so the wait ends at
+    the deadline or as soon as the world stops without leaving a thread behind. Agents that can only block are
+    waited on in a helper thread if a timeout is set, which ends once the agent acts or is shut down
+    :param agent: the agent to obtain an action from
+    :param timeout: the number of seconds to wait for the action. None waits until the agent acts
+    :param stopped: an Event that ends the wait when it is set, e.g. when the world shuts down
+    :return: the action of the agent or None if the timeout expired or the world stopped first
+    """
+    if accepts_blocking(agent):
+        deadline = None if timeout is None else time.time() + timeout
+        while stopped is None or not stopped.is_set():
+            action = agent.act(blocking=False)
+            if action is not None:
+                return action
+            wait = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.time())
+            if wait <= 0:
+                return None
+            if stopped is not None:
+                stopped.wait(wait)
+            else:
+                time.sleep(wait)
+        return None
+
+    if timeout is not None:
+        result = queue.Queue(maxsize=1)
+        waiter = threading.Thread(target=lambda: result.put(wait_for_action(agent)), daemon=True)
+        waiter.start()
+        try:
+            return result.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Obtain the action of a MTurk agent
+    try:
+        return agent.act(timeout=None)
+    # Obtain the action of a local agent
+    except TypeError:
+        return agent.act()
+
+
 class MTurkDMGDialogWorld(MTurkTaskWorld):
 
     def __init__(self, opt, agents=None, shared=None):
         if agents is not None:
             random.shuffle(agents)
+        self.opt = opt
         self.agents = agents
         self.acts = [None] * len(agents)
-        self.task = DMGMultiRoundTeacher(opt=opt)
-        self.game_nr = 0
-        self.round_nr = -1
+
+        # The game catalogue is loaded once per process and handed to every new world through shared
+        if shared is not None and 'catalogue' in shared:
+            self.catalogue = shared['catalogue']
+        else:
+            self.catalogue = load_catalogue(opt)
+        self.scheduler = shared.get('scheduler') if shared is not None else None
+        self.log_writer = shared.get('log_writer') if shared is not None else None
+        self.instrumentation = shared.get('instrumentation') if shared is not None else None
+        if self.instrumentation is None:
+            self.instrumentation = default_instrumentation()
+        self.shutdown_executor = shared.get('shutdown_executor') if shared is not None else None
+        if self.shutdown_executor is None:
+            self.shutdown_executor = default_shutdown_executor()
+        self.round_nr = 0
         self.turn_nr = -1
+        self.turn_speakers = set()
         self.players = [agents[0].id, agents[1].id]
         self.player_labels = ["A", "B"]
-        self.selections = defaultdict(lambda: dict())
         self.data = None
+        self.num_rounds = None
+        self.round_index = None
         self.common = None
-        self.episodeDone = False
-        self.doneCounter = 0
-
-        self.conversation_log = {
-            'game_id': self.game_nr,
-            'players': self.players,
-            'agent_labels': self.player_labels,
-            'agent_ids' :[],
-            'rounds': []
+        self.state = ROUND_START
+        self.shutDown = False
+
+        # Per-round progress: the number of images every player has to mark, the number of players that marked all
+        # of theirs, and which players asked for the next round
+        self.required = None
+        self.num_selected = 0
+        self.ready = [False] * len(agents)
+        self.num_ready = 0
+
+        # Control messages are parsed once and handed to their handler, chat messages are only routed and logged
+        self.parser = MessageParser()
+        self.handlers = {
+            SELECTION: self.handle_selection,
+            FEEDBACK: self.handle_feedback,
+            NEXT_ROUND: self.handle_next_round,
         }
 
+        # In event-driven mode every agent gets a reader thread that feeds its actions into a shared queue, so that
+        # messages are routed in the order in which they arrive instead of in a fixed agent order
+        self.lockstep = opt.get('lockstep_parley', False)
+        self.action_queue = queue.Queue()
+        self.readers = []
+        self.readers_stopped = threading.Event()
+
+        # Deadlines (in seconds) after which an idle or overlong round is ended and the agents are released
+        self.turn_timeout = opt.get('turn_timeout')
+        self.round_timeout = opt.get('round_timeout')
+        self.round_start = None
+        self.last_action_time = None
+        self.timedOut = False
+
+        agent_ids = []
         for i, agent in enumerate(agents):
             try:
-                self.conversation_log['agent_ids'].append(agent.worker_id)
+                agent_ids.append(agent.worker_id)
             except:
-                self.conversation_log['agent_ids'].append(self.player_labels[i])
+                agent_ids.append(self.player_labels[i])
+
+        # Games are checkpointed under the worker ids of their players, so games of local agents are not
+        self.checkpoints = shared.get('checkpoints') if shared is not None else None
+        self.checkpoint_selections = opt.get('checkpoint_selections', False)
+        self.worker_ids = agent_ids if all(hasattr(agent, 'worker_id') for agent in agents) else None
+        checkpoint = None
+        if self.checkpoints is not None and self.worker_ids is not None:
+            checkpoint = self.checkpoints.load(self.worker_ids)
+
+        if checkpoint is not None:
+            self.resume(checkpoint)
+            return
+
+        # Let the scheduler pick a game neither worker has seen, or fall back to the conversation's batch index.
+        # Only agents with a worker id are recorded, local agents would otherwise count as workers labelled A and B
+        if self.scheduler is not None:
+            self.game_nr = self.scheduler.assign([agent.worker_id for agent in agents if hasattr(agent, 'worker_id')])
+        else:
+            self.game_nr = self.catalogue.game_ids[opt.get('batchindex', 0) % len(self.catalogue)]
+
+        self.load_game()
+
+        # The conversation is kept in a compact form and only turned into the log schema when it is written
+        self.conversation = ConversationState(self.game_nr, self.players, self.player_labels, agent_ids,
+                                              self.catalogue.image_ids, self.catalogue.images)
+
+        # Stream every message and round summary to a JSON Lines log as they happen
+        self.log_path = os.path.join('logs', 'dmg_pilot_data_{}_{}.jsonl'.format(self.game_nr, time.time()))
+        self.log_event(GAME_EVENT, self.conversation.header())
 
         self.round_log = self.reset_round_log()
 
+    def resume(self, checkpoint):
+        """
+        Continues the game of the world's workers from its checkpoint instead of starting a new game
+        :param checkpoint: the state saved by save_checkpoint
+        :return: Nothing
+        """
+        self.conversation = ConversationState.from_checkpoint(checkpoint['conversation'], self.catalogue.image_ids,
+                                                              self.catalogue.images)
+
+        # Give every worker the slot and label it had before the restart
+        agents = dict(zip((str(worker_id) for worker_id in self.worker_ids), self.agents))
+        self.agents = [agents[worker_id] for worker_id in self.conversation.agent_ids]
+        self.players = list(self.conversation.players)
+        self.player_labels = list(self.conversation.agent_labels)
+
+        self.game_nr = self.conversation.game_id
+        self.load_game()
+        self.round_nr = checkpoint['round_nr']
+        if checkpoint.get('round') is not None:
+            self.round_log = RoundState.from_checkpoint(self.conversation, checkpoint['round'])
+        else:
+            self.round_log = self.reset_round_log()
+
+        # The stream of the crashed process may hold messages past the checkpoint, so the game gets a new stream
+        self.log_path = os.path.join('logs', 'dmg_pilot_data_{}_{}.jsonl'.format(self.game_nr, time.time()))
+        self.log_event(GAME_EVENT, self.conversation.header())
+        if self.log_writer is not None:
+            for round_state in self.conversation.rounds + [self.round_log]:
+                round_nr = self.round_nr if round_state is self.round_log else round_state.round_nr
+                for index in range(len(round_state.messages)):
+                    self.log_writer.write(self.log_path, MESSAGE_EVENT,
+                                          dict(round_state.message_log(index), round=round_nr))
+                if round_state is not self.round_log:
+                    self.log_writer.write(self.log_path, ROUND_EVENT, dict(round_state.summary(), round=round_nr))
+
+        self.instrumentation.event(INFO, 'game_resumed', game=self.game_nr, round=self.round_nr,
+                                   messages=len(self.round_log.messages))
+
+
+    def load_game(self):
+        """
+        Looks up the game data and the number of rounds to play
+        :return: Nothing
+        """
+        self.data = self.catalogue[self.game_nr]
+        num_rounds = len(self.catalogue.rounds(self.game_nr))
+        self.num_rounds = min(self.opt.get('num_rounds') or num_rounds, num_rounds)
 
     def parley(self):
         """
         Main communication loop for the agents involved in the task
         :return: Nothing
         """
+        if self.state == GAME_DONE:
+            return
 
-        # If a new round has started, load the game data (if necessary) and send it to the players
-        if self.turn_nr == -1:
-            # Load a new game (data) if no game is running yet
-            if self.round_nr == -1 and not self.data:
-                self.data = self.task.episodes[self.game_nr % len(self.task.episodes)]
-                self.round_nr = 0
+        # If a new round has started, send the game data to the players
+        if self.state == ROUND_START:
+            self.start_round()
 
-            # Determine the common images
-            self.common = list(set(self.data[self.player_labels[0]][self.round_nr])
-                               .intersection(self.data[self.player_labels[1]][self.round_nr]))
-
-            # Send a welcome message with the game data to all players
+        # Else observe the actions of the players
+        elif self.lockstep:
             for agent, player, player_label in zip(self.agents, self.players, self.player_labels):
+                action = self.get_action(agent, timeout=self.time_left())
+                if action is None:
+                    self.expire_round()
+                    return
+                self.process_action(agent, player, player_label, action)
 
-                image_list = ""
-                for image in self.data[player_label][self.round_nr]:
-                    image_list += "{} \n".format(image)
-
-                action = {}
-                action['text'] = WELCOME_MESSAGE.format(self.round_nr+1, player, image_list)
-                action['images'] = self.data[player_label][self.round_nr]
-                print(action['images'])
-
-                agent.observe(validate(action))
+                # Do not wait for the other player if this action ended the round
+                if self.state in (ROUND_START, GAME_DONE):
+                    return
 
             self.turn_nr += 1
 
-        # Else observe the actions of the players
+        # Or handle whichever action arrived first if the world is event-driven
         else:
-            for agent, player, player_label in zip(self.agents, self.players, self.player_labels):
-
-                # Obtain the action of a MTurk agent
-                try:
-                    action = agent.act(timeout=None)
-                # Obtain the action of a local agent
-                except TypeError:
-                    action = agent.act()
+            if not self.readers:
+                self.start_readers()
 
-                # Let the other agents observe the action
-                for other_agent in self.agents:
-                    if other_agent != agent:
-                        other_agent.observe(validate(action))
+            try:
+                agent, player, player_label, action = self.action_queue.get(timeout=self.time_left())
+            except queue.Empty:
+                self.expire_round()
+                return
+            self.process_action(agent, player, player_label, action)
+
+            # As in lockstep mode, a turn lasts until every player sent a message
+            self.turn_speakers.add(player)
+            if len(self.turn_speakers) == len(self.players):
+                self.turn_speakers.clear()
+                self.turn_nr += 1
+
+    def start_round(self):
+        """
+        Sends the images of the current round to the players and resets the round's progress
+        :return: Nothing
+        """
+        # Look up the common images and the welcome messages that were prepared when the catalogue was loaded
+        self.round_index = self.catalogue.rounds(self.game_nr)[self.round_nr]
+        self.common = self.round_index.common
+
+        # A round resumed from a checkpoint may already hold selections
+        self.required = [len(self.round_index.images[player_label]) for player_label in self.player_labels]
+        self.num_selected = sum(1 for player_index, selections in enumerate(self.round_log.selections)
+                                if len(selections) >= self.required[player_index])
+        self.ready = [False] * len(self.players)
+        self.num_ready = 0
+
+        # Send a welcome message with the game data to all players
+        for agent, player, player_label in zip(self.agents, self.players, self.player_labels):
+            action = self.round_index.welcome(player_label, player)
+            agent.observe(validate(action))
 
-                # Parse a selection
-                message = action["text"]
-                print("Message sent was: {}".format(message))
+        self.instrumentation.event(DEBUG, 'round_started', game=self.game_nr, round=self.round_nr,
+                                   images=dict(self.round_index.images))
+        self.round_start = time.time()
+        self.last_action_time = self.round_start
+        self.turn_nr = 0
+        self.turn_speakers.clear()
+        self.state = SELECTING
 
-                log_entry = self.create_message_log_entry(agent, player, player_label, message)
-                self.round_log['messages'].append(log_entry)
+    def process_action(self, agent, player, player_label, action):
+        """
+        Routes the action of an agent to its partner, logs it and handles the game's control messages
+        :param agent: the agent that produced the action
+        :param player: the id of the player the agent represents
+        :param player_label: the label of the player the agent represents
+        :param action: the action produced by the agent
+        :return: Nothing
+        """
+        now = time.time()
+        if self.round_log.messages:
+            self.instrumentation.observe('dmg_turn_latency_seconds', now - self.last_action_time)
+        else:
+            self.instrumentation.observe('dmg_time_to_first_message_seconds', now - self.round_start)
+        self.instrumentation.increment('dmg_messages_total')
+        self.last_action_time = now
+
+        # Let the other agents observe the action
+        for other_agent in self.agents:
+            if other_agent != agent:
+                other_agent.observe(validate(action))
+
+        # Log the message and parse it if it is a control message
+        message = action["text"]
+        if self.instrumentation.enabled(DEBUG):
+            self.instrumentation.event(DEBUG, 'message', game=self.game_nr, round=self.round_nr, turn=self.turn_nr,
+                                       player=player_label, text=message)
+
+        player_index = self.players.index(player)
+        index = self.round_log.add_message(now, self.turn_nr, player_index, message)
+        if self.log_writer is not None:
+            self.log_event(MESSAGE_EVENT, self.round_log.message_log(index))
 
-                message = message.split(" ")
-                if message[0] == SELECTION_TOKEN:
-                    try:
-                        assert len(message) == 3
-                        image_id = message[-1]
-                        image_type = message[1]
-                        self.selections[agent][image_id] = image_type
-                        print("Marked image {} as {}".format(image_id, image_type))
+        try:
+            parsed = self.parser.parse(message)
+        except ProtocolError as error:
+            self.instrumentation.increment('dmg_protocol_errors_total')
+            self.instrumentation.event(WARNING, 'protocol_error', game=self.game_nr, round=self.round_nr,
+                                       player=player_label, type=error.message_type, reason=error.reason,
+                                       text=error.text)
+        else:
+            handler = self.handlers.get(parsed.type)
+            if handler is not None:
+                handler(player_index, parsed)
+
+        # Check if episode ended due to disconnection or timeout or returned hit
+        if action['episode_done'] and self.state != GAME_DONE:
+            self.instrumentation.increment('dmg_disconnects_total')
+            self.instrumentation.event(WARNING, 'disconnect', game=self.game_nr, round=self.round_nr,
+                                       player=player_label)
+            self.end_game()
+
+    def handle_selection(self, player_index, message):
+        """
+        Records a player marking an image as common or different
+        :param player_index: the index of the player that sent the message
+        :param message: the parsed SelectionMessage
+        :return: Nothing
+        """
+        selections = self.round_log.selections[player_index]
+        marked = len(selections)
+        self.round_log.select(player_index, message.image, message.image_type)
+        if marked < self.required[player_index] <= len(selections):
+            self.num_selected += 1
+        if self.checkpoint_selections:
+            self.save_checkpoint(self.round_nr, partial=True)
+        if self.instrumentation.enabled(DEBUG):
+            self.instrumentation.event(DEBUG, 'selection', game=self.game_nr, round=self.round_nr,
+                                       player=self.player_labels[player_index], image=message.image,
+                                       image_type=message.image_type)
+
+    def handle_feedback(self, player_index, message):
+        """
+        Scores the round and sends the feedback once all images are marked
+        :param player_index: the index of the player that sent the message
+        :param message: the parsed feedback message
+        :return: Nothing
+        """
+        if self.state == SELECTING and self.all_selected():
+            self.round_log.score = self.send_feedback()
+            self.state = SCORED
 
-                    except:
-                        print("WARNING: Your selection could not be parsed properly!")
+    def handle_next_round(self, player_index, message):
+        """
+        Ends the round once both players got their feedback and asked to continue
+        :param player_index: the index of the player that sent the message
+        :param message: the parsed next round message
+        :return: Nothing
+        """
+        if self.state != SCORED or self.ready[player_index]:
+            return
 
-                if message[0] == FEEDBACK_TOKEN and self.all_selected():
-                    scores = self.send_feedback()
-                    self.round_log['score'] = scores
+        self.ready[player_index] = True
+        self.num_ready += 1
+        if self.num_ready < len(self.players):
+            self.instrumentation.event(DEBUG, 'continue', game=self.game_nr, round=self.round_nr,
+                                       player=self.player_labels[player_index])
+            return
 
-                if message[0] == NEXT_ROUND_TOKEN and self.all_selected() and self.doneCounter == 0:
-                    print("One player clicked continue")
-                    self.doneCounter += 1
+        self.end_round()
 
-                elif message[0] == NEXT_ROUND_TOKEN and self.all_selected() and self.doneCounter == 1:
-                    print("Logging data")
-                    self.round_log['round_nr'] = self.round_nr
-                    self.round_log['images'] = {self.player_labels[0]: self.data[self.player_labels[0]][self.round_nr],
-                                                self.player_labels[1]: self.data[self.player_labels[1]][self.round_nr]}
-                    self.conversation_log['rounds'].append(deepcopy(self.round_log))
+    def end_round(self):
+        """
+        Logs the completed round and moves on to the next round or ends the game after the last one
+        :return: Nothing
+        """
+        duration = time.time() - self.round_start
+        self.instrumentation.observe('dmg_round_duration_seconds', duration)
+        self.instrumentation.increment('dmg_rounds_total')
+        self.instrumentation.event(INFO, 'round_completed', game=self.game_nr, round=self.round_nr,
+                                   duration=duration, score=self.round_log.score)
+        self.round_log.round_nr = self.round_nr
+        self.round_log.images = self.round_index.images
+        self.conversation.rounds.append(self.round_log)
+        self.log_round()
+
+        # Only a completed game drops its checkpoint, so a game a worker dropped out of can still be resumed
+        if self.round_nr + 1 >= self.num_rounds:
+            self.clear_checkpoint()
+            self.end_game()
+            return
+
+        # A crashed game continues with the next round
+        self.save_checkpoint(self.round_nr + 1)
+        self.round_nr += 1
+        self.round_log = self.reset_round_log()
+        self.state = ROUND_START
 
-                    self.episodeDone = True
+    def end_game(self):
+        """
+        Ends the game and releases the agents
+        :return: Nothing
+        """
+        self.state = GAME_DONE
+        self.shutdown()
 
+    def get_action(self, agent, timeout=None):
+        """
+        Waits for the next action of the given agent
+        :param agent: the agent to obtain an action from
+        :param timeout: the number of seconds to wait for the action. None blocks until the agent acts
+        :return: the action of the agent or None if the timeout expired or the world shut down first
+        """
+        return wait_for_action(agent, timeout, self.readers_stopped)
 
-                # Check if episode ended due to disconnection or timeout or returned hit
-                elif action['episode_done']:
-                    self.episodeDone = True
+    def time_left(self):
+        """
+        Returns the time until the earliest of the current turn and round deadlines
+        :return: the number of seconds left or None if no deadlines are set
+        """
+        deadlines = []
+        if self.turn_timeout:
+            deadlines.append(self.last_action_time + self.turn_timeout)
+        if self.round_timeout:
+            deadlines.append(self.round_start + self.round_timeout)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def expire_round(self):
+        """
+        Ends the current round after a deadline expired, logs the partial round data and releases the agents
+        :return: Nothing
+        """
+        self.instrumentation.increment('dmg_round_timeouts_total')
+        self.instrumentation.event(WARNING, 'round_timed_out', game=self.game_nr, round=self.round_nr,
+                                   duration=time.time() - self.round_start, messages=len(self.round_log.messages))
+        self.round_log.round_nr = self.round_nr
+        self.round_log.images = self.round_index.images
+        self.round_log.timed_out = True
+        self.conversation.rounds.append(self.round_log)
+        self.log_round()
+
+        self.timedOut = True
+        self.end_game()
+
+    def start_readers(self):
+        """
+        Starts a reader thread for every agent that feeds the agent's actions into the world's action queue
+        :return: Nothing
+        """
+        for agent, player, player_label in zip(self.agents, self.players, self.player_labels):
+            reader = threading.Thread(target=self.read_actions, args=(agent, player, player_label), daemon=True)
+            reader.start()
+            self.readers.append(reader)
 
-            self.turn_nr += 1
+    def read_actions(self, agent, player, player_label):
+        """
+        Reader thread loop that queues the actions of a single agent until it is done or the world shuts down
+        :param agent: the agent to read actions from
+        :param player: the id of the player the agent represents
+        :param player_label: the label of the player the agent represents
+        :return: Nothing
+        """
+        while not self.readers_stopped.is_set():
+            action = self.get_action(agent)
+            if action is None or self.readers_stopped.is_set():
+                break
+            self.action_queue.put((agent, player, player_label, action))
+            if action['episode_done']:
+                break
+
+    def share(self):
+        """
+        Returns the data that new worlds can reuse instead of loading it themselves
+        :return: the shared data of this world
+        """
+        shared = {}
+        shared['world_class'] = type(self)
+        shared['opt'] = self.opt
+        shared['catalogue'] = self.catalogue
+        shared['scheduler'] = self.scheduler
+        shared['log_writer'] = self.log_writer
+        shared['instrumentation'] = self.instrumentation
+        shared['shutdown_executor'] = self.shutdown_executor
+        shared['checkpoints'] = self.checkpoints
+        return shared
 
     def send_feedback(self):
         """
         Sends feedback to the player after each round of the game and calculates the scores
-        :return: The scores for all players. 6 points means all images marked correctly, 0 points means zero correct.
+        :return: The scores for all players, the number of images each player marked correctly.
         """
-        # print("The common images were {}".format(self.common))
-
         scores = {self.players[0]: 0, self.players[1]: 0}
 
         # Send a feedback message to all players
-        for agent, player in zip(self.agents, self.players):
+        for player_index, (agent, player, player_label) in enumerate(zip(self.agents, self.players,
+                                                                         self.player_labels)):
 
             solutions = []
 
             feedback = "Feedback for Agent {}:\n".format(player)
-            for image_id, selection in self.selections[agent].items():
+            for image_id, selection in self.round_log.selected(player_index):
                 # file = "person_fridge_pilot/COCO_train2014_{:0>12d}.jpg".format(int(image_id))
                 file = image_id
                 feedback += "You marked image {} as ".format(image_id)
                 if selection == COM_TOKEN: feedback += "common"
                 elif selection == DIF_TOKEN: feedback += "different"
                 feedback += " which was "
-                if (selection == COM_TOKEN and file in self.common) \
-                        or (selection == DIF_TOKEN and file not in self.common):
+                if (selection == COM_TOKEN and self.round_index.is_common(file)) \
+                        or (selection == DIF_TOKEN and not self.round_index.is_common(file)):
                     feedback += "correct.\n"
                     solutions.append([image_id, 1])
                     scores[player] += 1
@@ -182,77 +570,114 @@ class MTurkDMGDialogWorld(MTurkTaskWorld):
                     feedback += "incorrect.\n"
                     solutions.append([image_id, 0])
 
-            try:
-                assert len(solutions) == 6
-            except:
-                print("Not all images marked yet!")
-                continue
+            if len(solutions) != self.required[player_index]:
+                self.instrumentation.event(WARNING, 'feedback_incomplete', game=self.game_nr, round=self.round_nr,
+                                           player=player_label, marked=len(solutions))
 
             action = {}
             action['text'] = feedback
             action['solution'] = solutions
-            print(action['solution'])
+            if solutions:
+                self.instrumentation.observe('dmg_selection_accuracy', scores[player] / float(len(solutions)))
+            self.instrumentation.event(DEBUG, 'feedback', game=self.game_nr, round=self.round_nr,
+                                       player=player_label, solution=solutions)
+
+            # Let the player's page prefetch the images of the next round while the feedback is shown
+            if self.round_nr + 1 < self.num_rounds:
+                action['next_images'] = self.data[player_label][self.round_nr + 1]
+
             agent.observe(validate(action))
 
-        print("Scores for this round are {}".format(scores))
+        self.instrumentation.event(INFO, 'round_scored', game=self.game_nr, round=self.round_nr, scores=scores)
         return scores
 
-    def create_message_log_entry(self, agent, player, player_label, message):
-
-        try:
-            agent_id = agent.worker_id
-        except:
-            agent_id = player_label
-
-        entry = {
-            'timestamp': time.time(),
-            'turn': self.turn_nr,
-            'speaker:': player_label,
-            'agent_label': player,
-            'agent_id': agent_id,
-            'message': message
-        }
-        return entry
+    @property
+    def conversation_log(self):
+        """
+        Serializes the conversation so far to the log schema
+        :return: the conversation log
+        """
+        return self.conversation.to_log()
 
     def all_selected(self):
         """
         Returns True if all players selected all images
         :return: True if all players selected all images
         """
-        for agent in self.agents:
-            if len(self.selections[agent]) < 6:
-                return False
-        return True
+        return self.num_selected == len(self.players)
+
+    def log_event(self, event, record):
+        """
+        Passes a record to the streaming log writer if the world has one
+        :param event: the type of the record
+        :param record: the record to log
+        :return: Nothing
+        """
+        if self.log_writer is None:
+            return
+        if event != GAME_EVENT:
+            record = dict(record, round=self.round_nr)
+        self.log_writer.write(self.log_path, event, record)
+
+    def log_round(self):
+        """
+        Logs the summary of the current round, without its messages which were streamed already
+        :return: Nothing
+        """
+        self.log_event(ROUND_EVENT, self.round_log.summary())
+
+    def save_checkpoint(self, round_nr, partial=False):
+        """
+        Saves the state of the game to the checkpoint store if the world has one
+        :param round_nr: the round to continue with after a restart
+        :param partial: include the messages and selections of the current round
+        :return: Nothing
+        """
+        if self.checkpoints is None or self.worker_ids is None:
+            return
+        self.checkpoints.save(self.worker_ids, {
+            'game_id': self.game_nr,
+            'round_nr': round_nr,
+            'conversation': self.conversation.to_checkpoint(),
+            'round': self.round_log.to_checkpoint() if partial else None,
+        })
+
+    def clear_checkpoint(self):
+        if self.checkpoints is not None and self.worker_ids is not None:
+            self.checkpoints.delete(self.worker_ids)
 
     def reset_round_log(self):
-        return {
-            'round_nr': None,
-            'score': None,
-            'images': None,
-            'messages': []
-        }
+        return self.conversation.new_round()
 
     def episode_done(self):
         """
-        Returns True if the current game round (episode) is done
-        :return: True if the current game round (episode) is done
+        Returns True if the game (episode) is done
+        :return: True if the game (episode) is done
         """
-        return self.episodeDone
+        return self.state == GAME_DONE
+
+    def timed_out(self):
+        """
+        Returns True if the game was ended because a turn or round deadline expired
+        :return: True if the game was ended because a turn or round deadline expired
+        """
+        return self.timedOut
 
     def shutdown(self):
         """
-        Shuts down all mturk agents in parallel
+        Hands all mturk agents to the shared shutdown executor, which shuts them down in parallel
         (if one mturk agent is disconnected then it could prevent other mturk agents from completing.)
+        :return: a future per agent that resolves when the agent is shut down
         """
-        global shutdown_agent
-
-        def shutdown_agent(agent):
-            # Shut down MTurk agents
-            try:
-                agent.shutdown(timeout=None)
-            # Shut down local agents
-            except Exception:
-                agent.shutdown()
-
-        Parallel(n_jobs=len(self.agents), backend='threading')\
-            (delayed(shutdown_agent)(agent) for agent in self.agents)
+        # The world shuts its agents down itself when the game ends, so later calls have nothing left to do
+        if self.shutDown:
+            return []
+        self.shutDown = True
+        self.readers_stopped.set()
+        futures = self.shutdown_executor.shutdown_agents(self.agents)
+
+        # Polling readers stop within a poll interval, readers blocked in an agent's act once it is shut down
+        for reader in self.readers:
+            if reader is not threading.current_thread():
+                reader.join(timeout=READER_JOIN_TIMEOUT)
+        return futures